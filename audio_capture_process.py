@@ -0,0 +1,215 @@
+import logging
+import multiprocessing as mp
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# Audio capture and analysis in a dedicated process.
+#
+# The child process owns the sounddevice stream and the numpy DSP, and writes one
+# feature row per audio block into a shared memory ring buffer. The control
+# process only ever reads the newest row, so neither side takes a lock and the
+# network code in the control process can no longer starve the audio callback.
+
+# Header slots (int64) at the start of the shared memory block
+_HDR_WRITE_SEQ = 0      # Number of rows published by the producer
+_HDR_OVERFLOWS = 1      # Audio input overflows reported by PortAudio
+_HDR_READY = 2          # Set to 1 once the input stream is running, -1 on failure
+_HDR_SAMPLERATE = 3     # Sample rate picked by the producer
+_HDR_UNDERRUNS = 4      # Gaps in the captured audio, from PortAudio or the block timestamps
+_HEADER_LEN = 8
+
+
+class SharedFeatureRing:
+    """Single-producer / single-consumer ring of float64 feature rows in shared memory.
+
+    Every slot stores its sequence number in column 0 and the features after it.
+    The producer writes the features, then the slot sequence, then bumps the
+    global write sequence. The reader copies the newest slot and checks that the
+    slot sequence did not change while copying, which detects the (rare) case of
+    the producer lapping the reader without any locking.
+    """
+
+    def __init__(self, n_features: int, capacity: int = 64, name: str = None):
+        self.n_features = n_features
+        self.capacity = capacity
+        size = 8 * (_HEADER_LEN + capacity * (n_features + 1))
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+            self._owner = True
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            self._owner = False
+        self.header = np.ndarray((_HEADER_LEN,), dtype=np.int64, buffer=self.shm.buf)
+        self.slots = np.ndarray((capacity, n_features + 1), dtype=np.float64,
+                                buffer=self.shm.buf, offset=8 * _HEADER_LEN)
+        if self._owner:
+            self.header[:] = 0
+            self.slots[:] = -1.0
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def write(self, features: np.ndarray):
+        """Publish one feature row (producer side only)."""
+        seq = int(self.header[_HDR_WRITE_SEQ])
+        slot = self.slots[seq % self.capacity]
+        slot[0] = -1.0  # Mark the slot as being written
+        slot[1:] = features
+        slot[0] = float(seq)
+        self.header[_HDR_WRITE_SEQ] = seq + 1
+
+    def write_seq(self) -> int:
+        return int(self.header[_HDR_WRITE_SEQ])
+
+    def read(self, seq: int):
+        """Return a copy of the row with the given sequence number, or None if it was overwritten."""
+        slot = self.slots[seq % self.capacity]
+        if slot[0] != seq:
+            return None
+        features = slot[1:].copy()
+        if slot[0] != seq:
+            return None
+        return features
+
+    def close(self):
+        # Drop the numpy views before closing, otherwise the buffer is still exported
+        self.header = None
+        self.slots = None
+        self.shm.close()
+        if self._owner:
+            self.shm.unlink()
+
+
+def _capture_main(ring_name: str, n_features: int, capacity: int, mode: str, sensitivity: float,
+                  fmin: float, fmax: float, blocksize: int, stop_event):
+    """Entry point of the capture process."""
+    import sounddevice as sd
+    from audio_features import SpectrumAnalyzer
+
+    ring = SharedFeatureRing(n_features, capacity, name=ring_name)
+    try:
+        samplerate = sd.query_devices(kind='input')['default_samplerate']
+        ring.header[_HDR_SAMPLERATE] = int(samplerate)
+        analyzer = None
+        if mode == "spectrum":
+            analyzer = SpectrumAnalyzer(samplerate, n_features, fmin=fmin, fmax=fmax, sensitivity=sensitivity / 10.0)
+
+        last_block = {"end": None}
+
+        def audio_callback(indata, frames, time_info, status):
+            if status.input_overflow:
+                ring.header[_HDR_OVERFLOWS] += 1
+            # A block that starts well after the previous one ended means audio went missing in between
+            start = time_info.inputBufferAdcTime
+            if status.input_underflow or (start and last_block["end"] is not None
+                                          and start - last_block["end"] > 0.5 * frames / samplerate):
+                ring.header[_HDR_UNDERRUNS] += 1
+            last_block["end"] = start + frames / samplerate if start else None
+            if analyzer is not None:
+                ring.write(analyzer.process(indata))
+            else:
+                ring.write(np.array([np.linalg.norm(indata) * 10]))
+
+        with sd.InputStream(samplerate=samplerate, blocksize=blocksize, callback=audio_callback):
+            ring.header[_HDR_READY] = 1
+            while not stop_event.wait(0.2):
+                pass
+    except Exception as e:
+        ring.header[_HDR_READY] = -1
+        logging.error(f"Audio capture process failed: {e}")
+    finally:
+        ring.close()
+
+
+class AudioCaptureProcess:
+    """Runs audio capture and feature extraction in a separate process.
+
+    poll() is non-blocking and returns the newest feature row, or None when the
+    producer has not published anything since the last call. Rows that were
+    published but superseded before the reader got to them are counted as
+    skipped. Underruns are gaps in the audio the capture process received,
+    not polls that found nothing new.
+    """
+
+    def __init__(self, mode: str, n_features: int, sensitivity: float = 10.0, fmin: float = 40.0,
+                 fmax: float = None, blocksize: int = 0, capacity: int = 64):
+        self.mode = mode
+        self.n_features = n_features
+        self.sensitivity = sensitivity
+        self.fmin = fmin
+        self.fmax = fmax
+        self.blocksize = blocksize
+        self.capacity = capacity
+        self.ring = None
+        self.samplerate = None
+        self.process = None
+        self._stop_event = None
+        self._read_seq = 0
+        self.frames_read = 0
+        self.skipped = 0
+        self.torn_reads = 0
+
+    def start(self, timeout: float = 5.0) -> float:
+        """Start the capture process and wait for its stream. Returns the sample rate in use."""
+        ctx = mp.get_context("spawn")
+        self.ring = SharedFeatureRing(self.n_features, self.capacity)
+        self._stop_event = ctx.Event()
+        self.process = ctx.Process(
+            target=_capture_main,
+            args=(self.ring.name, self.n_features, self.capacity, self.mode, self.sensitivity,
+                  self.fmin, self.fmax, self.blocksize, self._stop_event),
+            name="audio-capture",
+            daemon=True,
+        )
+        self.process.start()
+        deadline = time.monotonic() + timeout
+        while self.ring.header[_HDR_READY] == 0:
+            if time.monotonic() > deadline or not self.process.is_alive():
+                self.stop()
+                raise RuntimeError("Audio capture process did not start.")
+            time.sleep(0.01)
+        if self.ring.header[_HDR_READY] < 0:
+            self.stop()
+            raise RuntimeError("Audio capture process could not open the input stream.")
+        self.samplerate = float(self.ring.header[_HDR_SAMPLERATE])
+        return self.samplerate
+
+    def poll(self):
+        write_seq = self.ring.write_seq()
+        if write_seq <= self._read_seq:
+            return None
+        newest = write_seq - 1
+        features = self.ring.read(newest)
+        if features is None:
+            # The producer lapped us while copying; try again on the next poll
+            self.torn_reads += 1
+            return None
+        self.skipped += newest - self._read_seq
+        self._read_seq = write_seq
+        self.frames_read += 1
+        return features
+
+    def stats(self) -> dict:
+        return {
+            "produced": self.ring.write_seq() if self.ring else 0,
+            "read": self.frames_read,
+            "skipped": self.skipped,
+            "underruns": int(self.ring.header[_HDR_UNDERRUNS]) if self.ring else 0,
+            "torn_reads": self.torn_reads,
+            "input_overflows": int(self.ring.header[_HDR_OVERFLOWS]) if self.ring else 0,
+        }
+
+    def stop(self):
+        if self._stop_event is not None:
+            self._stop_event.set()
+        if self.process is not None:
+            self.process.join(timeout=2.0)
+            if self.process.is_alive():
+                self.process.terminate()
+            self.process = None
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
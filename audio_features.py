@@ -0,0 +1,118 @@
+import numpy as np
+
+# Vectorized audio analysis helpers shared by the microphone driven effects.
+# Everything in here works on whole numpy arrays so that a single audio block
+# costs one FFT and a handful of array operations, independent of band count.
+
+
+def make_band_edges(n_bands: int, samplerate: float, fmin: float = 40.0, fmax: float = None) -> np.ndarray:
+    """Return n_bands + 1 logarithmically spaced band edges in Hz."""
+    nyquist = samplerate / 2.0
+    if fmax is None or fmax > nyquist:
+        fmax = nyquist
+    if fmin <= 0 or fmin >= fmax:
+        raise ValueError(f"Invalid frequency range: {fmin} Hz - {fmax} Hz")
+    return np.geomspace(fmin, fmax, n_bands + 1)
+
+
+def hsv_to_rgb(hues: np.ndarray, saturation: float = 1.0, value: float = 1.0) -> np.ndarray:
+    """Vectorized HSV to RGB conversion. Hues are in [0, 1), the result is an (n, 3) uint8 array."""
+    hues = np.asarray(hues, dtype=np.float64) % 1.0
+    h6 = hues * 6.0
+    sector = np.floor(h6).astype(np.int64) % 6
+    f = h6 - np.floor(h6)
+    p = value * (1.0 - saturation)
+    q = value * (1.0 - saturation * f)
+    t = value * (1.0 - saturation * (1.0 - f))
+    v = np.full_like(hues, value)
+    p = np.full_like(hues, p)
+    # Rows are indexed by sector, columns are the r/g/b channel picks for that sector
+    choices = np.stack([
+        np.stack([v, t, p], axis=-1),
+        np.stack([q, v, p], axis=-1),
+        np.stack([p, v, t], axis=-1),
+        np.stack([p, q, v], axis=-1),
+        np.stack([t, p, v], axis=-1),
+        np.stack([v, p, q], axis=-1),
+    ])
+    rgb = choices[sector, np.arange(hues.shape[0])]
+    return np.clip(np.rint(rgb * 255.0), 0, 255).astype(np.uint8)
+
+
+def band_hues(n_bands: int) -> np.ndarray:
+    """Spread the bands from red (bass) to violet (treble)."""
+    if n_bands == 1:
+        return np.zeros(1)
+    return np.linspace(0.0, 0.8, n_bands)
+
+
+class SpectrumAnalyzer:
+    """Splits audio blocks into frequency bands and returns normalized band levels.
+
+    The window, FFT bin boundaries and per-bin band membership are computed
+    once for a given block size, so processing a block is a single rfft plus a
+    reduceat over the magnitude spectrum.
+    """
+
+    def __init__(self, samplerate: float, n_bands: int, fmin: float = 40.0, fmax: float = None,
+                 sensitivity: float = 1.0, decay: float = 0.995):
+        self.samplerate = samplerate
+        self.n_bands = n_bands
+        self.sensitivity = sensitivity
+        self.decay = decay
+        self.edges = make_band_edges(n_bands, samplerate, fmin, fmax)
+        self._blocksize = None
+        self._window = None
+        self._bin_starts = None
+        self._bin_stop = None
+        self._bin_counts = None
+        # Running peak over all bands, used as an automatic gain control that keeps
+        # the relative loudness of the bands intact
+        self._peak = 1e-6
+
+    def _prepare(self, blocksize: int):
+        self._blocksize = blocksize
+        self._window = np.hanning(blocksize)
+        freqs = np.fft.rfftfreq(blocksize, d=1.0 / self.samplerate)
+        starts = np.searchsorted(freqs, self.edges[:-1], side='left')
+        # Every band needs at least one bin, so narrow low bands borrow the next bins up
+        offsets = np.arange(self.n_bands)
+        starts = np.maximum.accumulate(starts - offsets) + offsets
+        if starts[-1] >= len(freqs):
+            raise ValueError(f"Block size {blocksize} is too small for {self.n_bands} bands.")
+        stop = int(np.searchsorted(freqs, self.edges[-1], side='right'))
+        stop = min(max(stop, starts[-1] + 1), len(freqs))
+        self._bin_starts = starts
+        self._bin_stop = stop
+        self._bin_counts = np.diff(np.append(starts, stop))
+
+    def band_energies(self, block: np.ndarray) -> np.ndarray:
+        """Return the mean FFT magnitude for every band of a (frames,) or (frames, channels) block."""
+        mono = block.mean(axis=1) if block.ndim == 2 else block
+        if mono.shape[0] != self._blocksize:
+            self._prepare(mono.shape[0])
+        spectrum = np.abs(np.fft.rfft(mono * self._window))[:self._bin_stop]
+        return np.add.reduceat(spectrum, self._bin_starts) / self._bin_counts
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        """Return band levels in [0, 1] for one audio block."""
+        energies = self.band_energies(block)
+        self._peak = max(self._peak * self.decay, float(energies.max()), 1e-6)
+        return np.clip(energies / self._peak * self.sensitivity, 0.0, 1.0)
+
+
+def assign_bands(n_lights: int, n_bands: int) -> np.ndarray:
+    """Map each light index to a band index.
+
+    Lights are split into contiguous groups so that every band gets at least one
+    light; with more lights than bands, neighbouring lights share a band.
+    """
+    return (np.arange(n_lights) * n_bands) // n_lights
+
+
+def levels_to_light_values(levels: np.ndarray, hues: np.ndarray, light_bands: np.ndarray,
+                           min_luminance: int = 1):
+    """Turn band levels into per-light (rgb, luminance) arrays in one vectorized step."""
+    rgb = hsv_to_rgb(hues[light_bands])
+    luminance = np.clip(np.rint(levels[light_bands] * 100.0), min_luminance, 100).astype(np.int64)
+    return rgb, luminance
@@ -0,0 +1,198 @@
+import argparse
+import asyncio
+import logging
+import json
+import os
+import sys
+from cryptography.fernet import Fernet, InvalidToken
+from startup import StartupGraph, add_light_steps, async_close_login
+from latency_calibration import (CALIBRATION_FILE, SIMULATED_CALIBRATION_FILE, ImpulseTrain, LatencyProbe,
+                                 InjectedSource, PlayedSource, luminance_analysis, spectrum_analysis, run_calibration,
+                                 save_calibration)
+from simulated_lights import make_simulated_lights
+from light_output_filter import LightOutputFilter
+from light_commands import LightCommandBuilder
+from command_executor import CommandExecutor
+from light_scenes import snapshot_scene, release_lights
+from profiler import DEFAULT_OUTPUT, run_profiled
+from command_trace import start_trace
+
+# Setup basic logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+async def calibrate(email: str, password: str, light_names: list, backend: str = "simulated", source: str = "inject",
+                    mode: str = "luminance", impulses: int = 20, period: float = 1.0, burst: float = 0.25, samplerate: float = 44100.0,
+                    blocksize: int = 512, sensitivity: float = 10.0, update_interval: float = 0.1,
+                    luminance_threshold: int = 5, sim_lights: int = 3, sim_latency: float = 0.08,
+                    sim_jitter: float = 0.02, sim_loss: float = 0.0, command_deadline: float = 2.0,
+                    hedge_after: float = None, output: str = None, verbose: bool = False):
+    if verbose:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    if output is None:
+        output = CALIBRATION_FILE if backend == "meross" else SIMULATED_CALIBRATION_FILE
+    elif backend == "simulated" and os.path.abspath(output) == os.path.abspath(CALIBRATION_FILE):
+        # The effects would take the simulated offset for the one of the real bulbs
+        logging.error(f"Refusing to write a simulated calibration to {CALIBRATION_FILE}, it is meant for real lights.")
+        return
+
+    http_client = None
+    if backend == "meross":
+        startup = StartupGraph()
+        add_light_steps(startup, email, password, light_names)
+        try:
+            results = await startup.run()
+            logging.info("MerossManager initialized and devices discovered.")
+            startup.log_report()
+        except Exception as e:
+            logging.error(f"Failed to initialize MerossManager: {e}")
+            await async_close_login(startup)
+            return
+        http_client = results["login"]
+        target_lights = results["light state"]
+    else:
+        target_lights = make_simulated_lights(sim_lights, latency=sim_latency, jitter=sim_jitter, loss=sim_loss, seed=1)
+        logging.info(f"Using {sim_lights} simulated light(s), {sim_latency * 1000:.0f} +- {sim_jitter * 1000:.0f} ms "
+                     f"round-trip, {sim_loss:.0%} loss.")
+
+    if not target_lights:
+        logging.error("No target lights found.")
+        if http_client:
+            await http_client.async_logout()
+        return
+
+    if source == "play":
+        import sounddevice as sd
+        samplerate = sd.query_devices(kind='output')['default_samplerate']
+    analyse = spectrum_analysis(samplerate, sensitivity) if mode == "spectrum" else luminance_analysis(sensitivity)
+    probe = LatencyProbe(period)
+    train = ImpulseTrain(samplerate, period=period, burst=burst)
+    audio = PlayedSource(train, probe, blocksize) if source == "play" else InjectedSource(train, probe, blocksize)
+
+    # The lights end up the way they were, calibration flashes are not meant to stay
+    prior_scene = snapshot_scene(target_lights)
+    output_filter = LightOutputFilter(luminance_threshold=luminance_threshold)
+    for light in target_lights:
+        output_filter.seed(light)
+    executor = CommandExecutor(deadline=command_deadline, hedge_after=hedge_after)
+    commands = LightCommandBuilder(output_filter, executor=executor)
+
+    logging.info(f"Sending {impulses} impulse(s), one every {period}s, {source}ed into the {mode} analysis, "
+                 f"to {[light.name for light in target_lights]}.")
+    try:
+        await run_calibration(target_lights, audio, probe, analyse, commands, impulses, update_interval)
+    except asyncio.CancelledError:
+        logging.info("Calibration stopped.")
+    finally:
+        probe.log_report()
+        report = probe.report()
+        if report["measured"]:
+            settings = {"backend": backend, "source": source, "mode": mode, "lights": [light.name for light in target_lights],
+                        "samplerate": samplerate, "blocksize": blocksize, "update_interval": update_interval}
+            save_calibration(report, settings, output)
+            logging.info(f"Saved the calibration to {output}.")
+        await release_lights(target_lights, prior_scene, executor)
+        executor.log_health()
+        if http_client:
+            await http_client.async_logout()
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure how far the lights trail the sound in the microphone effects.")
+    parser.add_argument("--backend", choices=["simulated", "meross"], default="simulated", help="Calibrate against simulated lights or real Meross lights (default: simulated).")
+    parser.add_argument("--light-names", nargs='+', help="The name(s) of the Meross light(s) to calibrate (default: all lights). Also accepts aliases, group:<name>, tag:<name> and glob patterns.")
+    parser.add_argument("--source", choices=["inject", "play"], default="inject", help="Inject the impulses straight into the analysis, or play them on the speakers and record them with the microphone (default: inject).")
+    parser.add_argument("--mode", choices=["luminance", "spectrum"], default="luminance", help="The analysis of mic_light_control.py to time (default: luminance).")
+    parser.add_argument("--impulses", type=int, default=20, help="Number of impulses to measure (default: 20).")
+    parser.add_argument("--period", type=float, default=1.0, help="Seconds between two impulses (default: 1.0).")
+    parser.add_argument("--burst", type=float, default=0.25, help="Length of every impulse in seconds; keep it above --update-interval or the lights may never see it (default: 0.25).")
+    parser.add_argument("--samplerate", type=float, default=44100.0, help="Sample rate of injected audio (default: 44100).")
+    parser.add_argument("--blocksize", type=int, default=512, help="Audio block size in samples (default: 512).")
+    parser.add_argument("--sensitivity", type=float, default=10.0, help="Sensitivity, as in mic_light_control.py (default: 10).")
+    parser.add_argument("--update-interval", type=float, default=0.1, help="Seconds the control loop waits after every update, as in mic_light_control.py (default: 0.1).")
+    parser.add_argument("--luminance-threshold", type=int, default=5, help="Smallest luminance change that is sent to a light (default: 5).")
+    parser.add_argument("--sim-lights", type=int, default=3, help="Number of simulated lights (default: 3).")
+    parser.add_argument("--sim-latency", type=float, default=0.08, help="Mean round-trip of a simulated light in seconds (default: 0.08).")
+    parser.add_argument("--sim-jitter", type=float, default=0.02, help="Standard deviation of the simulated round-trip in seconds (default: 0.02).")
+    parser.add_argument("--sim-loss", type=float, default=0.0, help="Fraction of commands a simulated light never answers (default: 0).")
+    parser.add_argument("--output", help=f"Where to save the calibration (default: {CALIBRATION_FILE} for --backend meross, {SIMULATED_CALIBRATION_FILE} for simulated lights).")
+    parser.add_argument("--command-deadline", type=float, default=2.0, help="Seconds a light gets to acknowledge a command before it counts as failed (default: 2.0).")
+    parser.add_argument("--hedge-after", type=float, help="Send a second copy of a command that has not been acknowledged after this many seconds.")
+    parser.add_argument("--profile", nargs='?', const=DEFAULT_OUTPUT, metavar="PREFIX", help="Profile the run and write PREFIX.collapsed, PREFIX.svg (flamegraph) and PREFIX-lag.json (event-loop lag); the prefix defaults to meross_profile.")
+    parser.add_argument("--trace", metavar="FILE", help="Record every device command, its acknowledgement and round-trip to FILE (gzipped JSON lines), to replay with replay_trace.py.")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose (DEBUG) logging.")
+    args = parser.parse_args()
+
+    email = password = None
+    if args.backend == "meross":
+        KEY_FILE = "secret.key"
+        CONFIG_FILE = "meross_config.json"
+
+        def load_key():
+            """Load the encryption key from the key file."""
+            try:
+                with open(KEY_FILE, "rb") as key_file:
+                    return key_file.read()
+            except FileNotFoundError:
+                return None
+
+        key = load_key()
+        if not key:
+            print(f"Error: Encryption key '{KEY_FILE}' not found. Please run the GUI app once to generate it.", file=sys.stderr)
+            sys.exit(1)
+
+        try:
+            with open(CONFIG_FILE, 'r') as f:
+                config = json.load(f)
+            email = config.get('email')
+            encrypted_password = config.get('password')
+            if not email or not encrypted_password:
+                print(f"Error: Could not find 'email' or 'password' in {CONFIG_FILE}.", file=sys.stderr)
+                sys.exit(1)
+
+            f = Fernet(key)
+            password = f.decrypt(encrypted_password.encode()).decode()
+
+        except FileNotFoundError:
+            print(f"Error: Configuration file '{CONFIG_FILE}' not found.", file=sys.stderr)
+            sys.exit(1)
+        except json.JSONDecodeError:
+            print(f"Error: Could not decode '{CONFIG_FILE}'. Please ensure it is valid JSON.", file=sys.stderr)
+            sys.exit(1)
+        except InvalidToken:
+            print("Error: Failed to decrypt password. The encryption key may have changed.", file=sys.stderr)
+            sys.exit(1)
+
+    start_trace(args.trace)
+    try:
+        asyncio.run(run_profiled(
+            calibrate(
+                email=email,
+                password=password,
+                light_names=args.light_names,
+                backend=args.backend,
+                source=args.source,
+                mode=args.mode,
+                impulses=args.impulses,
+                period=args.period,
+                burst=args.burst,
+                samplerate=args.samplerate,
+                blocksize=args.blocksize,
+                sensitivity=args.sensitivity,
+                update_interval=args.update_interval,
+                luminance_threshold=args.luminance_threshold,
+                sim_lights=args.sim_lights,
+                sim_latency=args.sim_latency,
+                sim_jitter=args.sim_jitter,
+                sim_loss=args.sim_loss,
+                command_deadline=args.command_deadline,
+                hedge_after=args.hedge_after,
+                output=args.output,
+                verbose=args.verbose
+            ),
+            args.profile
+        ))
+    except KeyboardInterrupt:
+        print("\nScript interrupted by user.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+import asyncio
+import logging
+import time
+from light_history import OK, FAILED, TIMEOUT
+
+# Command execution layer shared by the effect loops.
+#
+# Every device command runs under a deadline, optionally with a hedged second
+# attempt, and behind a per-device circuit breaker. A bulb that keeps failing
+# is skipped for a backoff window instead of holding up every frame of the
+# effect, so the healthy lights keep their timing.
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitBreaker:
+    """Per-device breaker plus the health counters reported for that device."""
+
+    def __init__(self, name: str, failure_threshold: int = 3, backoff: float = 5.0, max_backoff: float = 60.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.base_backoff = backoff
+        self.max_backoff = max_backoff
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.current_backoff = backoff
+        self.open_until = 0.0
+        self._probe_in_flight = False
+        self.successes = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.skipped = 0
+        self.last_error = None
+        self.latency_ewma = None
+
+    def allow(self) -> bool:
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN and time.monotonic() >= self.open_until:
+            # Backoff elapsed, let a single probe through
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        self.skipped += 1
+        return False
+
+    def record_success(self, latency: float):
+        self.successes += 1
+        self.consecutive_failures = 0
+        self._probe_in_flight = False
+        self.latency_ewma = latency if self.latency_ewma is None else 0.8 * self.latency_ewma + 0.2 * latency
+        if self.state != CLOSED:
+            logging.info(f"{self.name} is responding again, resuming commands.")
+            self.state = CLOSED
+            self.current_backoff = self.base_backoff
+
+    def record_failure(self, error: Exception):
+        self.failures += 1
+        self.consecutive_failures += 1
+        self.last_error = repr(error)
+        if isinstance(error, asyncio.TimeoutError):
+            self.timeouts += 1
+        if self.state == HALF_OPEN:
+            # The probe failed, back off for longer
+            self._probe_in_flight = False
+            self.current_backoff = min(self.current_backoff * 2, self.max_backoff)
+            self._trip()
+        elif self.state == CLOSED and self.consecutive_failures >= self.failure_threshold:
+            self._trip()
+
+    def reset(self):
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.current_backoff = self.base_backoff
+        self._probe_in_flight = False
+
+    def _trip(self):
+        self.state = OPEN
+        self.open_until = time.monotonic() + self.current_backoff
+        logging.warning(f"{self.name} failed {self.consecutive_failures} time(s) in a row "
+                        f"({self.last_error}), skipping it for {self.current_backoff:.1f}s.")
+
+    def health(self) -> dict:
+        return {
+            "state": self.state,
+            "successes": self.successes,
+            "failures": self.failures,
+            "timeouts": self.timeouts,
+            "skipped": self.skipped,
+            "consecutive_failures": self.consecutive_failures,
+            "latency_ms": round(self.latency_ewma * 1000) if self.latency_ewma is not None else None,
+            "last_error": self.last_error,
+        }
+
+
+class CommandExecutor:
+    """Runs device commands with deadlines, optional hedging and per-device circuit breakers.
+
+    run() never raises for a failed command: it returns False and the failure is
+    recorded against the device, so one dead bulb cannot stall a gather over a
+    whole group. Commands must be idempotent (all light SET commands are) since
+    a hedged attempt may reach the device twice.
+    """
+
+    def __init__(self, deadline: float = 2.0, hedge_after: float = None, failure_threshold: int = 3,
+                 backoff: float = 5.0, max_backoff: float = 60.0, history=None):
+        self.deadline = deadline
+        self.hedge_after = hedge_after
+        self.failure_threshold = failure_threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedges = 0
+        self.hedge_wins = 0
+        # Optional light_history.HistoryWriter that gets the outcome of every command
+        self.history = history
+        self._breakers = {}
+
+    def breaker(self, light) -> CircuitBreaker:
+        breaker = self._breakers.get(light.uuid)
+        if breaker is None:
+            breaker = CircuitBreaker(light.name, self.failure_threshold, self.backoff, self.max_backoff)
+            self._breakers[light.uuid] = breaker
+        return breaker
+
+    def is_available(self, light) -> bool:
+        return self.breaker(light).state != OPEN
+
+    def reset_breakers(self):
+        """Close every breaker, e.g. once a dropped connection is back and the failures were not the lights' fault."""
+        for breaker in self._breakers.values():
+            breaker.reset()
+
+    async def run(self, light, command_factory, record: bool = True, changes_only: bool = False) -> bool:
+        """Run command_factory() against one light. Returns True when the command succeeded.
+
+        record=False keeps the command out of the history; changes_only=True only records it when the
+        light's state changed (see HistoryWriter.record), e.g. for effect frames.
+        """
+        breaker = self.breaker(light)
+        if not breaker.allow():
+            return False
+        start = time.monotonic()
+        try:
+            await self._attempt(command_factory)
+        except asyncio.CancelledError:
+            breaker._probe_in_flight = False
+            raise
+        except Exception as e:
+            logging.debug("Command to %s failed: %r", light.name, e)
+            breaker.record_failure(e)
+            if self.history is not None and record:
+                self.history.record(light, TIMEOUT if isinstance(e, asyncio.TimeoutError) else FAILED,
+                                    changes_only=changes_only)
+            return False
+        latency = time.monotonic() - start
+        breaker.record_success(latency)
+        if self.history is not None and record:
+            self.history.record(light, OK, latency, changes_only=changes_only)
+        return True
+
+    async def run_all(self, lights: list, command_factory) -> dict:
+        """Run command_factory(light) for every light concurrently. Returns {uuid: success}."""
+        results = await asyncio.gather(*(self.run(light, lambda light=light: command_factory(light)) for light in lights))
+        return {light.uuid: ok for light, ok in zip(lights, results)}
+
+    async def _attempt(self, command_factory):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.deadline
+        tasks = {asyncio.ensure_future(command_factory())}
+        primary = next(iter(tasks))
+        hedge_at = loop.time() + self.hedge_after if self.hedge_after is not None else None
+        last_error = None
+        try:
+            while True:
+                if not tasks:
+                    if hedge_at is None or loop.time() >= deadline:
+                        raise last_error
+                    # The first attempt failed fast, use the hedge as an immediate retry
+                    hedge_at = loop.time()
+                if hedge_at is not None and loop.time() >= hedge_at:
+                    # The first attempt is slow: race a second one against it
+                    hedge_at = None
+                    self.hedges += 1
+                    tasks.add(asyncio.ensure_future(command_factory()))
+                now = loop.time()
+                if now >= deadline:
+                    raise asyncio.TimeoutError(f"No response within {self.deadline}s")
+                wake_at = deadline if hedge_at is None else min(deadline, hedge_at)
+                done, tasks = await asyncio.wait(tasks, timeout=wake_at - now, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self.hedge_wins += 1
+                        return task.result()
+                    last_error = task.exception()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def health(self) -> dict:
+        return {uuid: breaker.health() for uuid, breaker in self._breakers.items()}
+
+    def log_health(self):
+        for breaker in self._breakers.values():
+            health = breaker.health()
+            logging.info(f"Health {breaker.name}: {health['state']}, {health['successes']} ok, "
+                         f"{health['failures']} failed ({health['timeouts']} timeouts), {health['skipped']} skipped, "
+                         f"latency {health['latency_ms']} ms")
+        if self.hedges:
+            logging.info(f"Hedged retries: {self.hedges} sent, {self.hedge_wins} won.")
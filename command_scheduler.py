@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+from command_executor import CommandExecutor
+
+# Per-device command scheduling with priority lanes.
+#
+# Every device gets its own worker that sends one command at a time. Pending
+# commands wait in lanes ordered by priority, so a button press only ever waits
+# for the command already in flight, never behind a backlog of effect frames.
+# Effect frames are superseded rather than queued: a device only keeps the
+# newest one, and a higher priority command for the device discards it.
+
+INTERACTIVE = 0
+SCENE = 1
+EFFECT = 2
+
+LANE_NAMES = {INTERACTIVE: "interactive", SCENE: "scene", EFFECT: "effect"}
+
+# What submit() resolves to for an effect frame that was discarded unsent; falsy like a failure,
+# but the light did not fail
+SUPERSEDED = None
+
+
+class _Command:
+    __slots__ = ("factory", "future", "submitted_at")
+
+    def __init__(self, factory, future):
+        self.factory = factory
+        self.future = future
+        self.submitted_at = time.monotonic()
+
+
+class _DeviceQueue:
+    def __init__(self):
+        self.lanes = {INTERACTIVE: deque(), SCENE: deque()}
+        self.effect_frame = None
+        self.wakeup = asyncio.Event()
+        self.worker = None
+
+    def pop(self):
+        for priority in (INTERACTIVE, SCENE):
+            if self.lanes[priority]:
+                return priority, self.lanes[priority].popleft()
+        if self.effect_frame is not None:
+            command, self.effect_frame = self.effect_frame, None
+            return EFFECT, command
+        return None, None
+
+
+class DeviceCommandScheduler:
+    """Queues commands per device and sends them highest priority first.
+
+    submit() returns a future resolving to True when the command succeeded,
+    False when it failed and SUPERSEDED when it was superseded. Commands go
+    through the CommandExecutor, so they keep its deadlines and circuit
+    breakers. Must be used from the event loop thread.
+    """
+
+    def __init__(self, executor: CommandExecutor = None, history: int = 500):
+        self.executor = executor or CommandExecutor()
+        self._queues = {}
+        self.superseded = 0
+        # Seconds from submit() to completion, per lane
+        self.latencies = {lane: deque(maxlen=history) for lane in LANE_NAMES}
+
+    def submit(self, light, command_factory, priority: int = INTERACTIVE) -> asyncio.Future:
+        queue = self._queues.get(light.uuid)
+        if queue is None:
+            queue = _DeviceQueue()
+            self._queues[light.uuid] = queue
+        if queue.worker is None or queue.worker.done():
+            queue.worker = asyncio.ensure_future(self._run_device(light, queue))
+
+        command = _Command(command_factory, asyncio.get_running_loop().create_future())
+        if priority == EFFECT:
+            if queue.lanes[INTERACTIVE] or queue.lanes[SCENE]:
+                # Anything the user or a scene asked for wins over effect frames
+                self._supersede(command)
+            else:
+                if queue.effect_frame is not None:
+                    self._supersede(queue.effect_frame)
+                queue.effect_frame = command
+        else:
+            if queue.effect_frame is not None:
+                self._supersede(queue.effect_frame)
+                queue.effect_frame = None
+            queue.lanes[priority].append(command)
+        queue.wakeup.set()
+        return command.future
+
+    def cancel_effect_frames(self, lights: list = None):
+        """Discard pending effect frames, for the given lights or for all of them."""
+        uuids = None if lights is None else {light.uuid for light in lights}
+        for uuid, queue in self._queues.items():
+            if (uuids is None or uuid in uuids) and queue.effect_frame is not None:
+                self._supersede(queue.effect_frame)
+                queue.effect_frame = None
+
+    def _supersede(self, command: _Command):
+        self.superseded += 1
+        if not command.future.done():
+            command.future.set_result(SUPERSEDED)
+
+    async def _run_device(self, light, queue: _DeviceQueue):
+        while True:
+            priority, command = queue.pop()
+            if command is None:
+                queue.wakeup.clear()
+                await queue.wakeup.wait()
+                continue
+            if command.future.done():
+                continue
+            # Effect frames are too many to keep every one in the light history, only their state changes
+            ok = await self.executor.run(light, command.factory, changes_only=priority == EFFECT)
+            self.latencies[priority].append(time.monotonic() - command.submitted_at)
+            if not command.future.done():
+                command.future.set_result(ok)
+
+    def latency_report(self) -> dict:
+        report = {}
+        for lane, values in self.latencies.items():
+            if not values:
+                continue
+            ordered = sorted(values)
+            report[LANE_NAMES[lane]] = {
+                "count": len(ordered),
+                "p50_ms": round(ordered[len(ordered) // 2] * 1000),
+                "p95_ms": round(ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))] * 1000),
+            }
+        return report
+
+    def log_report(self):
+        for lane, stats in self.latency_report().items():
+            logging.info(f"Scheduler {lane} lane: {stats['count']} command(s), "
+                         f"p50 {stats['p50_ms']} ms, p95 {stats['p95_ms']} ms.")
+        if self.superseded:
+            logging.info(f"Scheduler discarded {self.superseded} superseded effect frame(s).")
+
+    async def close(self):
+        self.cancel_effect_frames()
+        for queue in self._queues.values():
+            if queue.worker is not None:
+                queue.worker.cancel()
+        await asyncio.gather(*(q.worker for q in self._queues.values() if q.worker is not None),
+                             return_exceptions=True)
@@ -0,0 +1,318 @@
+import asyncio
+import atexit
+import gzip
+import hashlib
+import json
+import logging
+import queue
+import threading
+import time
+
+# Command traces: record every device command of a run, replay it locally.
+#
+# With a trace installed (the --trace option of the scripts), every light that
+# discovery hands out is wrapped so its commands are written to a gzipped JSON
+# lines file: when the command was sent, to which light, what it asked for,
+# how long the acknowledgement took and whether it came at all. Hooking the
+# lights themselves catches every path to a device: effects, scenes, the GUI
+# buttons, retries and hedged copies of the executor alike.
+#
+#     {"version": 1, "started": 1792390307.4}
+#     ["light", 0, "uuid", "Desk", true, true, [true, [255, 0, 0], 80]]
+#     ["cmd", 12.3456, 0, "color", {"rgb": [255, 40, 0]}, 0.0487, "ok"]
+#
+# Command times are seconds since the trace started; the outcome is ok,
+# timeout, error or cancelled (the caller gave up, e.g. a deadline or a won
+# hedge). replay() sends the same commands at the same times to simulated
+# lights that answer after the recorded round-trip and stay silent where the
+# real light did, either in real time or on a virtual clock that skips the
+# waits, which makes a replay deterministic and as fast as the machine goes.
+
+TRACE_VERSION = 1
+# Events are handed to the writer thread in chunks of this size
+CHUNK = 512
+
+_recorder = None
+
+
+class TraceRecorder:
+    """Wraps the command methods of lights and writes what they send, from a writer thread."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.start = time.monotonic()
+        self.commands = 0
+        self._lights = {}
+        self._events = []
+        self._queue = queue.Queue()
+        self._file = gzip.open(path, 'wt', encoding='utf-8')
+        self._file.write(json.dumps({"version": TRACE_VERSION, "started": time.time()}) + "\n")
+        self._thread = threading.Thread(target=self._write_loop, name="command-trace", daemon=True)
+        self._thread.start()
+        self._closed = False
+
+    def attach(self, lights: list) -> list:
+        """Record the commands of these lights from now on. Returns the lights."""
+        for light in lights:
+            if light.uuid in self._lights:
+                continue
+            index = len(self._lights)
+            self._lights[light.uuid] = index
+            self._emit(["light", index, light.uuid, light.name, light.get_supports_rgb(),
+                        light.get_supports_luminance(), _state(light)])
+            self._wrap(light, index)
+        return lights
+
+    def _wrap(self, light, index: int):
+        def traced(method, op, fields_of):
+            async def wrapper(*args, **kwargs):
+                sent = time.monotonic()
+                outcome = "ok"
+                try:
+                    return await method(*args, **kwargs)
+                except asyncio.TimeoutError:
+                    outcome = "timeout"
+                    raise
+                except asyncio.CancelledError:
+                    outcome = "cancelled"
+                    raise
+                except Exception:
+                    outcome = "error"
+                    raise
+                finally:
+                    self._record(sent, index, op, fields_of(*args, **kwargs), outcome)
+            return wrapper
+
+        light.async_turn_on = traced(light.async_turn_on, "on", lambda *a, **k: {})
+        light.async_turn_off = traced(light.async_turn_off, "off", lambda *a, **k: {})
+        light.async_set_light_color = traced(light.async_set_light_color, "color", _color_fields)
+        light.async_update = traced(light.async_update, "update", lambda *a, **k: {})
+        execute_command = getattr(light, "_execute_command", None)
+        if execute_command is not None:
+            # The methods above end up in _execute_command too; only the combined messages of
+            # light_commands.async_send_light_state() reach it directly
+            multiple = traced(execute_command, "color", _multiple_fields)
+
+            async def execute(*args, **kwargs):
+                if kwargs.get("namespace") == "Appliance.Control.Multiple":
+                    return await multiple(*args, **kwargs)
+                return await execute_command(*args, **kwargs)
+            light._execute_command = execute
+
+    def _record(self, sent: float, index: int, op: str, fields: dict, outcome: str):
+        now = time.monotonic()
+        self.commands += 1
+        self._emit(["cmd", round(sent - self.start, 4), index, op, fields, round(now - sent, 4), outcome])
+
+    def _emit(self, event: list):
+        self._events.append(event)
+        if len(self._events) >= CHUNK:
+            self._queue.put(self._events)
+            self._events = []
+
+    def _write_loop(self):
+        while True:
+            chunk = self._queue.get()
+            if chunk is None:
+                break
+            self._file.write("".join(json.dumps(event, separators=(",", ":")) + "\n" for event in chunk))
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(self._events)
+        self._events = []
+        self._queue.put(None)
+        self._thread.join()
+        self._file.close()
+        logging.info(f"Trace: {self.commands} command(s) of {len(self._lights)} light(s) written to {self.path}.")
+
+
+def _state(light) -> list:
+    try:
+        rgb = list(light.get_rgb_color()) if light.get_supports_rgb() and light.get_rgb_color() is not None else None
+        luminance = light.get_luminance() if light.get_supports_luminance() else None
+        return [bool(light.get_light_is_on()), rgb, luminance]
+    except Exception:
+        return [None, None, None]
+
+
+def _color_fields(channel: int = 0, onoff: bool = None, rgb: tuple = None, luminance: int = None, *args, **kwargs) -> dict:
+    fields = {"onoff": onoff, "rgb": list(rgb) if rgb is not None else None, "luminance": luminance}
+    return {key: value for key, value in fields.items() if value is not None}
+
+
+def _multiple_fields(*args, payload: dict = None, **kwargs) -> dict:
+    # Decode the toggle and light parts of an Appliance.Control.Multiple message
+    fields = {}
+    for message in (payload or {}).get("multiple", []):
+        body = message.get("payload", {})
+        toggle = body.get("togglex") or body.get("toggle")
+        if toggle is not None:
+            fields["onoff"] = bool(toggle.get("onoff"))
+        light = body.get("light")
+        if light is not None:
+            if "rgb" in light:
+                value = light["rgb"]
+                fields["rgb"] = [(value >> 16) & 0xFF, (value >> 8) & 0xFF, value & 0xFF]
+            if "luminance" in light:
+                fields["luminance"] = light["luminance"]
+    return fields
+
+
+def start_trace(path: str = None):
+    """Record the commands of every light discovered from now on to path; no-op without a path.
+
+    The trace is written out when the process exits.
+    """
+    global _recorder
+    if path is None or _recorder is not None:
+        return _recorder
+    _recorder = TraceRecorder(path)
+    atexit.register(_recorder.close)
+    logging.info(f"Recording a command trace to {path}.")
+    return _recorder
+
+
+def attach_trace(lights: list) -> list:
+    """Hook lights into the running trace, if there is one. Returns the lights."""
+    if _recorder is not None:
+        _recorder.attach(lights)
+    return lights
+
+
+def load_trace(path: str):
+    """Return (header, {index: light info}, commands sorted by send time)."""
+    lights = {}
+    commands = []
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        header = json.loads(f.readline())
+        if header.get("version") != TRACE_VERSION:
+            raise ValueError(f"Unsupported trace version: {header.get('version')}")
+        for line in f:
+            event = json.loads(line)
+            if event[0] == "light":
+                _, index, uuid, name, supports_rgb, supports_luminance, state = event
+                lights[index] = {"uuid": uuid, "name": name, "supports_rgb": supports_rgb,
+                                 "supports_luminance": supports_luminance, "state": state}
+            elif event[0] == "cmd":
+                commands.append(event[1:])
+    commands.sort(key=lambda command: command[0])
+    return header, lights, commands
+
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    """An event loop whose clock jumps to the next timer whenever nothing else is ready to run.
+
+    Only suitable for code that waits on timers alone, such as a replay
+    against simulated lights: a wait for I/O would be skipped over.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._virtual_time = 0.0
+
+    def time(self) -> float:
+        return self._virtual_time
+
+    def _run_once(self):
+        if not self._ready and self._scheduled:
+            self._virtual_time = max(self._virtual_time, self._scheduled[0]._when)
+        super()._run_once()
+
+
+class ReplayError(Exception):
+    """Stands in for a command that failed with an error during the recording."""
+
+
+def _percentile(values: list, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else 0.0
+
+
+async def replay(lights_info: dict, commands: list, speed: float = 1.0) -> dict:
+    """Send the traced commands to simulated lights at their recorded times (divided by speed). Returns a report."""
+    from simulated_lights import SimulatedLight
+
+    lights = {}
+    for index, info in lights_info.items():
+        light = SimulatedLight(info["name"], uuid=info["uuid"], supports_rgb=info["supports_rgb"],
+                               supports_luminance=info["supports_luminance"])
+        onoff, rgb, luminance = info["state"]
+        light._apply(onoff=onoff, rgb=rgb, luminance=luminance)
+        lights[index] = light
+
+    loop = asyncio.get_running_loop()
+    lags = []
+    round_trips = []
+    outcomes = {}
+
+    async def send(light, op: str, fields: dict, rtt: float, outcome: str):
+        rtt = rtt / speed
+        try:
+            if outcome == "error":
+                await asyncio.sleep(rtt)
+                raise ReplayError(f"{light.name} failed during the recording")
+            if op == "on":
+                fields = {"onoff": True}
+            elif op == "off":
+                fields = {"onoff": False}
+            elif op == "color" and "onoff" not in fields:
+                fields = dict(fields, onoff=True)
+            if outcome == "cancelled":
+                # The light still got the command (a hedge that lost the race, or a deadline cancel), the
+                # caller only stopped waiting for it at the recorded time: applied halfway, given up at the end
+                await light._command(rtt=rtt, lost=False, **fields)
+                result = "cancelled"
+            else:
+                # A command the light did not answer is lost, and given up on after the recorded time
+                await light._command(timeout=rtt, rtt=rtt, lost=outcome == "timeout", **fields)
+                result = "ok"
+        except asyncio.TimeoutError:
+            result = "timeout"
+        except ReplayError:
+            result = "error"
+        outcomes[result] = outcomes.get(result, 0) + 1
+
+    start = loop.time()
+    tasks = []
+    replay_start = time.perf_counter()
+    for sent, index, op, fields, rtt, outcome in commands:
+        due = start + sent / speed
+        delay = due - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        lags.append(loop.time() - due)
+        round_trips.append(rtt / speed)
+        tasks.append(asyncio.ensure_future(send(lights[index], op, fields, rtt, outcome)))
+    await asyncio.gather(*tasks)
+
+    final = {light.uuid: [light.get_light_is_on(), list(light.get_rgb_color()), light.get_luminance()]
+             for light in lights.values()}
+    return {
+        "commands": len(commands),
+        "lights": len(lights),
+        "outcomes": outcomes,
+        "trace_seconds": round(commands[-1][0] if commands else 0.0, 3),
+        "replay_seconds": round(loop.time() - start, 3),
+        "wall_seconds": round(time.perf_counter() - replay_start, 3),
+        "issue_lag_ms": {"p50": round(_percentile(lags, 0.5) * 1000, 2), "p99": round(_percentile(lags, 0.99) * 1000, 2),
+                         "max": round(max(lags, default=0.0) * 1000, 2)},
+        "round_trip_ms": {"p50": round(_percentile(round_trips, 0.5) * 1000, 1),
+                          "p99": round(_percentile(round_trips, 0.99) * 1000, 1)},
+        # Equal digests mean two replays left every light in the same state
+        "state_digest": hashlib.sha1(json.dumps(final, sort_keys=True).encode()).hexdigest()[:12],
+    }
+
+
+def run_replay(path: str, speed: float = 1.0, fast: bool = False) -> dict:
+    """Load a trace and replay it, on a virtual clock when fast is set."""
+    _, lights_info, commands = load_trace(path)
+    if fast:
+        loop = VirtualClockLoop()
+        try:
+            return loop.run_until_complete(replay(lights_info, commands, speed))
+        finally:
+            loop.close()
+    return asyncio.run(replay(lights_info, commands, speed))
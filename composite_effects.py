@@ -0,0 +1,215 @@
+import argparse
+import asyncio
+import logging
+import json
+import sys
+import time
+from cryptography.fernet import Fernet, InvalidToken
+from startup import StartupGraph, add_light_steps, async_close_login
+from effect_compositor import (EffectCompositor, Layer, NORMAL, MULTIPLY, color_cycle_source, level_source,
+                               beat_flash_source)
+from audio_capture_process import AudioCaptureProcess
+from light_layout import brightness_to_luminance
+from light_output_filter import LightOutputFilter
+from light_commands import LightCommandBuilder
+from command_executor import CommandExecutor
+from light_scenes import snapshot_scene, release_lights
+from hot_path_log import HotPathLog
+from latency_calibration import load_latency_offset
+from profiler import DEFAULT_OUTPUT, run_profiled
+from command_trace import start_trace
+
+# Setup basic logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+async def run_composite(email: str, password: str, light_names: list, cycle_period: float = 10.0,
+                        mic: bool = False, sensitivity: float = 10.0, bpm: float = None,
+                        update_interval: float = 0.1, min_luminance: int = 1,
+                        luminance_threshold: int = 5, color_threshold: int = 16,
+                        command_deadline: float = 2.0, hedge_after: float = None, restore_scene: bool = False,
+                        lead_time: float = 0.0, verbose: bool = False):
+    if verbose:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    def start_mic_capture():
+        capture = AudioCaptureProcess("luminance", 1, sensitivity=sensitivity)
+        capture.start()
+        return capture
+
+    # Login, MQTT connection, discovery and the light state fetch run as a dependency graph,
+    # and the microphone capture process is spawned alongside
+    startup = StartupGraph()
+    add_light_steps(startup, email, password, light_names)
+    if mic:
+        startup.step("audio capture", start_mic_capture, blocking=True)
+    try:
+        results = await startup.run()
+        logging.info("MerossManager initialized and devices discovered.")
+        startup.log_report()
+    except Exception as e:
+        logging.error(f"Failed to initialize MerossManager: {e}")
+        if "audio capture" in startup.results:
+            startup.results["audio capture"].stop()
+        await async_close_login(startup)
+        return
+    http_client = results["login"]
+    target_lights = results["light state"]
+    capture = results.get("audio capture")
+
+    if not target_lights:
+        logging.error("No target lights found.")
+        if capture is not None:
+            capture.stop()
+        await http_client.async_logout()
+        return
+
+    # Bottom to top: color cycle, microphone brightness, beat flash
+    compositor = EffectCompositor(len(target_lights))
+    compositor.add_layer(Layer("cycle", color_cycle_source(cycle_period), blend=NORMAL, priority=0))
+    if capture is not None:
+        def mic_level():
+            features = capture.poll()
+            # Same scale as mic_light_control.py: volume * sensitivity is a luminance in 0-100
+            return None if features is None else features[0] * sensitivity / 100.0
+
+        compositor.add_layer(Layer("mic", level_source(mic_level), blend=MULTIPLY, priority=10))
+    if bpm:
+        compositor.add_layer(Layer("beat", beat_flash_source(bpm), blend=NORMAL, priority=20))
+
+    logging.info(f"Compositing effects on {[light.name for light in target_lights]}. Press Ctrl+C to stop.")
+
+    prior_scene = snapshot_scene(target_lights) if restore_scene else None
+
+    output_filter = LightOutputFilter(luminance_threshold=luminance_threshold, color_threshold=color_threshold)
+    for light in target_lights:
+        output_filter.seed(light)
+    executor = CommandExecutor(deadline=command_deadline, hedge_after=hedge_after)
+    commands = LightCommandBuilder(output_filter, executor=executor)
+    hot_log = HotPathLog("composite")
+    hot_log.track_commands(commands)
+
+    if lead_time:
+        logging.info(f"Rendering frames {lead_time * 1000:.0f} ms ahead to make up for the light latency.")
+    start = time.monotonic()
+    try:
+        while True:
+            # All layers merge into one frame, so every light gets at most one message per tick.
+            # Rendering ahead by the calibrated latency lets the timed layers land on time.
+            rgb_values, brightness = compositor.compose(time.monotonic() - start + lead_time)
+            luminances = brightness_to_luminance(brightness, min_luminance)
+            for light, rgb, luminance in zip(target_lights, rgb_values.tolist(), luminances.tolist()):
+                commands.set(light, onoff=True, rgb=rgb, luminance=luminance)
+            await commands.flush()
+            hot_log.update()
+            startup.mark("first light command")
+            await asyncio.sleep(update_interval)
+
+    except asyncio.CancelledError:
+        logging.info("Composite effect stopped.")
+    finally:
+        hot_log.log_summary()
+        if capture is not None:
+            logging.info(f"Capture stats: {capture.stats()}")
+            capture.stop()
+        compositor.log_summary()
+        output_filter.log_summary()
+        commands.log_summary()
+        await release_lights(target_lights, prior_scene, executor)
+        executor.log_health()
+        await http_client.async_logout()
+
+def main():
+    parser = argparse.ArgumentParser(description="Layer a color cycle, microphone brightness and a beat flash on Meross smart lights.")
+    parser.add_argument("--light-names", nargs='+', help="The name(s) of the light(s) to use (default: all lights). Also accepts aliases, group:<name>, tag:<name> and glob patterns.")
+    parser.add_argument("--cycle-period", type=float, default=10.0, help="Seconds for the base color cycle to go around the color wheel once (default: 10).")
+    parser.add_argument("--mic", action="store_true", help="Drive the brightness from the microphone volume.")
+    parser.add_argument("--sensitivity", type=float, default=10.0, help="The sensitivity of the microphone (default: 10.0).")
+    parser.add_argument("--bpm", type=float, help="Flash the lights white on every beat at this tempo.")
+    parser.add_argument("--update-interval", type=float, default=0.1, help="Seconds between composited frames (default: 0.1).")
+    parser.add_argument("--min-luminance", type=int, default=1, help="Lowest luminance the effects use (default: 1).")
+    parser.add_argument("--luminance-threshold", type=int, default=5, help="Smallest luminance change that is sent to a light (default: 5).")
+    parser.add_argument("--color-threshold", type=int, default=16, help="Smallest change of a color channel that is sent to a light (default: 16).")
+    parser.add_argument("--command-deadline", type=float, default=2.0, help="Seconds a light gets to acknowledge a command before it counts as failed (default: 2.0).")
+    parser.add_argument("--hedge-after", type=float, help="Send a second copy of a command that has not been acknowledged after this many seconds.")
+    parser.add_argument("--restore-scene", action="store_true", help="When stopping, put the lights back the way they were instead of turning them off.")
+    parser.add_argument("--latency-file", help="Calibration file written by calibrate_latency.py; the color cycle and beat flash are rendered ahead by its send-path latency.")
+    parser.add_argument("--profile", nargs='?', const=DEFAULT_OUTPUT, metavar="PREFIX", help="Profile the run and write PREFIX.collapsed, PREFIX.svg (flamegraph) and PREFIX-lag.json (event-loop lag); the prefix defaults to meross_profile.")
+    parser.add_argument("--trace", metavar="FILE", help="Record every device command, its acknowledgement and round-trip to FILE (gzipped JSON lines), to replay with replay_trace.py.")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose (DEBUG) logging.")
+    args = parser.parse_args()
+
+    lead_time = 0.0
+    if args.latency_file:
+        try:
+            # The timed layers skip the microphone, only the send path applies to them
+            lead_time = load_latency_offset(args.latency_file, send_path_only=True)
+        except (FileNotFoundError, json.JSONDecodeError, ValueError) as e:
+            print(f"Error: Could not load latency file '{args.latency_file}': {e}", file=sys.stderr)
+            sys.exit(1)
+
+    KEY_FILE = "secret.key"
+    CONFIG_FILE = "meross_config.json"
+
+    def load_key():
+        """Load the encryption key from the key file."""
+        try:
+            with open(KEY_FILE, "rb") as key_file:
+                return key_file.read()
+        except FileNotFoundError:
+            return None
+
+    key = load_key()
+    if not key:
+        print(f"Error: Encryption key '{KEY_FILE}' not found. Please run the GUI app once to generate it.", file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        with open(CONFIG_FILE, 'r') as f:
+            config = json.load(f)
+        email = config.get('email')
+        encrypted_password = config.get('password')
+        if not email or not encrypted_password:
+            print(f"Error: Could not find 'email' or 'password' in {CONFIG_FILE}.", file=sys.stderr)
+            sys.exit(1)
+        
+        f = Fernet(key)
+        password = f.decrypt(encrypted_password.encode()).decode()
+
+    except FileNotFoundError:
+        print(f"Error: Configuration file '{CONFIG_FILE}' not found.", file=sys.stderr)
+        sys.exit(1)
+    except json.JSONDecodeError:
+        print(f"Error: Could not decode '{CONFIG_FILE}'. Please ensure it is valid JSON.", file=sys.stderr)
+        sys.exit(1)
+    except InvalidToken:
+        print("Error: Failed to decrypt password. The encryption key may have changed.", file=sys.stderr)
+        sys.exit(1)
+
+    start_trace(args.trace)
+    try:
+        asyncio.run(run_profiled(
+            run_composite(
+                email=email,
+                password=password,
+                light_names=args.light_names,
+                cycle_period=args.cycle_period,
+                mic=args.mic,
+                sensitivity=args.sensitivity,
+                bpm=args.bpm,
+                update_interval=args.update_interval,
+                min_luminance=args.min_luminance,
+                luminance_threshold=args.luminance_threshold,
+                color_threshold=args.color_threshold,
+                command_deadline=args.command_deadline,
+                hedge_after=args.hedge_after,
+                restore_scene=args.restore_scene,
+                lead_time=lead_time,
+                verbose=args.verbose
+            ),
+            args.profile
+        ))
+    except KeyboardInterrupt:
+        print("\nScript interrupted by user.")
+
+if __name__ == "__main__":
+    main()
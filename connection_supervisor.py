@@ -0,0 +1,239 @@
+import asyncio
+import json
+import logging
+import time
+
+# Keeps the cloud session of a running effect alive.
+#
+# When the MQTT connection drops, every command fails at once and the circuit
+# breakers of the executor back off, so the lights stay dark long after the
+# connection is back. The ConnectionSupervisor watches the manager's MQTT
+# clients, pauses the effect while they are down (effects await
+# wait_connected() once per beat or step) and resumes it on the beat grid once
+# the clients are connected and subscribed again. paho reconnects and the
+# manager re-subscribes by themselves; when that has not happened within
+# relogin_after seconds, say because the session expired, the supervisor logs
+# in again, discovers the same lights on a new manager and moves the light
+# handles the effect holds over to it, with a doubling backoff between tries.
+#
+# Every drop, reconnect and re-login is counted; stats() returns the counters
+# and the reconnect times and downtime, and with a metrics_file they are also
+# written there as JSON whenever the connection changes state.
+
+CONNECTED = "connected"
+RECONNECTING = "reconnecting"
+
+
+def mqtt_connected(manager) -> bool:
+    """Tell if every MQTT client of the manager is connected and subscribed to its topics."""
+    # Set by the manager once its subscription went through, cleared on a disconnect
+    events = getattr(manager, "_mqtt_connected_and_subscribed", {})
+    clients = getattr(manager, "_mqtt_clients", {})
+    return bool(events) and all(event.is_set() for event in events.values()) and \
+        all(client.is_connected() for client in clients.values())
+
+
+async def async_new_session(email: str, password: str, uuids: list):
+    """Log in again and discover the given lights. Returns (http_client, manager, lights)."""
+    from meross_iot.http_api import MerossHttpClient
+    from meross_iot.manager import MerossManager
+    from light_discovery import async_discover_lights
+
+    http_client = await MerossHttpClient.async_from_user_password(email=email, password=password,
+                                                                  api_base_url="https://iot.meross.com")
+    try:
+        manager = MerossManager(http_client=http_client)
+        await manager.async_init()
+        # Selecting by uuid needs no registry, and a broken registry file must not keep the session from coming back
+        lights = await async_discover_lights(manager, http_client, uuids=uuids, registry_config={})
+    except Exception:
+        await http_client.async_logout()
+        raise
+    return http_client, manager, lights
+
+
+class ConnectionSupervisor:
+    """Detects connection drops, gets the session back and pauses the effect in the meantime."""
+
+    def __init__(self, manager, http_client, email: str, password: str, lights: list, check_interval: float = 0.5,
+                 relogin_after: float = 30.0, backoff: float = 2.0, max_backoff: float = 60.0,
+                 metrics_file: str = None, is_connected=mqtt_connected, new_session=async_new_session):
+        self.manager = manager
+        self.http_client = http_client
+        self.email = email
+        self.password = password
+        self.lights = lights
+        self.check_interval = check_interval
+        self.relogin_after = relogin_after
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.metrics_file = metrics_file
+        self._is_connected = is_connected
+        self._new_session = new_session
+        self._callbacks = []
+        self._connected = asyncio.Event()
+        self._connected.set()
+        self._task = None
+        self.state = CONNECTED
+        self.drops = 0
+        self.reconnects = 0
+        self.relogins = 0
+        self.relogin_failures = 0
+        self.pauses = 0
+        self.downtime = 0.0
+        self.reconnect_times = []
+        self._down_since = None
+        self._start = time.monotonic()
+
+    @property
+    def connected(self) -> bool:
+        return self._connected.is_set()
+
+    def on_reconnect(self, callback):
+        """Call callback() every time the connection is back, e.g. to reset breakers and resend full state."""
+        self._callbacks.append(callback)
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def wait_connected(self, period: float = None, origin: float = None) -> bool:
+        """Return at once while connected. After a drop, wait for the connection and then for the next
+        multiple of period after origin (event loop time), so the effect resumes on its beat. Returns True
+        when the effect was paused."""
+        if self._connected.is_set():
+            return False
+        self.pauses += 1
+        await self._connected.wait()
+        if period:
+            loop = asyncio.get_running_loop()
+            now = loop.time()
+            origin = now if origin is None else origin
+            await asyncio.sleep(period - (now - origin) % period)
+        return True
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            if self._is_connected(self.manager):
+                continue
+            self._dropped()
+            await self._recover()
+            self._restored()
+
+    def _dropped(self):
+        self.drops += 1
+        self.state = RECONNECTING
+        self._down_since = time.monotonic()
+        self._connected.clear()
+        logging.warning("Connection to the Meross cloud lost, pausing the effect until it is back.")
+        self._export()
+
+    async def _recover(self):
+        # First give paho the chance to reconnect by itself, then log in again until it works
+        deadline = self._down_since + self.relogin_after
+        while time.monotonic() < deadline:
+            await asyncio.sleep(self.check_interval)
+            if self._is_connected(self.manager):
+                return
+        backoff = self.backoff
+        while True:
+            if self._is_connected(self.manager):
+                return
+            try:
+                await self._relogin()
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.relogin_failures += 1
+                logging.warning(f"Logging in again failed ({e!r}), retrying in {backoff:.1f}s.")
+                self._export()
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+
+    async def _relogin(self):
+        logging.info("The connection did not come back by itself, logging in again.")
+        http_client, manager, fresh = await self._new_session(self.email, self.password,
+                                                              [light.uuid for light in self.lights])
+        fresh = {light.uuid: light for light in fresh}
+        for light in self.lights:
+            new = fresh.get(light.uuid)
+            if new is None:
+                logging.warning(f"{light.name} was not found again after logging in, it may be offline.")
+                continue
+            # The effect holds the old handles: point them at the new manager and let it route to them
+            registry = getattr(manager, "_device_registry", None)
+            if registry is not None and new is not light:
+                registry.relinquish_device(new.internal_id)
+                registry.enroll_device(light)
+            light._manager = manager
+        old_manager, old_http_client = self.manager, self.http_client
+        self.manager, self.http_client = manager, http_client
+        self.relogins += 1
+        try:
+            old_manager.close()
+            await old_http_client.async_logout()
+        except Exception as e:
+            logging.debug(f"Closing the old session failed: {e!r}")
+
+    def _restored(self):
+        downtime = time.monotonic() - self._down_since
+        self.downtime += downtime
+        self.reconnects += 1
+        self.reconnect_times.append(downtime)
+        del self.reconnect_times[:-100]
+        self._down_since = None
+        self.state = CONNECTED
+        for callback in self._callbacks:
+            callback()
+        self._connected.set()
+        logging.info(f"Connection to the Meross cloud is back after {downtime:.1f}s, resuming the effect.")
+        self._export()
+
+    def stats(self) -> dict:
+        elapsed = time.monotonic() - self._start
+        downtime = self.downtime + (time.monotonic() - self._down_since if self._down_since is not None else 0.0)
+        times = sorted(self.reconnect_times)
+        return {
+            "state": self.state,
+            "drops": self.drops,
+            "reconnects": self.reconnects,
+            "relogins": self.relogins,
+            "relogin_failures": self.relogin_failures,
+            "effect_pauses": self.pauses,
+            "downtime_s": round(downtime, 1),
+            "uptime_ratio": round(1.0 - downtime / elapsed, 4) if elapsed > 0 else 1.0,
+            "reconnect_s": {"last": round(self.reconnect_times[-1], 1) if times else None,
+                            "p50": round(times[len(times) // 2], 1) if times else None,
+                            "max": round(times[-1], 1) if times else None},
+        }
+
+    def log_stats(self):
+        stats = self.stats()
+        if not stats["drops"]:
+            return
+        logging.info(f"Connection: {stats['drops']} drop(s), {stats['reconnects']} reconnect(s) "
+                     f"({stats['relogins']} by logging in again), {stats['downtime_s']}s down in total, "
+                     f"reconnect p50 {stats['reconnect_s']['p50']}s, max {stats['reconnect_s']['max']}s.")
+
+    def _export(self):
+        if not self.metrics_file:
+            return
+        try:
+            with open(self.metrics_file, 'w') as f:
+                json.dump(self.stats(), f, indent=2)
+        except OSError as e:
+            logging.warning(f"Could not write the connection metrics to {self.metrics_file}: {e}")
+
+    async def stop(self):
+        """Stop watching the connection."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self._export()
+
+    async def close(self):
+        """Stop watching and log out of the current session."""
+        await self.stop()
+        await self.http_client.async_logout()
@@ -0,0 +1,204 @@
+import argparse
+import asyncio
+import logging
+import json
+import sys
+from cryptography.fernet import Fernet, InvalidToken
+from startup import StartupGraph, add_light_steps, async_close_login
+from dmx_input import (E131_PORT, ARTNET_PORT, MODES, DmxMapping, DmxReceiver, parse_e131, parse_artnet,
+                       load_mapping, sequential_mapping, e131_multicast_group, open_dmx_socket)
+from output_stage import CoalescingOutput
+from light_output_filter import LightOutputFilter
+from light_commands import LightCommandBuilder
+from command_executor import CommandExecutor
+from light_scenes import snapshot_scene, release_lights
+from hot_path_log import HotPathLog
+from profiler import DEFAULT_OUTPUT, run_profiled
+from command_trace import start_trace
+
+# Setup basic logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+async def run_dmx_bridge(email: str, password: str, light_names: list, protocol: str = "both", mapping_file: str = None,
+                         universe: int = 1, mode: str = "rgbl", bind_address: str = "0.0.0.0", multicast: bool = False,
+                         update_interval: float = 0.05, luminance_threshold: int = 2, color_threshold: int = 8,
+                         command_deadline: float = 2.0, hedge_after: float = None, restore_scene: bool = False,
+                         verbose: bool = False):
+    if verbose:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    entries = None
+    if mapping_file:
+        try:
+            entries = load_mapping(mapping_file)
+        except (FileNotFoundError, json.JSONDecodeError, KeyError, ValueError) as e:
+            logging.error(f"Could not load mapping file '{mapping_file}': {e}")
+            return
+
+    # Login, MQTT connection, discovery and the light state fetch run as a dependency graph,
+    # so independent steps overlap
+    startup = StartupGraph()
+    add_light_steps(startup, email, password, light_names)
+    try:
+        results = await startup.run()
+        logging.info("MerossManager initialized and devices discovered.")
+        startup.log_report()
+    except Exception as e:
+        logging.error(f"Failed to initialize MerossManager: {e}")
+        await async_close_login(startup)
+        return
+    http_client = results["login"]
+    target_lights = results["light state"]
+
+    if not target_lights:
+        logging.error("No target lights found.")
+        await http_client.async_logout()
+        return
+
+    try:
+        mapping = DmxMapping(target_lights, entries if entries is not None else sequential_mapping(target_lights, universe, mode))
+    except ValueError as e:
+        logging.error(str(e))
+        await http_client.async_logout()
+        return
+
+    prior_scene = snapshot_scene(target_lights) if restore_scene else None
+
+    # Consoles resend the whole universe 40+ times a second, only changed values may reach the bulbs
+    output_filter = LightOutputFilter(luminance_threshold=luminance_threshold, color_threshold=color_threshold)
+    for light in target_lights:
+        output_filter.seed(light)
+    executor = CommandExecutor(deadline=command_deadline, hedge_after=hedge_after)
+    commands = LightCommandBuilder(output_filter, executor=executor)
+    hot_log = HotPathLog("dmx")
+    hot_log.track_commands(commands)
+    output = CoalescingOutput(commands, update_interval, hot_log)
+
+    # Bind the ports before anything touches the lights, so a port in use only ends the session
+    sockets = []
+    try:
+        if protocol in ("e131", "both"):
+            groups = [e131_multicast_group(u) for u in mapping.universes] if multicast else []
+            sockets.append(("sACN", parse_e131, open_dmx_socket(E131_PORT, bind_address, groups)))
+        if protocol in ("artnet", "both"):
+            sockets.append(("Art-Net", parse_artnet, open_dmx_socket(ARTNET_PORT, bind_address)))
+    except OSError as e:
+        logging.error(f"Could not open the DMX receiver socket: {e}")
+        for _, _, sock in sockets:
+            sock.close()
+        await http_client.async_logout()
+        return
+
+    loop = asyncio.get_running_loop()
+    listeners = []
+    try:
+        for name, parse, sock in sockets:
+            endpoint = await loop.create_datagram_endpoint(lambda parse=parse: DmxReceiver(parse, mapping, output), sock=sock)
+            listeners.append((name, endpoint))
+
+        logging.info(f"Listening for {' and '.join(name for name, _ in listeners)} on universe(s) {mapping.universes} "
+                     f"for {[light.name for light in target_lights]}. Press Ctrl+C to stop.")
+        await output.run()
+
+    except asyncio.CancelledError:
+        logging.info("DMX bridge stopped.")
+    finally:
+        hot_log.log_summary()
+        for name, (transport, receiver) in listeners:
+            transport.close()
+            logging.info(f"{name} receiver: {receiver.stats()}")
+        for _, _, sock in sockets:
+            sock.close()
+        output.log_summary()
+        output_filter.log_summary()
+        commands.log_summary()
+        await release_lights(target_lights, prior_scene, executor)
+        executor.log_health()
+        await http_client.async_logout()
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive Meross smart lights from a lighting console over sACN (E1.31) or Art-Net.")
+    parser.add_argument("--light-names", nargs='+', help="The name(s) of the light(s) to use (default: all lights). Also accepts aliases, group:<name>, tag:<name> and glob patterns.")
+    parser.add_argument("--protocol", choices=["e131", "artnet", "both"], default="both", help="Which DMX over UDP protocol(s) to listen for (default: both).")
+    parser.add_argument("--mapping", help="JSON file with the universe, start address and mode of every light. Without it the lights are patched one after the other from channel 1.")
+    parser.add_argument("--universe", type=int, default=1, help="Universe used when there is no mapping file (default: 1).")
+    parser.add_argument("--mode", choices=sorted(MODES), default="rgbl", help="Channel layout used when there is no mapping file (default: rgbl).")
+    parser.add_argument("--bind", default="0.0.0.0", help="Address to listen on (default: all interfaces).")
+    parser.add_argument("--multicast", action="store_true", help="Join the sACN multicast groups of the mapped universes.")
+    parser.add_argument("--update-interval", type=float, default=0.05, help="Minimum seconds between two rounds of commands to the lights (default: 0.05).")
+    parser.add_argument("--luminance-threshold", type=int, default=2, help="Smallest luminance change that is sent to a light (default: 2).")
+    parser.add_argument("--color-threshold", type=int, default=8, help="Smallest change of a color channel that is sent to a light (default: 8).")
+    parser.add_argument("--command-deadline", type=float, default=2.0, help="Seconds a light gets to acknowledge a command before it counts as failed (default: 2.0).")
+    parser.add_argument("--hedge-after", type=float, help="Send a second copy of a command that has not been acknowledged after this many seconds.")
+    parser.add_argument("--restore-scene", action="store_true", help="When stopping, put the lights back the way they were instead of turning them off.")
+    parser.add_argument("--profile", nargs='?', const=DEFAULT_OUTPUT, metavar="PREFIX", help="Profile the run and write PREFIX.collapsed, PREFIX.svg (flamegraph) and PREFIX-lag.json (event-loop lag); the prefix defaults to meross_profile.")
+    parser.add_argument("--trace", metavar="FILE", help="Record every device command, its acknowledgement and round-trip to FILE (gzipped JSON lines), to replay with replay_trace.py.")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose (DEBUG) logging.")
+    args = parser.parse_args()
+
+    KEY_FILE = "secret.key"
+    CONFIG_FILE = "meross_config.json"
+
+    def load_key():
+        """Load the encryption key from the key file."""
+        try:
+            with open(KEY_FILE, "rb") as key_file:
+                return key_file.read()
+        except FileNotFoundError:
+            return None
+
+    key = load_key()
+    if not key:
+        print(f"Error: Encryption key '{KEY_FILE}' not found. Please run the GUI app once to generate it.", file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        with open(CONFIG_FILE, 'r') as f:
+            config = json.load(f)
+        email = config.get('email')
+        encrypted_password = config.get('password')
+        if not email or not encrypted_password:
+            print(f"Error: Could not find 'email' or 'password' in {CONFIG_FILE}.", file=sys.stderr)
+            sys.exit(1)
+        
+        f = Fernet(key)
+        password = f.decrypt(encrypted_password.encode()).decode()
+
+    except FileNotFoundError:
+        print(f"Error: Configuration file '{CONFIG_FILE}' not found.", file=sys.stderr)
+        sys.exit(1)
+    except json.JSONDecodeError:
+        print(f"Error: Could not decode '{CONFIG_FILE}'. Please ensure it is valid JSON.", file=sys.stderr)
+        sys.exit(1)
+    except InvalidToken:
+        print("Error: Failed to decrypt password. The encryption key may have changed.", file=sys.stderr)
+        sys.exit(1)
+
+    start_trace(args.trace)
+    try:
+        asyncio.run(run_profiled(
+            run_dmx_bridge(
+                email=email,
+                password=password,
+                light_names=args.light_names,
+                protocol=args.protocol,
+                mapping_file=args.mapping,
+                universe=args.universe,
+                mode=args.mode,
+                bind_address=args.bind,
+                multicast=args.multicast,
+                update_interval=args.update_interval,
+                luminance_threshold=args.luminance_threshold,
+                color_threshold=args.color_threshold,
+                command_deadline=args.command_deadline,
+                hedge_after=args.hedge_after,
+                restore_scene=args.restore_scene,
+                verbose=args.verbose
+            ),
+            args.profile
+        ))
+    except KeyboardInterrupt:
+        print("\nScript interrupted by user.")
+
+if __name__ == "__main__":
+    main()
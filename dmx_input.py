@@ -0,0 +1,255 @@
+import asyncio
+import json
+import logging
+import socket
+import struct
+
+import numpy as np
+
+# DMX input over UDP: E1.31 (sACN) and Art-Net.
+#
+# Packets are parsed into (universe, channel data), and a DmxMapping turns the
+# channel data of a universe into per-light rgb/luminance states. The channel
+# offsets of every light are gathered into numpy index arrays once, so decoding
+# a full universe is a few fancy-indexing operations per packet.
+
+E131_PORT = 5568
+ARTNET_PORT = 6454
+
+_E131_ACN_ID = b"ASC-E1.17\x00\x00\x00"
+_E131_VECTOR_ROOT_DATA = 0x00000004
+_E131_VECTOR_FRAMING_DATA = 0x00000002
+_E131_OPTION_PREVIEW = 0x80
+_E131_OPTION_TERMINATED = 0x40
+_E131_DATA_OFFSET = 126
+
+_ARTNET_ID = b"Art-Net\x00"
+_ARTNET_OP_DMX = 0x5000
+_ARTNET_DATA_OFFSET = 18
+
+# Channels used by every mapping mode, relative to the light's start address
+MODES = {
+    "rgb": 3,   # red, green, blue; all zero turns the light off
+    "rgbl": 4,  # red, green, blue, dimmer; dimmer zero turns the light off
+    "l": 1,     # dimmer only
+}
+
+MAPPING_VERSION = 1
+
+
+class DmxFrame:
+    # source identifies the sender: the CID for E1.31, None for Art-Net, whose packets carry no sender id
+    __slots__ = ("universe", "data", "sequence", "source")
+
+    def __init__(self, universe: int, data: bytes, sequence: int, source):
+        self.universe = universe
+        self.data = data
+        self.sequence = sequence
+        self.source = source
+
+
+def parse_e131(packet: bytes):
+    """Return a DmxFrame for an E1.31 data packet, None for anything else (including preview and terminated streams)."""
+    if len(packet) < _E131_DATA_OFFSET or packet[4:16] != _E131_ACN_ID:
+        return None
+    if struct.unpack_from("!I", packet, 18)[0] != _E131_VECTOR_ROOT_DATA:
+        return None
+    if struct.unpack_from("!I", packet, 40)[0] != _E131_VECTOR_FRAMING_DATA:
+        return None
+    options = packet[112]
+    if options & (_E131_OPTION_PREVIEW | _E131_OPTION_TERMINATED):
+        return None
+    if packet[125] != 0:
+        # Only the null start code carries dimmer data
+        return None
+    property_count = struct.unpack_from("!H", packet, 123)[0]
+    universe = struct.unpack_from("!H", packet, 113)[0]
+    data = packet[_E131_DATA_OFFSET:_E131_DATA_OFFSET + property_count - 1]
+    return DmxFrame(universe, data, packet[111], bytes(packet[22:38]))
+
+
+def parse_artnet(packet: bytes):
+    """Return a DmxFrame for an ArtDmx packet, None for anything else."""
+    if len(packet) < _ARTNET_DATA_OFFSET or packet[:8] != _ARTNET_ID:
+        return None
+    if struct.unpack_from("<H", packet, 8)[0] != _ARTNET_OP_DMX:
+        return None
+    universe = packet[14] | (packet[15] << 8)
+    length = struct.unpack_from("!H", packet, 16)[0]
+    # Sequence 0 means the sender does not number its packets
+    sequence = packet[12] or None
+    return DmxFrame(universe, packet[_ARTNET_DATA_OFFSET:_ARTNET_DATA_OFFSET + length], sequence, None)
+
+
+def build_e131_packet(universe: int, data: bytes, sequence: int = 0, source_name: str = "meross-lights",
+                      cid: bytes = b"meross-lights-tx", priority: int = 100) -> bytes:
+    """Build an E1.31 data packet (used by the local test sender)."""
+    data = bytes(data)
+    dmp_length = 10 + 1 + len(data)
+    framing_length = 77 + dmp_length
+    root_length = 22 + framing_length
+    packet = struct.pack("!HH12s", 0x0010, 0x0000, _E131_ACN_ID)
+    packet += struct.pack("!HI16s", 0x7000 | root_length, _E131_VECTOR_ROOT_DATA, cid[:16].ljust(16, b"\x00"))
+    packet += struct.pack("!HI64sBHBBH", 0x7000 | framing_length, _E131_VECTOR_FRAMING_DATA,
+                          source_name.encode()[:63].ljust(64, b"\x00"), priority, 0, sequence & 0xFF, 0, universe)
+    packet += struct.pack("!HBBHHHB", 0x7000 | dmp_length, 0x02, 0xA1, 0x0000, 0x0001, len(data) + 1, 0x00)
+    return packet + data
+
+
+def build_artnet_packet(universe: int, data: bytes, sequence: int = 0) -> bytes:
+    """Build an ArtDmx packet (used by the local test sender)."""
+    data = bytes(data)
+    if len(data) % 2:
+        data += b"\x00"
+    return (_ARTNET_ID + struct.pack("<H", _ARTNET_OP_DMX) + struct.pack("!H", 14)
+            + struct.pack("!BBBBH", sequence & 0xFF, 0, universe & 0xFF, (universe >> 8) & 0x7F, len(data)) + data)
+
+
+def e131_multicast_group(universe: int) -> str:
+    return f"239.255.{(universe >> 8) & 0xFF}.{universe & 0xFF}"
+
+
+def load_mapping(path: str) -> list:
+    """Return [(uuid or name, universe, address, mode)] from a mapping file.
+
+    Mapping file format (addresses are 1-based DMX channels):
+        {"version": 1, "lights": {"<uuid or light name>": {"universe": 1, "address": 1, "mode": "rgbl"}, ...}}
+    """
+    with open(path, 'r') as f:
+        data = json.load(f)
+    if data.get("version") != MAPPING_VERSION:
+        raise ValueError(f"Unsupported mapping file version: {data.get('version')}")
+    entries = []
+    for key, spec in data["lights"].items():
+        mode = spec.get("mode", "rgbl")
+        if mode not in MODES:
+            raise ValueError(f"Unknown mode '{mode}' for '{key}', expected one of {sorted(MODES)}")
+        address = int(spec["address"])
+        if not 1 <= address <= 513 - MODES[mode]:
+            raise ValueError(f"Address {address} of '{key}' does not fit {MODES[mode]} channel(s) in a universe")
+        entries.append((key, int(spec.get("universe", 1)), address, mode))
+    return entries
+
+
+def sequential_mapping(lights: list, universe: int = 1, mode: str = "rgbl") -> list:
+    """Patch the lights one after the other starting at channel 1."""
+    width = MODES[mode]
+    if len(lights) * width > 512:
+        raise ValueError(f"{len(lights)} light(s) in {mode} mode need more than one universe, use a mapping file")
+    return [(light.uuid, universe, 1 + i * width, mode) for i, light in enumerate(lights)]
+
+
+class _UniversePatch:
+    def __init__(self):
+        self.lights = {mode: [] for mode in MODES}
+        self.offsets = {mode: [] for mode in MODES}
+
+    def freeze(self):
+        for mode, width in MODES.items():
+            starts = np.asarray(self.offsets[mode], dtype=np.int64).reshape(-1, 1)
+            self.offsets[mode] = starts + np.arange(width)
+
+
+class DmxMapping:
+    """Turns the channel data of a universe into per-light states."""
+
+    def __init__(self, lights: list, entries: list):
+        by_uuid = {light.uuid: light for light in lights}
+        by_name = {light.name.lower(): light for light in lights}
+        self._patches = {}
+        for key, universe, address, mode in entries:
+            light = by_uuid.get(key) or by_name.get(str(key).lower())
+            if light is None:
+                logging.warning(f"Mapped light '{key}' not found, ignoring it.")
+                continue
+            patch = self._patches.setdefault(universe, _UniversePatch())
+            patch.lights[mode].append(light)
+            patch.offsets[mode].append(address - 1)
+        for patch in self._patches.values():
+            patch.freeze()
+
+    @property
+    def universes(self) -> list:
+        return sorted(self._patches)
+
+    def decode(self, universe: int, data: bytes) -> list:
+        """Return [(light, fields)] for every light patched into the universe."""
+        patch = self._patches.get(universe)
+        if patch is None:
+            return []
+        channels = np.zeros(512, dtype=np.uint8)
+        received = np.frombuffer(data[:512], dtype=np.uint8)
+        channels[:received.shape[0]] = received
+        states = []
+        for mode, lights in patch.lights.items():
+            if not lights:
+                continue
+            values = channels[patch.offsets[mode]]
+            if mode == "l":
+                dimmer = values[:, 0]
+                on = dimmer > 0
+                rgb = None
+            else:
+                rgb = values[:, :3]
+                on = rgb.any(axis=1)
+                dimmer = values[:, 3] if mode == "rgbl" else None
+                if dimmer is not None:
+                    on &= dimmer > 0
+            luminance = None if dimmer is None else np.clip((dimmer.astype(np.int64) * 100 + 127) // 255, 1, 100)
+            for i, light in enumerate(lights):
+                if not on[i]:
+                    states.append((light, {"onoff": False}))
+                    continue
+                fields = {"onoff": True}
+                if rgb is not None:
+                    fields["rgb"] = tuple(rgb[i].tolist())
+                if luminance is not None:
+                    fields["luminance"] = int(luminance[i])
+                states.append((light, fields))
+        return states
+
+
+class DmxReceiver(asyncio.DatagramProtocol):
+    """Receives sACN/Art-Net packets and stages the decoded light states on a CoalescingOutput."""
+
+    def __init__(self, parser, mapping: DmxMapping, output):
+        self.parser = parser
+        self.mapping = mapping
+        self.output = output
+        self._sequences = {}
+        self.packets = 0
+        self.ignored = 0
+        self.out_of_order = 0
+
+    def datagram_received(self, packet, addr):
+        self.packets += 1
+        frame = self.parser(packet)
+        if frame is None:
+            self.ignored += 1
+            return
+        if frame.sequence is not None:
+            # Art-Net streams are told apart by the sender's address
+            key = (frame.source if frame.source is not None else addr, frame.universe)
+            previous = self._sequences.get(key)
+            # Same rule as E1.31: a packet up to 20 behind the last one is stale
+            if previous is not None and -20 < ((frame.sequence - previous + 128) % 256) - 128 <= 0:
+                self.out_of_order += 1
+                return
+            self._sequences[key] = frame.sequence
+        for light, fields in self.mapping.decode(frame.universe, frame.data):
+            self.output.submit(light, **fields)
+
+    def stats(self) -> dict:
+        return {"packets": self.packets, "ignored": self.ignored, "out_of_order": self.out_of_order}
+
+
+def open_dmx_socket(port: int, bind_address: str = "0.0.0.0", multicast_groups: list = ()) -> socket.socket:
+    """Open a non-blocking UDP socket, joined to the given multicast groups."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((bind_address, port))
+    for group in multicast_groups:
+        membership = struct.pack("4s4s", socket.inet_aton(group), socket.inet_aton("0.0.0.0"))
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+    sock.setblocking(False)
+    return sock
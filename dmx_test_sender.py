@@ -0,0 +1,49 @@
+import argparse
+import colorsys
+import socket
+import time
+
+from dmx_input import E131_PORT, ARTNET_PORT, MODES, build_e131_packet, build_artnet_packet
+
+# Sends a moving rainbow as sACN or Art-Net to test dmx_bridge.py without a lighting console.
+
+def rainbow_frame(n_lights: int, mode: str, t: float, period: float) -> bytes:
+    data = bytearray()
+    for i in range(n_lights):
+        r, g, b = colorsys.hsv_to_rgb((t / period + i / max(n_lights, 1)) % 1.0, 1.0, 1.0)
+        channels = [int(r * 255), int(g * 255), int(b * 255), 255]
+        data += bytes(channels[:3] if mode == "rgb" else channels if mode == "rgbl" else channels[3:])
+    return bytes(data)
+
+def main():
+    parser = argparse.ArgumentParser(description="Send a test rainbow over sACN (E1.31) or Art-Net.")
+    parser.add_argument("--protocol", choices=["e131", "artnet"], default="e131", help="Protocol to send (default: e131).")
+    parser.add_argument("--host", default="127.0.0.1", help="Address of the bridge (default: 127.0.0.1).")
+    parser.add_argument("--universe", type=int, default=1, help="Universe to send (default: 1).")
+    parser.add_argument("--lights", type=int, default=4, help="Number of lights patched one after the other from channel 1 (default: 4).")
+    parser.add_argument("--mode", choices=sorted(MODES), default="rgbl", help="Channel layout of every light (default: rgbl).")
+    parser.add_argument("--rate", type=float, default=44.0, help="Frames per second (default: 44).")
+    parser.add_argument("--period", type=float, default=5.0, help="Seconds for the rainbow to go around once (default: 5).")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds to send for (default: 10).")
+    args = parser.parse_args()
+
+    port = E131_PORT if args.protocol == "e131" else ARTNET_PORT
+    build = build_e131_packet if args.protocol == "e131" else build_artnet_packet
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    start = time.monotonic()
+    sequence = 0
+    sent = 0
+    try:
+        while time.monotonic() - start < args.duration:
+            sequence = (sequence % 255) + 1
+            frame = rainbow_frame(args.lights, args.mode, time.monotonic() - start, args.period)
+            sock.sendto(build(args.universe, frame, sequence=sequence), (args.host, port))
+            sent += 1
+            time.sleep(1.0 / args.rate)
+    except KeyboardInterrupt:
+        pass
+    print(f"Sent {sent} frame(s) to {args.host}:{port}.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+import logging
+
+import numpy as np
+
+from audio_features import hsv_to_rgb
+
+# Layering of several effects into one output stream per light.
+#
+# Every layer renders the same tick for all lights as numpy arrays: an (n, 3)
+# color, an (n,) brightness, or both. The compositor blends the layers bottom
+# to top into a single frame, so stacking effects changes what the lights show
+# but never how many commands go out: one merged set of fields per light per
+# tick, fed through the usual LightCommandBuilder.
+
+NORMAL = "normal"
+MULTIPLY = "multiply"
+ADD = "add"
+MAX = "max"
+
+BLEND_MODES = (NORMAL, MULTIPLY, ADD, MAX)
+
+
+class LayerFrame:
+    """What a layer contributes to one tick. Any field may be None (the layer leaves it alone).
+
+    rgb is (n, 3) in 0-255, brightness is (n,) in 0-1, and opacity is a scalar or an
+    (n,) array in 0-1 so a layer can cover only some of the lights.
+    """
+    __slots__ = ("rgb", "brightness", "opacity")
+
+    def __init__(self, rgb=None, brightness=None, opacity=1.0):
+        self.rgb = rgb
+        self.brightness = brightness
+        self.opacity = opacity
+
+
+class Layer:
+    """A named effect layer. source(t, n_lights) returns a LayerFrame, or None when the layer is idle."""
+
+    def __init__(self, name: str, source, blend: str = NORMAL, priority: int = 0, opacity: float = 1.0):
+        if blend not in BLEND_MODES:
+            raise ValueError(f"Unknown blend mode '{blend}', expected one of {BLEND_MODES}")
+        self.name = name
+        self.source = source
+        self.blend = blend
+        self.priority = priority
+        self.opacity = opacity
+        self.enabled = True
+
+
+def _blend(base: np.ndarray, value: np.ndarray, mode: str, alpha, full_scale: float) -> np.ndarray:
+    if mode == MULTIPLY:
+        mixed = base * (value / full_scale)
+    elif mode == ADD:
+        mixed = np.minimum(base + value, full_scale)
+    elif mode == MAX:
+        mixed = np.maximum(base, value)
+    else:
+        mixed = value
+    if base.ndim == 2 and np.ndim(alpha) == 1:
+        alpha = alpha[:, None]
+    return base + (mixed - base) * alpha
+
+
+class EffectCompositor:
+    """Blends layers in priority order (lowest first, highest on top) into one frame per tick."""
+
+    def __init__(self, n_lights: int, base_rgb=(255, 255, 255), base_brightness: float = 0.0):
+        self.n_lights = n_lights
+        self.base_rgb = np.asarray(base_rgb, dtype=np.float64)
+        self.base_brightness = base_brightness
+        self._layers = []
+        self.ticks = 0
+        self.layer_frames = 0
+
+    def add_layer(self, layer: Layer) -> Layer:
+        self._layers.append(layer)
+        # Stable sort, layers with the same priority keep the order they were added in
+        self._layers.sort(key=lambda l: l.priority)
+        return layer
+
+    def remove_layer(self, name: str):
+        self._layers = [layer for layer in self._layers if layer.name != name]
+
+    def layer(self, name: str) -> Layer:
+        return next(layer for layer in self._layers if layer.name == name)
+
+    def compose(self, t: float):
+        """Render every enabled layer for time t and blend them. Returns (rgb uint8 (n, 3), brightness (n,))."""
+        rgb = np.broadcast_to(self.base_rgb, (self.n_lights, 3)).astype(np.float64)
+        brightness = np.full(self.n_lights, self.base_brightness, dtype=np.float64)
+        for layer in self._layers:
+            if not layer.enabled:
+                continue
+            frame = layer.source(t, self.n_lights)
+            if frame is None:
+                continue
+            self.layer_frames += 1
+            alpha = np.clip(np.asarray(frame.opacity, dtype=np.float64) * layer.opacity, 0.0, 1.0)
+            if frame.rgb is not None:
+                rgb = _blend(rgb, np.asarray(frame.rgb, dtype=np.float64), layer.blend, alpha, 255.0)
+            if frame.brightness is not None:
+                brightness = _blend(brightness, np.asarray(frame.brightness, dtype=np.float64), layer.blend, alpha, 1.0)
+        self.ticks += 1
+        return np.clip(np.rint(rgb), 0, 255).astype(np.uint8), np.clip(brightness, 0.0, 1.0)
+
+    def log_summary(self):
+        if self.ticks:
+            logging.info(f"Compositor: {self.ticks} tick(s) merged {self.layer_frames} layer frame(s) "
+                         f"into one frame per light per tick.")
+
+
+# Ready made layer sources
+
+def color_cycle_source(period: float = 10.0, saturation: float = 1.0, spread: float = 0.0):
+    """Hue rotating once per period seconds. spread offsets the hue across the lights."""
+    def source(t, n_lights):
+        hues = t / period + spread * np.arange(n_lights) / max(n_lights, 1)
+        return LayerFrame(rgb=hsv_to_rgb(hues, saturation), brightness=np.ones(n_lights))
+    return source
+
+
+def level_source(get_level):
+    """Brightness from a callable returning the current level in 0-1 (or None when nothing new is known)."""
+    state = {"level": 0.0}
+
+    def source(t, n_lights):
+        level = get_level()
+        if level is not None:
+            state["level"] = float(np.clip(level, 0.0, 1.0))
+        return LayerFrame(brightness=np.full(n_lights, state["level"]))
+    return source
+
+
+def beat_flash_source(bpm: float, rgb=(255, 255, 255), flash_length: float = 0.15, decay: float = 0.1):
+    """A short flash on every beat that fades out, idle between flashes."""
+    beat_interval = 60.0 / bpm
+    color = np.asarray(rgb, dtype=np.float64)
+
+    def source(t, n_lights):
+        since_beat = t % beat_interval
+        if since_beat >= flash_length + decay:
+            return None
+        strength = 1.0 if since_beat < flash_length else 1.0 - (since_beat - flash_length) / decay
+        return LayerFrame(rgb=np.broadcast_to(color, (n_lights, 3)), brightness=np.ones(n_lights), opacity=strength)
+    return source
@@ -0,0 +1,324 @@
+import asyncio
+import itertools
+import logging
+import time
+import types
+from collections import deque
+
+from command_scheduler import EFFECT
+from hot_path_log import HotPathLog
+from light_commands import LightCommandBuilder
+from light_output_filter import LightOutputFilter
+
+# Several effects at once, each on its own lights.
+#
+# An EffectTaskManager runs every effect as its own asyncio task with an
+# EffectContext: a command builder and output filter of its own, whose frames
+# go through the effect lane of the shared DeviceCommandScheduler (so button
+# presses still win) and, when given, the SyncGroupDispatcher. A light belongs
+# to at most one running effect; stopping an effect cancels its task, drops
+# its queued frames and releases only its lights.
+#
+# Per task the manager measures the CPU time spent inside the effect coroutine
+# (the thread CPU clock around every step of it; command sending and audio
+# callbacks run elsewhere and are not included), the messages sent per second,
+# and the timer lag of the effect's ctx.sleep() calls.
+
+COLORS = {
+    "Red": (255, 0, 0),
+    "Green": (0, 255, 0),
+    "Blue": (0, 0, 255),
+    "Yellow": (255, 255, 0),
+    "Cyan": (0, 255, 255),
+    "Magenta": (255, 0, 255),
+    "White": (255, 255, 255),
+}
+
+
+class _EffectLane:
+    """LightCommandBuilder dispatcher that sends through the scheduler's effect lane."""
+
+    def __init__(self, scheduler, group_sync=None):
+        self.scheduler = scheduler
+        self.group_sync = group_sync
+        self.executor = scheduler.executor
+
+    def _run(self, light, command_factory):
+        return self.scheduler.submit(light, command_factory, EFFECT)
+
+    async def dispatch(self, lights: list, command_factory) -> dict:
+        if self.group_sync is not None:
+            return await self.group_sync.dispatch(lights, command_factory, run=self._run)
+        results = await asyncio.gather(*(self._run(light, lambda light=light: command_factory(light))
+                                         for light in lights))
+        return {light.uuid: ok for light, ok in zip(lights, results)}
+
+
+class EffectContext:
+    """What an effect gets to drive its lights: set()/flush() for frames, sleep() for timing."""
+
+    def __init__(self, name: str, lights: list, scheduler, group_sync=None, supervisor=None):
+        self.name = name
+        self.lights = lights
+        self.supervisor = supervisor
+        self.output_filter = LightOutputFilter()
+        for light in lights:
+            self.output_filter.seed(light)
+        self.commands = LightCommandBuilder(self.output_filter, dispatcher=_EffectLane(scheduler, group_sync))
+        self.hot_log = HotPathLog(name, interval=30.0)
+        self.hot_log.track_commands(self.commands)
+        self.origin = asyncio.get_running_loop().time()
+        self.frames = 0
+        self.lags = deque(maxlen=200)
+
+    def set(self, light, onoff: bool = None, rgb: tuple = None, luminance: int = None):
+        self.commands.set(light, onoff=onoff, rgb=rgb, luminance=luminance)
+
+    def set_all(self, onoff: bool = None, rgb: tuple = None, luminance: int = None):
+        for light in self.lights:
+            self.commands.set(light, onoff=onoff, rgb=rgb, luminance=luminance)
+
+    async def flush(self):
+        await self.commands.flush()
+        self.frames += 1
+        self.hot_log.update()
+
+    async def sleep(self, delay: float):
+        loop = asyncio.get_running_loop()
+        due = loop.time() + delay
+        await asyncio.sleep(delay)
+        self.lags.append(loop.time() - due)
+
+    async def wait_connected(self, period: float = None):
+        """Pause while the cloud connection is down, resuming on the effect's grid of period seconds."""
+        if self.supervisor is not None:
+            await self.supervisor.wait_connected(period, self.origin)
+
+    def forget_sent(self):
+        """Resend the full state with the next frame, e.g. after a reconnect."""
+        for light in self.lights:
+            self.output_filter.forget(light)
+
+
+@types.coroutine
+def _metered(coro, task):
+    # Steps coro like the event loop would, adding the thread CPU time of every step to the task
+    value, error = None, None
+    while True:
+        start = time.thread_time()
+        try:
+            if error is not None:
+                yielded = coro.throw(error)
+            else:
+                yielded = coro.send(value)
+        except StopIteration as stop:
+            task.cpu_seconds += time.thread_time() - start
+            return stop.value
+        task.cpu_seconds += time.thread_time() - start
+        try:
+            value, error = (yield yielded), None
+        except GeneratorExit:
+            coro.close()
+            raise
+        except BaseException as e:
+            value, error = None, e
+
+
+class EffectTask:
+    """One running effect: its lights, its asyncio task and its counters."""
+
+    def __init__(self, task_id: int, effect: str, context: EffectContext, prior_scene: dict = None):
+        self.id = task_id
+        self.effect = effect
+        self.context = context
+        self.lights = context.lights
+        self.prior_scene = prior_scene
+        self.started = time.monotonic()
+        self.cpu_seconds = 0.0
+        self.task = None
+        self._last_sample = (self.started, 0)
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        sent = self.context.commands.messages_sent
+        last_time, last_sent = self._last_sample
+        self._last_sample = (now, sent)
+        uptime = now - self.started
+        lags = sorted(self.context.lags)
+        return {
+            "id": self.id,
+            "effect": self.effect,
+            "lights": [light.name for light in self.lights],
+            "uptime_s": round(uptime, 1),
+            "cpu_ms": round(self.cpu_seconds * 1000, 1),
+            "cpu_percent": round(self.cpu_seconds / uptime * 100, 2) if uptime > 0 else 0.0,
+            "messages_per_s": round((sent - last_sent) / (now - last_time), 1) if now > last_time else 0.0,
+            "messages": sent,
+            "failed": self.context.commands.failures,
+            "frames": self.context.frames,
+            "lag_p50_ms": round(lags[len(lags) // 2] * 1000, 1) if lags else None,
+            "lag_max_ms": round(lags[-1] * 1000, 1) if lags else None,
+        }
+
+
+class EffectTaskManager:
+    """Starts, tracks and stops effects on disjoint light selections.
+
+    release(lights, prior_scene) is awaited after an effect stopped, to restore
+    or switch off its lights. Must be used from the event loop thread.
+    """
+
+    def __init__(self, scheduler, release, group_sync=None, supervisor=None):
+        self.scheduler = scheduler
+        self.release = release
+        self.group_sync = group_sync
+        self.supervisor = supervisor
+        self.tasks = {}
+        self._ids = itertools.count(1)
+
+    def busy_lights(self) -> dict:
+        """Return {uuid: task} for every light a running effect holds."""
+        return {light.uuid: task for task in self.tasks.values() for light in task.lights}
+
+    def start(self, effect: str, lights: list, prior_scene: dict = None, bpm: int = 60, color: str = None) -> EffectTask:
+        """Start an effect of EFFECTS on the lights. Raises ValueError when a light is taken by another effect."""
+        busy = self.busy_lights()
+        taken = [f"{light.name} ({busy[light.uuid].effect} #{busy[light.uuid].id})"
+                 for light in lights if light.uuid in busy]
+        if taken:
+            raise ValueError(f"already running an effect: {', '.join(taken)}")
+        task_id = next(self._ids)
+        context = EffectContext(f"{effect} #{task_id}", lights, self.scheduler, self.group_sync, self.supervisor)
+        effect_task = EffectTask(task_id, effect, context, prior_scene)
+        effect_task.task = asyncio.ensure_future(self._run(effect_task, EFFECTS[effect](context, bpm=bpm, color=color)))
+        self.tasks[task_id] = effect_task
+        logging.info(f"Started {context.name} on {[light.name for light in lights]}.")
+        return effect_task
+
+    async def _run(self, effect_task: EffectTask, coro):
+        try:
+            await _metered(coro, effect_task)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logging.error(f"{effect_task.context.name} failed: {e!r}")
+        finally:
+            effect_task.context.hot_log.log_summary()
+            # Released here so an effect that ended on its own (e.g. the mic effect without an audio
+            # device) gives its lights back too; they stay taken until the release is done
+            stats = effect_task.stats()
+            logging.info(f"Stopped {effect_task.context.name} after {stats['uptime_s']}s: {stats['messages']} "
+                         f"message(s), {stats['failed']} failed, {stats['cpu_ms']} ms CPU.")
+            self.scheduler.cancel_effect_frames(effect_task.lights)
+            try:
+                await self.release(effect_task.lights, effect_task.prior_scene)
+            except Exception as e:
+                logging.error(f"Could not release the lights of {effect_task.context.name}: {e!r}")
+            finally:
+                self.tasks.pop(effect_task.id, None)
+
+    async def stop(self, task_id: int):
+        """Stop one effect and release only its lights."""
+        effect_task = self.tasks.get(task_id)
+        if effect_task is None:
+            return
+        effect_task.task.cancel()
+        await asyncio.gather(effect_task.task, return_exceptions=True)
+
+    async def stop_all(self):
+        await asyncio.gather(*(self.stop(task_id) for task_id in list(self.tasks)))
+
+    def forget_sent(self):
+        for effect_task in self.tasks.values():
+            effect_task.context.forget_sent()
+
+    def stats(self) -> list:
+        return [effect_task.stats() for effect_task in self.tasks.values()]
+
+
+async def flashing(ctx: EffectContext, bpm: int = 60, color: str = None):
+    """Switch the lights on for the first half of every beat and off for the second."""
+    half_beat = 30.0 / bpm
+    rgb = COLORS.get(color)
+    while True:
+        await ctx.wait_connected(2 * half_beat)
+        ctx.set_all(onoff=True, rgb=rgb)
+        await ctx.flush()
+        await ctx.sleep(half_beat)
+        ctx.set_all(onoff=False)
+        await ctx.flush()
+        await ctx.sleep(half_beat)
+
+
+async def fade(ctx: EffectContext, bpm: int = 60, color: str = None):
+    """Fade the lights in and out once per beat."""
+    rgb = COLORS.get(color, COLORS["White"])
+    fade_steps = 10
+    beat_interval = 60.0 / bpm
+    step_interval = beat_interval / (2 * fade_steps)
+    cycle = [i * (100 // fade_steps) for i in range(fade_steps + 1)]
+    cycle += cycle[::-1]
+    while True:
+        await ctx.wait_connected(beat_interval)
+        for luminance in cycle:
+            ctx.set_all(onoff=True, rgb=rgb, luminance=luminance)
+            await ctx.flush()
+            await ctx.sleep(step_interval)
+
+
+async def pulse(ctx: EffectContext, bpm: int = 120, color: str = None):
+    """A short flash on every beat, in the given color or cycling through all colors."""
+    beat_interval = 60.0 / bpm
+    colors = itertools.cycle([COLORS[color]] if color in COLORS else COLORS.values())
+    while True:
+        await ctx.wait_connected(beat_interval)
+        ctx.set_all(onoff=True, rgb=next(colors))
+        await ctx.flush()
+        await ctx.sleep(0.1)
+        ctx.set_all(onoff=False)
+        await ctx.flush()
+        await ctx.sleep(max(0.0, beat_interval - 0.1))
+
+
+async def cycle(ctx: EffectContext, bpm: int = 60, color: str = None):
+    """Step the lights through the colors, one color per beat."""
+    beat_interval = 60.0 / bpm
+    for rgb in itertools.cycle(COLORS.values()):
+        await ctx.wait_connected(beat_interval)
+        ctx.set_all(onoff=True, rgb=rgb)
+        await ctx.flush()
+        await ctx.sleep(beat_interval)
+
+
+async def mic(ctx: EffectContext, bpm: int = 60, color: str = None, sensitivity: float = 10.0,
+              update_interval: float = 0.1):
+    """Drive the luminance of the lights from the microphone volume; the beat does not apply."""
+    rgb = COLORS.get(color)
+    try:
+        import numpy as np
+        import sounddevice as sd
+    except ImportError as e:
+        logging.error(f"The mic effect needs numpy and sounddevice: {e}")
+        return
+    level = {"volume": 0.0}
+
+    def audio_callback(indata, frames, time, status):
+        # Only the newest block matters
+        level["volume"] = float(np.linalg.norm(indata) * 10)
+
+    with sd.InputStream(callback=audio_callback):
+        while True:
+            await ctx.wait_connected()
+            ctx.set_all(onoff=True, rgb=rgb, luminance=min(100, int(level["volume"] * sensitivity)))
+            await ctx.flush()
+            await ctx.sleep(update_interval)
+
+
+# Every effect is called as effect(ctx, bpm=..., color=...), color being a COLORS name or None
+EFFECTS = {
+    "Flashing": flashing,
+    "Fade": fade,
+    "Pulse": pulse,
+    "Cycle": cycle,
+    "Mic": mic,
+}
@@ -2,15 +2,24 @@ import argparse
 import asyncio
 import logging
 import json
+import sys
 from cryptography.fernet import Fernet, InvalidToken
-from meross_iot.controller.mixins.light import LightMixin
-from meross_iot.http_api import MerossHttpClient
-from meross_iot.manager import MerossManager
+from startup import StartupGraph, add_light_steps, async_close_login
+from light_output_filter import LightOutputFilter
+from light_commands import LightCommandBuilder
+from command_executor import CommandExecutor
+from connection_supervisor import ConnectionSupervisor
+from light_scenes import snapshot_scene, release_lights
+from hot_path_log import HotPathLog
+from profiler import DEFAULT_OUTPUT, run_profiled
+from command_trace import start_trace
 
 # Setup basic logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-async def fade_lights(email: str, password: str, light_names: list, bpm: int, color: str = None, verbose: bool = False):
+async def fade_lights(email: str, password: str, light_names: list, bpm: int, color: str = None,
+                      command_deadline: float = 2.0, hedge_after: float = None, restore_scene: bool = False,
+                      connection_metrics: str = None, verbose: bool = False):
     if verbose:
         logging.getLogger().setLevel(logging.DEBUG)
 
@@ -24,33 +33,20 @@ async def fade_lights(email: str, password: str, light_names: list, bpm: int, co
         "white": (255, 255, 255),
     }
 
-    # Setup Meross HTTP API client and manager
-    http_client = await MerossHttpClient.async_from_user_password(email=email, password=password, api_base_url="https://iot.meross.com")
-    manager = MerossManager(http_client=http_client)
-
-    # Discover devices
+    # Login, MQTT connection, discovery and the light state fetch run as a dependency graph,
+    # so independent steps overlap
+    startup = StartupGraph()
+    add_light_steps(startup, email, password, light_names)
     try:
-        await manager.async_init()
-        await manager.async_device_discovery()
+        results = await startup.run()
         logging.info("MerossManager initialized and devices discovered.")
+        startup.log_report()
     except Exception as e:
         logging.error(f"Failed to initialize MerossManager: {e}")
-        await http_client.async_logout()
+        await async_close_login(startup)
         return
-
-    all_devices = manager.find_devices()
-    controllable_lights = [dev for dev in all_devices if isinstance(dev, LightMixin)]
-
-    target_lights = []
-    if light_names:
-        for light_name in light_names:
-            light = next((l for l in controllable_lights if l.name.lower() == light_name.lower()), None)
-            if light:
-                target_lights.append(light)
-            else:
-                logging.warning(f"Light '{light_name}' not found.")
-    else:
-        target_lights.extend(controllable_lights)
+    http_client = results["login"]
+    target_lights = results["light state"]
 
     if not target_lights:
         logging.error("No target lights found.")
@@ -65,43 +61,68 @@ async def fade_lights(email: str, password: str, light_names: list, bpm: int, co
     fade_steps = 10
     step_interval = beat_interval / (2 * fade_steps)  # Fade in and out in one beat
 
-    # Update the state of all target lights
-    tasks = [light.async_update() for light in target_lights]
-    await asyncio.gather(*tasks)
+    prior_scene = snapshot_scene(target_lights) if restore_scene else None
+
+    # Only luminance changes between fade steps, so the color is sent once per light
+    output_filter = LightOutputFilter()
+    for light in target_lights:
+        output_filter.seed(light)
+    executor = CommandExecutor(deadline=command_deadline, hedge_after=hedge_after)
+    commands = LightCommandBuilder(output_filter, executor=executor)
+    hot_log = HotPathLog("fade")
+    hot_log.track_commands(commands)
+
+    # A dropped connection pauses the fade; once it is back the lights get their full state again
+    supervisor = ConnectionSupervisor(results["manager"], http_client, email, password, target_lights,
+                                      metrics_file=connection_metrics)
+    supervisor.on_reconnect(executor.reset_breakers)
+    supervisor.on_reconnect(lambda: [output_filter.forget(light) for light in target_lights])
+    supervisor.start()
+    fade_cycle = [i * (100 // fade_steps) for i in range(fade_steps + 1)]
+    fade_cycle += fade_cycle[::-1]
+    beat_origin = asyncio.get_running_loop().time()
+
+    async def set_lights(luminance):
+        # The first frame also turns the lights on, in the same message as the color
+        for light in target_lights:
+            commands.set(light, onoff=True, rgb=rgb, luminance=luminance)
+        await commands.flush()
+        hot_log.update("Fade step: luminance %d", luminance)
+        startup.mark("first light command")
 
     try:
-        # First, turn the lights on
-        tasks = [light.async_turn_on() for light in target_lights]
-        await asyncio.gather(*tasks)
-
         while True:
-            # Fade in
-            for i in range(fade_steps + 1):
-                luminance = i * (100 // fade_steps)
-                tasks = [light.async_set_light_color(rgb=rgb, luminance=luminance) for light in target_lights]
-                await asyncio.gather(*tasks)
-                await asyncio.sleep(step_interval)
-
-            # Fade out
-            for i in range(fade_steps, -1, -1):
-                luminance = i * (100 // fade_steps)
-                tasks = [light.async_set_light_color(rgb=rgb, luminance=luminance) for light in target_lights]
-                await asyncio.gather(*tasks)
+            # After a pause the fade starts over on the next beat
+            await supervisor.wait_connected(beat_interval, beat_origin)
+            # Fade in, then out
+            for luminance in fade_cycle:
+                if not supervisor.connected:
+                    break
+                await set_lights(luminance)
                 await asyncio.sleep(step_interval)
 
     except asyncio.CancelledError:
         logging.info("Light fading stopped.")
     finally:
-        logging.info("Turning off all lights.")
-        tasks = [light.async_turn_off() for light in target_lights]
-        await asyncio.gather(*tasks)
-        await http_client.async_logout()
+        hot_log.log_summary()
+        output_filter.log_summary()
+        commands.log_summary()
+        await release_lights(target_lights, prior_scene, executor)
+        executor.log_health()
+        supervisor.log_stats()
+        await supervisor.close()
 
 def main():
     parser = argparse.ArgumentParser(description="Fade Meross smart lights to a beat.")
-    parser.add_argument("--light-names", nargs='+', required=True, help="The name(s) of the light(s) to fade.")
+    parser.add_argument("--light-names", nargs='+', required=True, help="The name(s) of the light(s) to fade. Also accepts aliases, group:<name>, tag:<name> and glob patterns.")
     parser.add_argument("--bpm", type=int, default=60, help="The beats per minute to fade the lights to (default: 60).")
     parser.add_argument("--color", help="The color to fade the lights in.")
+    parser.add_argument("--command-deadline", type=float, default=2.0, help="Seconds a light gets to acknowledge a command before it counts as failed (default: 2.0).")
+    parser.add_argument("--hedge-after", type=float, help="Send a second copy of a command that has not been acknowledged after this many seconds.")
+    parser.add_argument("--restore-scene", action="store_true", help="When stopping, put the lights back the way they were instead of turning them off.")
+    parser.add_argument("--connection-metrics", metavar="FILE", help="Write the connection drops, reconnect times and downtime to FILE as JSON whenever the connection changes state.")
+    parser.add_argument("--profile", nargs='?', const=DEFAULT_OUTPUT, metavar="PREFIX", help="Profile the run and write PREFIX.collapsed, PREFIX.svg (flamegraph) and PREFIX-lag.json (event-loop lag); the prefix defaults to meross_profile.")
+    parser.add_argument("--trace", metavar="FILE", help="Record every device command, its acknowledgement and round-trip to FILE (gzipped JSON lines), to replay with replay_trace.py.")
     parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose (DEBUG) logging.")
     args = parser.parse_args()
 
@@ -143,17 +164,23 @@ def main():
         print("Error: Failed to decrypt password. The encryption key may have changed.", file=sys.stderr)
         sys.exit(1)
 
+    start_trace(args.trace)
     try:
-        asyncio.run(
+        asyncio.run(run_profiled(
             fade_lights(
                 email=email,
                 password=password,
                 light_names=args.light_names,
                 bpm=args.bpm,
                 color=args.color,
+                command_deadline=args.command_deadline,
+                hedge_after=args.hedge_after,
+                restore_scene=args.restore_scene,
+                connection_metrics=args.connection_metrics,
                 verbose=args.verbose
-            )
-        )
+            ),
+            args.profile
+        ))
     except KeyboardInterrupt:
         print("\nScript interrupted by user.")
 
@@ -0,0 +1,197 @@
+import argparse
+import asyncio
+import colorsys
+import logging
+import json
+import sys
+from cryptography.fernet import Fernet, InvalidToken
+from fleet_supervisor import FLEET_FILE, FleetSupervisor, load_fleet_config, plan_shards
+from light_registry import load_registry_config
+from profiler import DEFAULT_OUTPUT, run_profiled
+
+# Setup basic logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+async def run_fleet(fleet: dict, light_names: list, serve: bool = True, host: str = "127.0.0.1", port: int = 8765,
+                    max_frame_rate: float = None, demo_fps: float = 20.0, stats_interval: float = 10.0,
+                    update_interval: float = 0.05, luminance_threshold: int = 2, color_threshold: int = 8,
+                    command_deadline: float = 2.0, hedge_after: float = None, sim_latency: float = 0.05,
+                    sim_jitter: float = 0.01, sim_loss: float = 0.0, verbose: bool = False):
+    if verbose:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    registry_config = load_registry_config()
+    settings = {"update_interval": update_interval, "luminance_threshold": luminance_threshold,
+                "color_threshold": color_threshold, "command_deadline": command_deadline, "hedge_after": hedge_after,
+                "simulated": {"latency": sim_latency, "jitter": sim_jitter, "loss": sim_loss},
+                "log_level": logging.DEBUG if verbose else logging.INFO}
+    try:
+        specs = await plan_shards(fleet, registry_config, settings)
+    except Exception as e:
+        logging.error(f"Failed to list the devices of the fleet: {e}")
+        return
+    if not specs:
+        logging.error("No target lights found.")
+        return
+
+    supervisor = FleetSupervisor(specs, registry_config)
+    await supervisor.start()
+    target_lights = supervisor.select(light_names)
+    if not target_lights:
+        logging.error("No target lights found.")
+        await supervisor.stop()
+        return
+
+    async def log_stats(frame_server=None):
+        while True:
+            await asyncio.sleep(stats_interval)
+            if frame_server is not None:
+                frame_server.log_stats()
+            await supervisor.log_stats()
+
+    async def demo():
+        # A rainbow across the whole fleet, every light a little further along the hue circle
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        while True:
+            elapsed = loop.time() - start
+            for i, light in enumerate(target_lights):
+                hue = (elapsed / 10.0 + i / len(target_lights)) % 1.0
+                r, g, b = colorsys.hsv_to_rgb(hue, 1.0, 1.0)
+                supervisor.submit(light, onoff=True, rgb=(int(r * 255), int(g * 255), int(b * 255)))
+            await asyncio.sleep(1.0 / demo_fps)
+
+    try:
+        if serve:
+            import websockets
+            from ws_frame_api import FrameServer
+
+            # The supervisor stands in for the output stage: frames are routed to the shard of every light
+            frame_server = FrameServer(target_lights, supervisor, max_frame_rate=max_frame_rate,
+                                       stats_interval=stats_interval)
+            async with websockets.serve(frame_server.handle_client, host, port):
+                logging.info(f"Frame server listening on ws://{host}:{port} for {len(target_lights)} light(s) "
+                             f"in {len(specs)} shard(s). Press Ctrl+C to stop.")
+                await log_stats(frame_server)
+        else:
+            logging.info(f"Running a rainbow over {len(target_lights)} light(s) in {len(specs)} shard(s) at "
+                         f"{demo_fps} frame(s)/s. Press Ctrl+C to stop.")
+            await asyncio.gather(demo(), log_stats())
+
+    except asyncio.CancelledError:
+        logging.info("Fleet stopped.")
+    finally:
+        await supervisor.log_stats()
+        await supervisor.command([light.uuid for light in target_lights], onoff=False)
+        await supervisor.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive a large fleet of Meross lights from several accounts, with every shard of lights in its own process.")
+    parser.add_argument("--fleet-file", default=FLEET_FILE, help=f"The fleet file with the accounts and how to shard them (default: {FLEET_FILE}).")
+    parser.add_argument("--light-names", nargs='+', help="The name(s) of the light(s) to drive, in index order (default: all lights of the fleet). Also accepts aliases, group:<name>, tag:<name> and glob patterns.")
+    parser.add_argument("--demo", action="store_true", help="Run a rainbow over the fleet instead of serving the WebSocket frame API.")
+    parser.add_argument("--demo-fps", type=float, default=20.0, help="Frames per second of the rainbow (default: 20).")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (default: 127.0.0.1).")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on (default: 8765).")
+    parser.add_argument("--max-frame-rate", type=float, help="Frames per second accepted from each client, faster frames are dropped (default: unlimited).")
+    parser.add_argument("--stats-interval", type=float, default=10.0, help="Seconds between two logs of the per-shard load (default: 10).")
+    parser.add_argument("--update-interval", type=float, default=0.05, help="Minimum seconds between two rounds of commands in every shard (default: 0.05).")
+    parser.add_argument("--luminance-threshold", type=int, default=2, help="Smallest luminance change that is sent to a light (default: 2).")
+    parser.add_argument("--color-threshold", type=int, default=8, help="Smallest change of a color channel that is sent to a light (default: 8).")
+    parser.add_argument("--command-deadline", type=float, default=2.0, help="Seconds a light gets to acknowledge a command before it counts as failed (default: 2.0).")
+    parser.add_argument("--hedge-after", type=float, help="Send a second copy of a command that has not been acknowledged after this many seconds.")
+    parser.add_argument("--sim-latency", type=float, default=0.05, help="Mean round-trip of the lights of simulated accounts in seconds (default: 0.05).")
+    parser.add_argument("--sim-jitter", type=float, default=0.01, help="Standard deviation of the simulated round-trip in seconds (default: 0.01).")
+    parser.add_argument("--sim-loss", type=float, default=0.0, help="Fraction of commands a simulated light never answers (default: 0).")
+    parser.add_argument("--profile", nargs='?', const=DEFAULT_OUTPUT, metavar="PREFIX", help="Profile the run and write PREFIX.collapsed, PREFIX.svg (flamegraph) and PREFIX-lag.json (event-loop lag); the prefix defaults to meross_profile.")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose (DEBUG) logging.")
+    args = parser.parse_args()
+
+    KEY_FILE = "secret.key"
+    CONFIG_FILE = "meross_config.json"
+
+    def load_key():
+        """Load the encryption key from the key file."""
+        try:
+            with open(KEY_FILE, "rb") as key_file:
+                return key_file.read()
+        except FileNotFoundError:
+            return None
+
+    try:
+        fleet = load_fleet_config(args.fleet_file)
+    except FileNotFoundError:
+        print(f"Error: Fleet file '{args.fleet_file}' not found.", file=sys.stderr)
+        sys.exit(1)
+    except json.JSONDecodeError:
+        print(f"Error: Could not decode '{args.fleet_file}'. Please ensure it is valid JSON.", file=sys.stderr)
+        sys.exit(1)
+    except ValueError as e:
+        print(f"Error: {e} in '{args.fleet_file}'.", file=sys.stderr)
+        sys.exit(1)
+
+    # Accounts without credentials of their own use the ones of the GUI app
+    accounts = [account for account in fleet["accounts"] if not account.get("simulated")]
+    if accounts:
+        key = load_key()
+        if not key:
+            print(f"Error: Encryption key '{KEY_FILE}' not found. Please run the GUI app once to generate it.", file=sys.stderr)
+            sys.exit(1)
+        f = Fernet(key)
+        for account in accounts:
+            try:
+                if not account.get("email"):
+                    with open(CONFIG_FILE, 'r') as config_file:
+                        config = json.load(config_file)
+                    account["email"] = config.get('email')
+                    account["password"] = config.get('password')
+                if not account.get("email") or not account.get("password"):
+                    print(f"Error: Could not find 'email' or 'password' for account '{account['name']}'.", file=sys.stderr)
+                    sys.exit(1)
+                account["password"] = f.decrypt(account["password"].encode()).decode()
+            except FileNotFoundError:
+                print(f"Error: Configuration file '{CONFIG_FILE}' not found.", file=sys.stderr)
+                sys.exit(1)
+            except json.JSONDecodeError:
+                print(f"Error: Could not decode '{CONFIG_FILE}'. Please ensure it is valid JSON.", file=sys.stderr)
+                sys.exit(1)
+            except InvalidToken:
+                print(f"Error: Failed to decrypt the password of account '{account['name']}'. The encryption key may have changed.", file=sys.stderr)
+                sys.exit(1)
+
+    if not args.demo:
+        try:
+            import websockets
+        except ImportError:
+            print("Error: 'websockets' not found.", file=sys.stderr)
+            print("Please install it, or run with --demo: pip install websockets", file=sys.stderr)
+            sys.exit(1)
+
+    try:
+        asyncio.run(run_profiled(
+            run_fleet(
+                fleet=fleet,
+                light_names=args.light_names,
+                serve=not args.demo,
+                host=args.host,
+                port=args.port,
+                max_frame_rate=args.max_frame_rate,
+                demo_fps=args.demo_fps,
+                stats_interval=args.stats_interval,
+                update_interval=args.update_interval,
+                luminance_threshold=args.luminance_threshold,
+                color_threshold=args.color_threshold,
+                command_deadline=args.command_deadline,
+                hedge_after=args.hedge_after,
+                sim_latency=args.sim_latency,
+                sim_jitter=args.sim_jitter,
+                sim_loss=args.sim_loss,
+                verbose=args.verbose
+            ),
+            args.profile
+        ))
+    except KeyboardInterrupt:
+        print("\nScript interrupted by user.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,539 @@
+import asyncio
+import itertools
+import json
+import logging
+import multiprocessing as mp
+import pickle
+import signal
+import threading
+import time
+
+from light_registry import LightRegistry, load_registry_config
+
+# Sharded worker processes for large fleets.
+#
+# One event loop and one MQTT connection run out of steam with several
+# accounts and hundreds of bulbs. The supervisor splits every account into
+# shards (a fixed number, or named groups of selectors), and runs each shard
+# in its own process with its own login, MerossManager, executor and
+# coalescing output stage. The supervisor process only routes: effect frames
+# are staged per light, coalesced, and sent to every shard as one batch per
+# event loop iteration; commands go to the shards that own the lights and
+# return their results. Shards that die are restarted with a backoff.
+#
+# Fleet file format (passwords encrypted with secret.key, like meross_config.json):
+#     {"version": 1,
+#      "accounts": [
+#          {"name": "home", "email": "...", "password": "...", "shards": 2},
+#          {"name": "office", "email": "...", "password": "...", "lights": ["tag:online"],
+#           "groups": {"floor1": ["group:floor1"], "floor2": ["Floor 2 *"]}},
+#          {"name": "lab", "simulated": 40, "shards": 2}]}
+# "lights" limits an account to some selectors, "simulated" runs simulated bulbs instead of an account.
+
+FLEET_FILE = "meross_fleet.json"
+FLEET_VERSION = 1
+
+# How long a restarted shard waits before coming back, doubling up to the maximum
+RESTART_BACKOFF = 1.0
+MAX_RESTART_BACKOFF = 60.0
+# A shard has to stay up this long after becoming ready before its backoff starts over
+STABLE_UPTIME = 30.0
+
+
+def load_fleet_config(path: str = FLEET_FILE) -> dict:
+    with open(path, 'r') as f:
+        config = json.load(f)
+    if config.get("version") != FLEET_VERSION:
+        raise ValueError(f"Unsupported fleet file version: {config.get('version')}")
+    names = [account.get("name") for account in config.get("accounts", [])]
+    if not names or None in names or len(set(names)) != len(names):
+        raise ValueError("Every account needs a unique name")
+    return config
+
+
+def split_shards(account: dict, devices: list, registry_config: dict = None) -> dict:
+    """Return {shard name: devices} for one account, from its groups or its shard count."""
+    name = account["name"]
+    groups = account.get("groups")
+    if groups:
+        registry = LightRegistry(devices, registry_config)
+        shards = {}
+        taken = set()
+        for group, selectors in groups.items():
+            members = [device for device in registry.select(selectors) if device.uuid not in taken]
+            taken.update(device.uuid for device in members)
+            shards[f"{name}/{group}"] = members
+        rest = [device for device in devices if device.uuid not in taken]
+        if rest:
+            logging.info(f"{len(rest)} device(s) of '{name}' are in no group, giving them their own shard.")
+            shards[f"{name}/other"] = rest
+        return shards
+    count = max(1, min(int(account.get("shards", 1)), len(devices) or 1))
+    shards = {f"{name}/{i + 1}": [] for i in range(count)}
+    # Round-robin over a stable order, so every shard gets about the same number of lights
+    for i, device in enumerate(sorted(devices, key=lambda device: device.uuid)):
+        shards[f"{name}/{i % count + 1}"].append(device)
+    return shards
+
+
+class _SimulatedDevice:
+    __slots__ = ("uuid", "dev_name", "device_type", "online_status")
+
+    def __init__(self, uuid: str, name: str):
+        self.uuid = uuid
+        self.dev_name = name
+        self.device_type = "simulated"
+        self.online_status = None
+
+
+async def plan_shards(config: dict, registry_config: dict = None, settings: dict = None) -> dict:
+    """Turn the fleet file into {shard name: spec} for FleetSupervisor.
+
+    Real accounts are logged in once to list their devices; the shard processes
+    then only discover the uuids they were given. Passwords must already be
+    decrypted. settings (thresholds, deadlines, simulation) go into every spec.
+    """
+    settings = settings or {}
+    specs = {}
+    for account in config["accounts"]:
+        name = account["name"]
+        if account.get("simulated"):
+            devices = [_SimulatedDevice(f"{name}-{i + 1}", f"{name} {i + 1}") for i in range(int(account["simulated"]))]
+        else:
+            from meross_iot.http_api import MerossHttpClient
+
+            http_client = await MerossHttpClient.async_from_user_password(
+                email=account["email"], password=account["password"], api_base_url="https://iot.meross.com")
+            try:
+                devices = await http_client.async_list_devices()
+            finally:
+                await http_client.async_logout()
+        if account.get("lights"):
+            devices = LightRegistry(devices, registry_config).select(account["lights"])
+        for shard, members in split_shards(account, devices, registry_config).items():
+            if not members:
+                continue
+            spec = dict(settings, name=shard, account=name,
+                        devices=[(device.uuid, getattr(device, "dev_name", device.uuid)) for device in members])
+            if account.get("simulated"):
+                spec["simulated"] = settings.get("simulated", {"latency": 0.05, "jitter": 0.01, "loss": 0.0})
+            else:
+                spec.update(email=account["email"], password=account["password"], simulated=None)
+            specs[shard] = spec
+        logging.info(f"Account '{name}': {len(devices)} light(s) in "
+                     f"{sum(1 for spec in specs.values() if spec['account'] == name)} shard(s).")
+    return specs
+
+
+class FleetLight:
+    """The router's view of a light: enough for selectors, FrameServer and the shard lookup."""
+
+    __slots__ = ("uuid", "name", "type", "shard")
+
+    def __init__(self, uuid: str, name: str, shard: str, device_type: str = None):
+        self.uuid = uuid
+        self.name = name
+        self.shard = shard
+        self.type = device_type
+
+    def __repr__(self):
+        return f"FleetLight({self.name!r}, shard={self.shard!r})"
+
+
+# ---- Worker process ----
+
+def _shard_main(spec: dict, conn):
+    """Entry point of a shard process."""
+    logging.basicConfig(level=spec.get("log_level", logging.INFO),
+                        format=f'%(asctime)s - {spec["name"]} - %(levelname)s - %(message)s')
+    # Ctrl+C reaches the whole process group; the supervisor stops the shards itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        asyncio.run(_shard_loop(spec, conn))
+    finally:
+        conn.close()
+
+
+async def _open_shard_lights(spec: dict):
+    """Log in and discover the shard's lights. Returns (lights, http_client or None)."""
+    if spec.get("simulated"):
+        from simulated_lights import SimulatedLight
+
+        sim = spec["simulated"]
+        return [SimulatedLight(name, uuid=uuid, latency=sim["latency"], jitter=sim["jitter"], loss=sim["loss"])
+                for uuid, name in spec["devices"]], None
+
+    from startup import StartupGraph, add_light_steps, async_close_login
+
+    startup = StartupGraph()
+    add_light_steps(startup, spec["email"], spec["password"], uuids=[uuid for uuid, _ in spec["devices"]])
+    try:
+        results = await startup.run()
+    except Exception:
+        await async_close_login(startup)
+        raise
+    startup.log_report()
+    return results["light state"], results["login"]
+
+
+async def _shard_loop(spec: dict, conn):
+    from command_executor import CommandExecutor
+    from light_commands import LightCommandBuilder, async_send_light_state
+    from light_output_filter import LightOutputFilter
+    from output_stage import CoalescingOutput
+    from profiler import LoopLagMonitor
+
+    loop = asyncio.get_running_loop()
+
+    def send(message):
+        conn.send_bytes(pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL))
+
+    try:
+        lights, http_client = await _open_shard_lights(spec)
+    except Exception as e:
+        send(("failed", repr(e)))
+        return
+    by_uuid = {light.uuid: light for light in lights}
+
+    output_filter = LightOutputFilter(luminance_threshold=spec["luminance_threshold"],
+                                      color_threshold=spec["color_threshold"])
+    for light in lights:
+        output_filter.seed(light)
+    executor = CommandExecutor(deadline=spec["command_deadline"], hedge_after=spec["hedge_after"])
+    commands = LightCommandBuilder(output_filter, executor=executor)
+    output = CoalescingOutput(commands, spec["update_interval"])
+    lag = LoopLagMonitor()
+    counters = {"frames": 0, "states": 0, "unknown": 0, "commands": 0}
+    cpu_start, wall_start = time.process_time(), time.monotonic()
+
+    def stats() -> dict:
+        health = executor.health().values()
+        latencies = [h["latency_ms"] for h in health if h["latency_ms"] is not None]
+        elapsed = max(time.monotonic() - wall_start, 1e-6)
+        return {
+            **counters,
+            **output.stats(),
+            "lights": len(lights),
+            "pending": len(output._latest),
+            "cpu_percent": round(100 * (time.process_time() - cpu_start) / elapsed, 1),
+            "loop_lag_ms": {key: lag.report()[key] for key in ("p50_ms", "p99_ms", "max_ms")},
+            "latency_ms": round(sum(latencies) / len(latencies)) if latencies else None,
+            "failures": sum(h["failures"] for h in health),
+            "open_breakers": sum(1 for h in health if h["state"] != "closed"),
+        }
+
+    async def run_command(request_id, uuids, fields):
+        targets = [by_uuid[uuid] for uuid in uuids if uuid in by_uuid]
+        counters["commands"] += 1
+        results = await executor.run_all(targets, lambda light: async_send_light_state(light, **fields))
+        for light in targets:
+            # The command bypassed the output stage, so the next frame must not be filtered against stale state
+            output_filter.forget(light)
+        send(("result", request_id, results))
+
+    send(("ready", [(light.uuid, light.name) for light in lights]))
+    tasks = [asyncio.ensure_future(output.run()), asyncio.ensure_future(lag.run())]
+    try:
+        while True:
+            data = await loop.run_in_executor(None, conn.recv_bytes)
+            message = pickle.loads(data)
+            kind = message[0]
+            if kind == "frame":
+                counters["frames"] += 1
+                for uuid, fields in message[1]:
+                    light = by_uuid.get(uuid)
+                    if light is None:
+                        counters["unknown"] += 1
+                        continue
+                    counters["states"] += 1
+                    output.submit(light, **fields)
+            elif kind == "command":
+                tasks.append(asyncio.ensure_future(run_command(*message[1:])))
+            elif kind == "stats":
+                send(("stats", message[1], stats()))
+            elif kind == "stop":
+                break
+    except (EOFError, OSError):
+        logging.warning("Lost the connection to the supervisor.")
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        output.log_summary()
+        executor.log_health()
+        if http_client is not None:
+            await http_client.async_logout()
+
+
+# ---- Supervisor side ----
+
+class ShardHandle:
+    """One shard process, its pipe and the router's counters for it."""
+
+    def __init__(self, name: str, spec: dict):
+        self.name = name
+        self.spec = spec
+        self.process = None
+        self.conn = None
+        self.ready = None
+        self.discovered = []
+        self.alive = False
+        self.restarts = 0
+        self.backoff = RESTART_BACKOFF
+        self.ready_at = None
+        self.restart_task = None
+        self.batches = 0
+        self.states = 0
+        self.bytes = 0
+        self.dropped = 0
+        self._send_lock = threading.Lock()
+
+    def send(self, message) -> bool:
+        if not self.alive:
+            return False
+        data = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+        try:
+            with self._send_lock:
+                self.conn.send_bytes(data)
+        except (BrokenPipeError, EOFError, OSError):
+            self.alive = False
+            return False
+        self.bytes += len(data)
+        return True
+
+
+class FleetSupervisor:
+    """Starts the shard processes and routes frames and commands to them.
+
+    submit() has the signature of CoalescingOutput.submit(), so a FrameServer
+    or any other frame source can feed the whole fleet through it.
+    """
+
+    def __init__(self, shard_specs: dict, registry_config: dict = None, ready_timeout: float = 60.0):
+        self.shards = {name: ShardHandle(name, spec) for name, spec in shard_specs.items()}
+        self.registry_config = registry_config if registry_config is not None else load_registry_config()
+        self.ready_timeout = ready_timeout
+        # The index comes from the plan, not from what the shards discovered, so it stays
+        # stable while a shard restarts and frame sources can keep their light order
+        self.lights = [FleetLight(uuid, device_name, name)
+                       for name, spec in shard_specs.items() for uuid, device_name in spec["devices"]]
+        self.registry = LightRegistry(self.lights, self.registry_config)
+        self._by_uuid = {light.uuid: light for light in self.lights}
+        self._staged = {}
+        self._flush_scheduled = False
+        self._requests = {}
+        self._request_ids = itertools.count(1)
+        self._loop = None
+        self._stopping = False
+        self._monitor = None
+        self.received = 0
+        self.coalesced = 0
+
+    async def start(self):
+        """Start every shard and wait until all of them discovered their lights (or failed)."""
+        self._loop = asyncio.get_running_loop()
+        await asyncio.gather(*(self._start_shard(shard) for shard in self.shards.values()))
+        self._monitor = asyncio.ensure_future(self._watch_shards())
+        ready = [shard for shard in self.shards.values() if shard.alive]
+        logging.info(f"Fleet ready: {sum(len(shard.discovered) for shard in ready)} of {len(self.lights)} light(s) "
+                     f"in {len(ready)} of {len(self.shards)} shard(s).")
+
+    async def _start_shard(self, shard: ShardHandle):
+        ctx = mp.get_context("spawn")
+        parent_conn, child_conn = ctx.Pipe()
+        shard.conn = parent_conn
+        shard.ready = self._loop.create_future()
+        shard.process = ctx.Process(target=_shard_main, args=(shard.spec, child_conn), name=f"shard-{shard.name}",
+                                    daemon=True)
+        shard.process.start()
+        child_conn.close()
+        shard.alive = True
+        threading.Thread(target=self._read_shard, args=(shard, shard.process, parent_conn), name=f"reader-{shard.name}",
+                         daemon=True).start()
+        try:
+            devices = await asyncio.wait_for(asyncio.shield(shard.ready), self.ready_timeout)
+        except asyncio.TimeoutError:
+            logging.error(f"Shard {shard.name} did not come up within {self.ready_timeout}s.")
+            # Nobody waits for it any more, so the exit of the process must not set an exception on it
+            shard.ready.cancel()
+            self._kill(shard)
+            return
+        except RuntimeError as e:
+            logging.error(f"Shard {shard.name} failed to start: {e}")
+            self._kill(shard)
+            return
+        shard.discovered = devices
+        shard.ready_at = self._loop.time()
+        logging.info(f"Shard {shard.name} is up with {len(devices)} light(s) (pid {shard.process.pid}).")
+
+    def _read_shard(self, shard: ShardHandle, process, conn):
+        # Runs in a thread per shard: blocking reads, handed over to the event loop
+        while True:
+            try:
+                message = pickle.loads(conn.recv_bytes())
+            except (EOFError, OSError):
+                break
+            self._loop.call_soon_threadsafe(self._on_message, shard, message)
+        process.join(1.0)
+        self._loop.call_soon_threadsafe(self._on_exit, shard, conn)
+
+    def _on_message(self, shard: ShardHandle, message):
+        kind = message[0]
+        if kind == "ready":
+            if not shard.ready.done():
+                shard.ready.set_result(message[1])
+        elif kind == "failed":
+            if not shard.ready.done():
+                shard.ready.set_exception(RuntimeError(message[1]))
+        elif kind in ("result", "stats"):
+            future = self._requests.pop(message[1], None)
+            if future is not None and not future.done():
+                future.set_result(message[2])
+
+    def _on_exit(self, shard: ShardHandle, conn):
+        if conn is not shard.conn:
+            return  # An old connection of a shard that was restarted already
+        shard.alive = False
+        if shard.ready is not None and not shard.ready.done():
+            shard.ready.set_exception(RuntimeError("the process exited"))
+        # Only a shard that ran for a while starts over with the short backoff, one that keeps
+        # crashing right after coming up keeps backing off
+        if shard.ready_at is not None and self._loop.time() - shard.ready_at >= STABLE_UPTIME:
+            shard.backoff = RESTART_BACKOFF
+        shard.ready_at = None
+        if not self._stopping:
+            logging.warning(f"Shard {shard.name} exited (code {shard.process.exitcode if shard.process else None}).")
+
+    def _kill(self, shard: ShardHandle):
+        shard.alive = False
+        if shard.process is not None and shard.process.is_alive():
+            shard.process.terminate()
+
+    async def _watch_shards(self):
+        """Restart shards that died, each on its own growing backoff."""
+        while True:
+            await asyncio.sleep(1.0)
+            for shard in self.shards.values():
+                if shard.alive or self._stopping:
+                    continue
+                if shard.restart_task is None or shard.restart_task.done():
+                    # One task per shard, so a long backoff of one shard does not hold up the others
+                    shard.restart_task = asyncio.ensure_future(self._restart_shard(shard))
+
+    async def _restart_shard(self, shard: ShardHandle):
+        logging.info(f"Restarting shard {shard.name} in {shard.backoff:.0f}s.")
+        await asyncio.sleep(shard.backoff)
+        shard.backoff = min(shard.backoff * 2, MAX_RESTART_BACKOFF)
+        shard.restarts += 1
+        await self._start_shard(shard)
+
+    def select(self, selectors: list) -> list:
+        """Resolve selectors against all lights of the fleet."""
+        return self.registry.select(selectors) if selectors else list(self.lights)
+
+    # Frame path: latest value wins per light, one batch per shard and loop iteration
+
+    def submit(self, light, onoff: bool = None, rgb: tuple = None, luminance: int = None) -> bool:
+        fields = {}
+        if onoff is not None:
+            fields["onoff"] = onoff
+        if rgb is not None:
+            fields["rgb"] = tuple(rgb)
+        if luminance is not None:
+            fields["luminance"] = luminance
+        self.received += 1
+        fleet_light = self._by_uuid.get(light.uuid)
+        if fleet_light is None:
+            return False
+        shard = fleet_light.shard
+        staged = self._staged.setdefault(shard, {})
+        replaced = light.uuid in staged
+        if replaced:
+            self.coalesced += 1
+        staged[light.uuid] = fields
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            self._loop.call_soon(self._flush)
+        return replaced
+
+    def _flush(self):
+        self._flush_scheduled = False
+        staged, self._staged = self._staged, {}
+        for name, states in staged.items():
+            shard = self.shards[name]
+            if shard.send(("frame", list(states.items()))):
+                shard.batches += 1
+                shard.states += len(states)
+            else:
+                shard.dropped += len(states)
+
+    # Command path: acknowledged, per light results
+
+    async def _request(self, shard: ShardHandle, *message, timeout: float = 10.0):
+        request_id = next(self._request_ids)
+        future = self._loop.create_future()
+        self._requests[request_id] = future
+        if not shard.send((message[0], request_id) + message[1:]):
+            self._requests.pop(request_id, None)
+            return None
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self._requests.pop(request_id, None)
+            return None
+
+    async def command(self, selectors: list, onoff: bool = None, rgb: tuple = None, luminance: int = None) -> dict:
+        """Send one state to the selected lights, through the shards that own them. Returns {uuid: success}."""
+        fields = {key: value for key, value in (("onoff", onoff), ("rgb", rgb), ("luminance", luminance))
+                  if value is not None}
+        by_shard = {}
+        for light in self.select(selectors):
+            by_shard.setdefault(light.shard, []).append(light.uuid)
+        replies = await asyncio.gather(*(self._request(self.shards[name], "command", uuids, fields)
+                                         for name, uuids in by_shard.items()))
+        results = {}
+        for uuids, reply in zip(by_shard.values(), replies):
+            for uuid in uuids:
+                results[uuid] = bool(reply and reply.get(uuid))
+        return results
+
+    async def stats(self) -> dict:
+        """Return {shard: metrics}, the router's counters merged with the shard's own."""
+        shards = list(self.shards.values())
+        replies = await asyncio.gather(*(self._request(shard, "stats", timeout=5.0) for shard in shards))
+        report = {}
+        for shard, reply in zip(shards, replies):
+            report[shard.name] = {"alive": shard.alive, "restarts": shard.restarts, "batches": shard.batches,
+                                  "states_routed": shard.states, "bytes_routed": shard.bytes,
+                                  "dropped": shard.dropped, **(reply or {})}
+        return report
+
+    async def log_stats(self):
+        for name, stats in (await self.stats()).items():
+            if not stats["alive"]:
+                logging.info(f"Shard {name}: down, {stats['restarts']} restart(s), {stats['dropped']} state(s) dropped.")
+                continue
+            lag = stats.get("loop_lag_ms", {})
+            logging.info(f"Shard {name}: {stats.get('lights')} light(s), {stats['states_routed']} state(s) in "
+                         f"{stats['batches']} batch(es), {stats.get('coalesced')} coalesced, "
+                         f"{stats.get('messages_sent')} message(s) sent, {stats.get('pending')} pending, "
+                         f"cpu {stats.get('cpu_percent')}%, loop lag p99 {lag.get('p99_ms')} ms, "
+                         f"latency {stats.get('latency_ms')} ms, {stats.get('open_breakers')} open breaker(s).")
+        if self.received:
+            logging.info(f"Router: {self.received} state(s) submitted, {self.coalesced} replaced before routing.")
+
+    async def stop(self):
+        self._stopping = True
+        if self._monitor is not None:
+            self._monitor.cancel()
+        for shard in self.shards.values():
+            if shard.restart_task is not None:
+                shard.restart_task.cancel()
+        for shard in self.shards.values():
+            shard.send(("stop",))
+        for shard in self.shards.values():
+            if shard.process is not None:
+                await self._loop.run_in_executor(None, shard.process.join, 10.0)
+                if shard.process.is_alive():
+                    shard.process.terminate()
+            shard.alive = False
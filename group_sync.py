@@ -0,0 +1,139 @@
+import asyncio
+import logging
+from collections import deque
+
+from command_executor import CommandExecutor
+
+# Synchronized group dispatch.
+#
+# Sending the same change to several bulbs at once still makes them switch at
+# different moments, because every bulb answers with its own latency. The
+# dispatcher learns each light's typical latency and delays the sends to the
+# fast lights so that the changes land inside a tight window.
+
+
+class SyncGroupDispatcher:
+    """Staggers the commands of a group so that all lights change at about the same time.
+
+    The time a light applies a command is estimated as the send time plus
+    apply_fraction of the measured round-trip (the command travels to the
+    bulb, the acknowledgement travels back). The per-light round-trip is an
+    exponentially weighted average, so the estimate follows slow drifts.
+
+    The apply-time spreads in skew_report() are estimates from that model, the
+    bulbs do not report when they changed. The spread of the acknowledgements
+    is what was actually observed.
+    """
+
+    def __init__(self, executor: CommandExecutor = None, alpha: float = 0.2, apply_fraction: float = 0.5,
+                 max_stagger: float = 1.0, compensate: bool = True, history: int = 500):
+        self.executor = executor or CommandExecutor()
+        self.alpha = alpha
+        self.apply_fraction = apply_fraction
+        self.max_stagger = max_stagger
+        self.compensate = compensate
+        self._rtt = {}
+        # Estimated spread between the first and last light of every dispatch, with and without the stagger
+        self.skew_uncompensated = deque(maxlen=history)
+        self.skew_compensated = deque(maxlen=history)
+        # Observed spread between the first and last acknowledgement of every dispatch
+        self.ack_spread = deque(maxlen=history)
+
+    def estimated_delay(self, light) -> float:
+        """Estimated time between sending a command to the light and the light changing."""
+        rtt = self._rtt.get(light.uuid)
+        return 0.0 if rtt is None else rtt * self.apply_fraction
+
+    def _learn(self, light, rtt: float):
+        previous = self._rtt.get(light.uuid)
+        self._rtt[light.uuid] = rtt if previous is None else (1 - self.alpha) * previous + self.alpha * rtt
+
+    def send_offsets(self, lights: list) -> list:
+        """Return how long to hold back the command of every light."""
+        if not self.compensate:
+            return [0.0] * len(lights)
+        # Lights the executor is skipping don't take part, they would only stretch the window
+        delays = [self.estimated_delay(light) if self.executor.is_available(light) else None for light in lights]
+        known = [d for d in delays if d is not None]
+        if not known:
+            return [0.0] * len(lights)
+        slowest = max(known)
+        return [0.0 if d is None else min(slowest - d, self.max_stagger) for d in delays]
+
+    async def dispatch(self, lights: list, command_factory, run=None) -> dict:
+        """Run command_factory(light) for every light, staggered. Returns {uuid: success}.
+
+        run(light, factory) sends one command and returns whether it succeeded; it
+        defaults to the executor, and can be pointed at a DeviceCommandScheduler lane.
+        """
+        lights = list(lights)
+        run = run or self.executor.run
+        loop = asyncio.get_running_loop()
+        offsets = self.send_offsets(lights)
+        start = loop.time()
+
+        async def send(light, offset):
+            if offset > 0:
+                await asyncio.sleep(offset)
+            started = []
+
+            def factory():
+                # Time from when the executor actually starts the command, not from when run() queued it,
+                # so waiting behind other commands in a scheduler lane is not learned as latency
+                started.append(loop.time())
+                return command_factory(light)
+
+            queued_at = loop.time()
+            ok = await run(light, factory)
+            sent_at = started[0] if started else queued_at
+            return ok, sent_at - start, loop.time() - sent_at
+
+        results = await asyncio.gather(*(send(light, offset) for light, offset in zip(lights, offsets)))
+
+        applied = []
+        unstaggered = []
+        acked = []
+        for light, (ok, sent_offset, rtt) in zip(lights, results):
+            if not ok:
+                continue
+            self._learn(light, rtt)
+            unstaggered.append(rtt * self.apply_fraction)
+            applied.append(sent_offset + rtt * self.apply_fraction)
+            acked.append(sent_offset + rtt)
+        if len(applied) > 1:
+            self.skew_uncompensated.append(max(unstaggered) - min(unstaggered))
+            self.skew_compensated.append(max(applied) - min(applied))
+            self.ack_spread.append(max(acked) - min(acked))
+        return {light.uuid: ok for light, (ok, _, _) in zip(lights, results)}
+
+    def skew_report(self) -> dict:
+        return {
+            "dispatches": len(self.skew_compensated),
+            "estimated_uncompensated_ms": _percentiles(self.skew_uncompensated),
+            "estimated_compensated_ms": _percentiles(self.skew_compensated),
+            "observed_ack_spread_ms": _percentiles(self.ack_spread),
+            "latency_ms": {uuid: round(rtt * 1000) for uuid, rtt in self._rtt.items()},
+        }
+
+    def log_report(self):
+        if not self.skew_compensated:
+            return
+        report = self.skew_report()
+        before = report["estimated_uncompensated_ms"]
+        after = report["estimated_compensated_ms"]
+        acks = report["observed_ack_spread_ms"]
+        logging.info(f"Inter-light skew over {report['dispatches']} group change(s), estimated from the latency model: "
+                     f"without stagger p50 {before['p50']} ms / p95 {before['p95']} ms, "
+                     f"with stagger p50 {after['p50']} ms / p95 {after['p95']} ms; "
+                     f"observed acknowledgement spread p50 {acks['p50']} ms / p95 {acks['p95']} ms.")
+
+
+def _percentiles(values) -> dict:
+    if not values:
+        return {"p50": None, "p95": None, "max": None}
+    ordered = sorted(values)
+
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000)
+
+    return {"p50": pick(0.5), "p95": pick(0.95), "max": round(ordered[-1] * 1000)}
@@ -0,0 +1,144 @@
+import logging
+import threading
+import time
+
+# Logging for the per-frame and per-block paths of the effect loops.
+#
+# A line per audio block or fade step costs CPU and I/O over a long session
+# and floods the GUI log window. A HotPathLog counts every update instead and
+# lets through at most a few detail lines per interval; the arguments are
+# %-style, so a line that is not emitted is never formatted. Once per interval
+# it logs one summary line with the counts of that interval, e.g.
+#     mic: 1,200 update(s), 1,187 sent, 3 error(s), 1,199 detail line(s) skipped in 10s
+# and log_summary() logs the totals when the effect ends.
+
+
+class Lazy:
+    """Defers an expensive log argument until a handler actually formats it: Lazy(lambda: ...)."""
+
+    __slots__ = ("func",)
+
+    def __init__(self, func):
+        self.func = func
+
+    def __str__(self):
+        return str(self.func())
+
+    __repr__ = __str__
+
+
+class HotPathLog:
+    """Rate-limited detail lines and periodic summary lines for one effect loop.
+
+    update() and error() may be called from any thread (audio callbacks
+    included). Cumulative counters of other objects, such as the messages a
+    LightCommandBuilder sent, can be added to the summaries with track().
+    """
+
+    def __init__(self, name: str, interval: float = 10.0, max_lines: int = 1, level: int = logging.DEBUG,
+                 logger: logging.Logger = None):
+        self.name = name
+        self.interval = interval
+        self.max_lines = max_lines
+        self.level = level
+        self.logger = logger or logging.getLogger()
+        self.updates = 0
+        self.errors = 0
+        self.skipped = 0
+        self._tracked = {}
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self._window_start = self._start
+        self._window = {"updates": 0, "errors": 0, "skipped": 0}
+        self._lines = 0
+
+    def track(self, label: str, counter):
+        """Add the growth of counter() over every interval to the summaries."""
+        value = counter()
+        # [counter, value at the start, value at the last summary]
+        self._tracked[label] = [counter, value, value]
+
+    def track_commands(self, commands):
+        """Add the messages a LightCommandBuilder sent and the ones that failed to the summaries."""
+        self.track("sent", lambda: commands.messages_sent)
+        self.track("failed", lambda: commands.failures)
+
+    def update(self, msg: str = None, *args):
+        """Count one update and log msg % args at the detail level, if this interval still has room for it."""
+        with self._lock:
+            self.updates += 1
+            self._window["updates"] += 1
+            emit = msg is not None and self._take_line()
+            summary = self._window_due()
+        if emit:
+            self.logger.log(self.level, msg, *args)
+        if summary is not None:
+            self._log_window(*summary)
+
+    def error(self, msg: str = None, *args):
+        """Count one error and log it as a warning, within the same per-interval line budget."""
+        with self._lock:
+            self.errors += 1
+            self._window["errors"] += 1
+            emit = msg is not None and self._take_line(logging.WARNING)
+            summary = self._window_due()
+        if emit:
+            self.logger.warning(msg, *args)
+        if summary is not None:
+            self._log_window(*summary)
+
+    def _take_line(self, level: int = None) -> bool:
+        if not self.logger.isEnabledFor(self.level if level is None else level):
+            return False
+        if self._lines >= self.max_lines:
+            self.skipped += 1
+            self._window["skipped"] += 1
+            return False
+        self._lines += 1
+        return True
+
+    def _window_due(self):
+        now = time.monotonic()
+        elapsed = now - self._window_start
+        if elapsed < self.interval:
+            return None
+        window = self._window
+        self._window = {"updates": 0, "errors": 0, "skipped": 0}
+        self._window_start = now
+        self._lines = 0
+        return window, elapsed
+
+    def _tracked_deltas(self) -> dict:
+        deltas = {}
+        for label, entry in self._tracked.items():
+            value = entry[0]()
+            deltas[label] = value - entry[2]
+            entry[2] = value
+        return deltas
+
+    def _log_window(self, window: dict, elapsed: float):
+        if not window["updates"] and not window["errors"]:
+            return
+        self.logger.info(f"{self.name}: {_describe(window, self._tracked_deltas())} in {elapsed:.0f}s")
+
+    def stats(self) -> dict:
+        return {"updates": self.updates, "errors": self.errors, "skipped_lines": self.skipped,
+                "seconds": round(time.monotonic() - self._start, 1)}
+
+    def log_summary(self):
+        """Log the totals since the start."""
+        if not self.updates and not self.errors:
+            return
+        totals = {label: counter() - initial for label, (counter, initial, _) in self._tracked.items()}
+        window = {"updates": self.updates, "errors": self.errors, "skipped": self.skipped}
+        self.logger.info(f"{self.name}: {_describe(window, totals)} in {time.monotonic() - self._start:.0f}s in total")
+
+
+def _describe(window: dict, tracked: dict) -> str:
+    parts = [f"{window['updates']:,} update(s)"]
+    parts += [f"{value:,} {label}" for label, value in tracked.items()]
+    if window["errors"]:
+        parts.append(f"{window['errors']:,} error(s)")
+    if window["skipped"]:
+        parts.append(f"{window['skipped']:,} detail line(s) skipped")
+    return ", ".join(parts)
@@ -0,0 +1,103 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# Import-time budget of the CLI.
+#
+# Every run starts a fresh interpreter, imports meross_cli and everything one
+# command needs (meross_cli.import_command), and reports the time that took
+# plus the modules that ended up loaded. The simple commands must stay under
+# the budget and must not pull in any of the heavy effect dependencies; the
+# script exits with status 1 when they do, so it can run as a check.
+
+SIMPLE_COMMANDS = ["list", "on", "off", "color", "cycle-colors", "save-scene", "restore-scene"]
+# Dependencies only the effects may load
+HEAVY_MODULES = ["numpy", "sounddevice", "speech_recognition", "tkinter", "websockets"]
+
+_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import meross_cli
+meross_cli.load_plugin_file()
+meross_cli.import_command(sys.argv[1])
+elapsed = time.perf_counter() - start
+print(json.dumps({"ms": elapsed * 1000, "heavy": [m for m in sys.argv[2:] if m in sys.modules]}))
+"""
+
+
+def measure(command: str, runs: int) -> dict:
+    """Import the command in `runs` fresh interpreters. Returns the median time and the heavy modules it loaded."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    times = []
+    heavy = set()
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, "-c", _PROBE, command] + HEAVY_MODULES, cwd=here,
+                                capture_output=True, text=True, check=True)
+        sample = json.loads(result.stdout.strip().splitlines()[-1])
+        times.append(sample["ms"])
+        heavy.update(sample["heavy"])
+    return {"median_ms": statistics.median(times), "max_ms": max(times), "heavy": sorted(heavy)}
+
+
+def slowest_imports(command: str, top: int) -> list:
+    """Return [(cumulative ms, module)] of the slowest top-level imports, from python -X importtime."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c",
+                             f"import meross_cli; meross_cli.load_plugin_file(); meross_cli.import_command({command!r})"],
+                            cwd=here, capture_output=True, text=True, check=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Nested imports are indented below the module that imported them
+        if not name[1:].startswith(" "):
+            imports.append((int(cumulative) / 1000, name.strip()))
+    return sorted(imports, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the import time of the CLI commands against a budget.")
+    parser.add_argument("--budget-ms", type=float, default=1500.0, help="Import-time budget of a simple command in ms (default: 1500).")
+    parser.add_argument("--runs", type=int, default=5, help="Fresh interpreters per command, the median counts (default: 5).")
+    parser.add_argument("--commands", nargs='+', default=SIMPLE_COMMANDS, help="The commands to check (default: the simple commands).")
+    parser.add_argument("--effects", action="store_true", help="Also report the import time of every effect (not held to the budget).")
+    parser.add_argument("--top", type=int, default=0, help="Show the N slowest top-level imports of every command.")
+    args = parser.parse_args()
+
+    failures = []
+    for command in args.commands:
+        result = measure(command, args.runs)
+        verdict = "ok"
+        if result["median_ms"] > args.budget_ms:
+            verdict = "OVER BUDGET"
+            failures.append(f"'{command}' imports in {result['median_ms']:.0f} ms, the budget is {args.budget_ms:.0f} ms")
+        if result["heavy"]:
+            verdict = "HEAVY IMPORTS"
+            failures.append(f"'{command}' loads {', '.join(result['heavy'])}")
+        print(f"{command:<14} median {result['median_ms']:7.1f} ms  max {result['max_ms']:7.1f} ms  {verdict}")
+        for ms, module in slowest_imports(command, args.top) if args.top else []:
+            print(f"    {ms:7.1f} ms  {module}")
+
+    if args.effects:
+        import meross_cli
+        meross_cli.load_plugin_file()
+        for name, plugin in sorted(meross_cli.EFFECTS.items()):
+            if plugin.missing_requirements():
+                print(f"effect {name:<9} skipped, needs {', '.join(plugin.missing_requirements())}")
+                continue
+            result = measure(name, args.runs)
+            print(f"effect {name:<9} median {result['median_ms']:7.1f} ms  loads {', '.join(result['heavy']) or 'no heavy modules'}")
+
+    if failures:
+        for failure in failures:
+            print(f"FAIL: {failure}", file=sys.stderr)
+        sys.exit(1)
+    print(f"All commands within the {args.budget_ms:.0f} ms budget.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,340 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+
+import numpy as np
+
+# End-to-end latency calibration of the microphone effects.
+#
+# A train of short tone bursts goes through the same path as live audio: an
+# audio callback thread hands blocks to the analysis, the newest level is
+# handed over to the event loop, the control loop sends it through the output
+# filter, command builder and executor, and the light acknowledges. Every
+# burst is timestamped at each hand-off, all on the time.monotonic() clock
+# that the event loop uses as well:
+#
+#     emitted     the burst starts (written to the sound card, or injected)
+#     captured    the audio callback receives the block that contains it
+#     analysed    the analysis of that block crossed the detection threshold
+#     dispatched  the event loop picked up the new level
+#     sent        the control loop started sending it
+#     acked       every light acknowledged the command
+#
+# The lights change at about sent + half the send round-trip (the same
+# estimate SyncGroupDispatcher uses); the median of emitted to that point is
+# the compensation offset of the microphone effects. Effects that render on
+# a timer skip capture, analysis and pacing, so the send-path part of it
+# (sent to the lights changing) is saved on its own as well.
+
+CALIBRATION_FILE = "latency_calibration.json"
+# Simulated lights say nothing about real bulbs, their calibrations go elsewhere
+SIMULATED_CALIBRATION_FILE = "latency_calibration_simulated.json"
+CALIBRATION_VERSION = 1
+
+TIMESTAMPS = ("emitted", "captured", "analysed", "dispatched", "sent", "acked")
+STAGES = (
+    ("capture", "emitted", "captured"),
+    ("dsp", "captured", "analysed"),
+    ("handoff", "analysed", "dispatched"),
+    ("pacing", "dispatched", "sent"),
+    ("send", "sent", "acked"),
+)
+# Fraction of the send round-trip after which a light is assumed to change
+APPLY_FRACTION = 0.5
+
+
+class ImpulseTrain:
+    """Tone bursts of burst seconds, one every period seconds, the first one half a period in."""
+
+    def __init__(self, samplerate: float, period: float = 1.0, burst: float = 0.25, frequency: float = 1000.0,
+                 amplitude: float = 0.5, noise: float = 0.001, seed: int = 0):
+        self.samplerate = samplerate
+        self.period_samples = int(round(period * samplerate))
+        self.burst_samples = max(1, int(round(burst * samplerate)))
+        self.offset_samples = self.period_samples // 2
+        self.frequency = frequency
+        self.amplitude = amplitude
+        self.noise = noise
+        self._rng = np.random.default_rng(seed)
+
+    def onset_sample(self, k: int) -> int:
+        return self.offset_samples + k * self.period_samples
+
+    def onsets_in(self, start: int, frames: int) -> list:
+        """Return [(k, sample)] of the bursts starting inside the block [start, start + frames)."""
+        first = max(0, -(-(start - self.offset_samples) // self.period_samples))
+        onsets = []
+        k = first
+        while self.onset_sample(k) < start + frames:
+            onsets.append((k, self.onset_sample(k)))
+            k += 1
+        return onsets
+
+    def block(self, start: int, frames: int) -> np.ndarray:
+        samples = np.arange(start, start + frames)
+        phase = (samples - self.offset_samples) % self.period_samples
+        in_burst = (samples >= self.offset_samples) & (phase < self.burst_samples)
+        tone = self.amplitude * np.sin(2 * np.pi * self.frequency * samples / self.samplerate)
+        block = np.where(in_burst, tone, 0.0)
+        if self.noise:
+            block = block + self._rng.normal(0.0, self.noise, frames)
+        return block.astype(np.float32).reshape(-1, 1)
+
+
+class LatencyProbe:
+    """Collects the timestamps of every burst and turns them into per-stage distributions."""
+
+    def __init__(self, period: float):
+        self.period = period
+        self.records = {}
+        self.false_detections = 0
+        self.missed = set()
+        self._lock = threading.Lock()
+
+    def emitted(self, k: int, at: float):
+        with self._lock:
+            self.records.setdefault(k, {})["emitted"] = at
+
+    def detected(self, captured_at: float, analysed_at: float):
+        """Match a detection to the newest burst emitted before the block arrived. Returns its number or None."""
+        with self._lock:
+            if not self.records:
+                # Nothing was emitted yet, the analysis is still settling on the noise floor
+                return None
+            candidates = [(record["emitted"], k) for k, record in self.records.items()
+                          if "captured" not in record and record["emitted"] <= captured_at]
+            if not candidates:
+                self.false_detections += 1
+                return None
+            emitted_at, k = max(candidates)
+            if captured_at - emitted_at >= self.period:
+                self.false_detections += 1
+                return None
+            self.records[k].update(captured=captured_at, analysed=analysed_at)
+            return k
+
+    def mark(self, k: int, timestamp: str, at: float):
+        with self._lock:
+            self.records[k][timestamp] = at
+
+    def miss(self, k: int):
+        """The burst never reached the lights, e.g. it ended before the control loop sent it."""
+        with self._lock:
+            self.missed.add(k)
+
+    def complete(self) -> list:
+        return [record for _, record in sorted(self.records.items()) if all(t in record for t in TIMESTAMPS)]
+
+    def report(self) -> dict:
+        complete = self.complete()
+        stages = {name: _distribution([r[end] - r[start] for r in complete]) for name, start, end in STAGES}
+        visible = [r["sent"] + APPLY_FRACTION * (r["acked"] - r["sent"]) - r["emitted"] for r in complete]
+        send_path = [APPLY_FRACTION * (r["acked"] - r["sent"]) for r in complete]
+        return {
+            "impulses": len(self.records),
+            "measured": len(complete),
+            "missed": len(self.missed),
+            "false_detections": self.false_detections,
+            "stages_ms": stages,
+            "end_to_end_ms": _distribution([r["acked"] - r["emitted"] for r in complete]),
+            "visible_ms": _distribution(visible),
+            "offset_ms": _distribution(visible)["p50"],
+            "send_offset_ms": _distribution(send_path)["p50"],
+        }
+
+    def log_report(self):
+        report = self.report()
+        logging.info(f"Measured {report['measured']} of {report['impulses']} impulse(s), {report['missed']} missed, "
+                     f"{report['false_detections']} false detection(s).")
+        for name, dist in list(report["stages_ms"].items()) + [("end to end", report["end_to_end_ms"]),
+                                                               ("visible", report["visible_ms"])]:
+            logging.info(f"  {name:<10} p50 {dist['p50']} ms, p90 {dist['p90']} ms, p99 {dist['p99']} ms, "
+                         f"max {dist['max']} ms")
+        logging.info(f"Lights trail the sound by about {report['offset_ms']} ms, {report['send_offset_ms']} ms of "
+                     f"that after the command is sent.")
+
+
+def _distribution(values) -> dict:
+    if not values:
+        return {"p50": None, "p90": None, "p99": None, "max": None, "mean": None}
+    ordered = sorted(values)
+
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 1)
+
+    return {"p50": pick(0.5), "p90": pick(0.9), "p99": pick(0.99), "max": round(ordered[-1] * 1000, 1),
+            "mean": round(sum(ordered) / len(ordered) * 1000, 1)}
+
+
+class InjectedSource:
+    """Feeds the impulse train to the callback from a thread, at the pace a sound card would deliver it.
+
+    A block is handed over once its last sample would have been recorded, so
+    the capture stage includes the block buffering a real input stream has.
+    """
+
+    def __init__(self, train: ImpulseTrain, probe: LatencyProbe, blocksize: int = 512):
+        self.train = train
+        self.probe = probe
+        self.blocksize = blocksize
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, callback):
+        self._thread = threading.Thread(target=self._run, args=(callback,), name="injected-audio", daemon=True)
+        self._thread.start()
+
+    def _run(self, callback):
+        start = time.monotonic()
+        position = 0
+        while not self._stop.is_set():
+            for k, sample in self.train.onsets_in(position, self.blocksize):
+                self.probe.emitted(k, start + sample / self.train.samplerate)
+            block = self.train.block(position, self.blocksize)
+            position += self.blocksize
+            delay = start + position / self.train.samplerate - time.monotonic()
+            if delay > 0 and self._stop.wait(delay):
+                break
+            callback(block)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+class PlayedSource:
+    """Plays the impulse train on the default output and records the default input in one duplex stream."""
+
+    def __init__(self, train: ImpulseTrain, probe: LatencyProbe, blocksize: int = 512):
+        self.train = train
+        self.probe = probe
+        self.blocksize = blocksize
+        self._stream = None
+        self._position = 0
+
+    def start(self, callback):
+        import sounddevice as sd
+
+        def duplex_callback(indata, outdata, frames, time_info, status):
+            # Stream time to time.monotonic(), taken in the callback so both clocks are read together
+            to_monotonic = time.monotonic() - time_info.currentTime
+            for k, sample in self.train.onsets_in(self._position, frames):
+                played_at = time_info.outputBufferDacTime + (sample - self._position) / self.train.samplerate
+                self.probe.emitted(k, to_monotonic + played_at)
+            outdata[:] = self.train.block(self._position, frames)
+            self._position += frames
+            callback(indata.copy())
+
+        self._stream = sd.Stream(samplerate=self.train.samplerate, blocksize=self.blocksize, channels=1,
+                                 callback=duplex_callback)
+        self._stream.start()
+
+    def stop(self):
+        if self._stream is not None:
+            self._stream.stop()
+            self._stream.close()
+
+
+def luminance_analysis(sensitivity: float):
+    """The analysis of the luminance mode of mic_light_control.py: block volume to a 0-100 luminance."""
+    def analyse(block):
+        return min(100, int(np.linalg.norm(block) * 10 * sensitivity))
+    return analyse
+
+
+def spectrum_analysis(samplerate: float, sensitivity: float, bands: int = 4):
+    """The spectrum mode analysis, reduced to the loudest band as a 0-100 luminance."""
+    from audio_features import SpectrumAnalyzer
+
+    analyzer = SpectrumAnalyzer(samplerate, bands, sensitivity=sensitivity / 10.0)
+
+    def analyse(block):
+        return int(min(1.0, float(np.max(analyzer.process(block)))) * 100)
+    return analyse
+
+
+async def run_calibration(lights: list, source, probe: LatencyProbe, analyse, commands, impulses: int,
+                          update_interval: float = 0.1, threshold: int = 50) -> LatencyProbe:
+    """Run the impulse train through analysis, hand-off and the send path until impulses bursts were measured.
+
+    The control loop has the shape of the live microphone loop: wait for a new
+    level, send it to every light, sleep update_interval.
+    """
+    loop = asyncio.get_running_loop()
+    latest = {"luminance": 0, "impulse": None}
+    new_level = asyncio.Event()
+    above = {"state": False}
+
+    def publish(luminance, k):
+        if k is not None:
+            probe.mark(k, "dispatched", time.monotonic())
+            latest["impulse"] = k
+        latest["luminance"] = luminance
+        new_level.set()
+
+    def audio_callback(block):
+        captured_at = time.monotonic()
+        luminance = analyse(block)
+        k = None
+        # Only the rising edge of a burst counts as a detection
+        if luminance >= threshold and not above["state"]:
+            k = probe.detected(captured_at, time.monotonic())
+        above["state"] = luminance >= threshold
+        loop.call_soon_threadsafe(publish, luminance, k)
+
+    deadline = loop.time() + (impulses + 2) * probe.period + 10.0
+    source.start(audio_callback)
+    try:
+        while len(probe.complete()) + len(probe.missed) < impulses and loop.time() < deadline:
+            try:
+                await asyncio.wait_for(new_level.wait(), timeout=probe.period)
+            except asyncio.TimeoutError:
+                continue
+            new_level.clear()
+            k, latest["impulse"] = latest["impulse"], None
+            for light in lights:
+                commands.set(light, onoff=True, luminance=latest["luminance"])
+            if k is not None:
+                probe.mark(k, "sent", time.monotonic())
+            sent_before = commands.messages_sent
+            await commands.flush()
+            if k is not None and commands.messages_sent == sent_before:
+                # The level fell back before the loop got to it, so the output filter had nothing to send
+                probe.miss(k)
+            elif k is not None:
+                probe.mark(k, "acked", time.monotonic())
+                logging.debug(f"Impulse {k}: {time.monotonic() - probe.records[k]['emitted']:.3f}s end to end.")
+            await asyncio.sleep(update_interval)
+    finally:
+        source.stop()
+    if len(probe.complete()) < impulses:
+        logging.warning(f"Only {len(probe.complete())} of {impulses} impulse(s) made it through, "
+                        "check the volume, --sensitivity and the light acknowledgements.")
+    return probe
+
+
+def save_calibration(report: dict, settings: dict, path: str = CALIBRATION_FILE):
+    with open(path, 'w') as f:
+        json.dump({"version": CALIBRATION_VERSION, "measured_at": int(time.time()), "settings": settings,
+                   **report}, f, indent=2)
+
+
+def load_latency_offset(path: str = CALIBRATION_FILE, send_path_only: bool = False) -> float:
+    """Return the calibrated compensation offset in seconds.
+
+    With send_path_only the offset covers only sending to the lights changing,
+    for effects whose frames do not come from the microphone.
+    """
+    with open(path, 'r') as f:
+        data = json.load(f)
+    if data.get("version") != CALIBRATION_VERSION:
+        raise ValueError(f"Unsupported calibration file version: {data.get('version')}")
+    if data.get("settings", {}).get("backend") == "simulated":
+        raise ValueError(f"Calibration file '{path}' was measured against simulated lights")
+    key = "send_offset_ms" if send_path_only else "offset_ms"
+    if data.get(key) is None:
+        raise ValueError(f"Calibration file '{path}' has no measured {'send-path ' if send_path_only else ''}offset")
+    return data[key] / 1000.0
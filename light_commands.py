@@ -0,0 +1,205 @@
+import asyncio
+import json
+import logging
+
+from meross_iot.controller.mixins.toggle import ToggleMixin, ToggleXMixin
+from meross_iot.model.enums import Namespace, LightMode
+from meross_iot.utilities.conversion import rgb_to_int
+
+from command_scheduler import SUPERSEDED
+
+# Builds a single device message out of the on/off, color and luminance changes
+# an effect wants to make to one light, so every frame costs one round-trip per
+# light instead of a turn_on() followed by a set_light_color().
+
+MULTIPLE_NAMESPACE = "Appliance.Control.Multiple"
+
+
+def supports_multiple(light) -> bool:
+    """Tell if the device advertises the Appliance.Control.Multiple namespace."""
+    abilities = getattr(light, "abilities", None) or {}
+    return MULTIPLE_NAMESPACE in abilities
+
+
+def _uses_toggle(light) -> bool:
+    return isinstance(light, (ToggleMixin, ToggleXMixin))
+
+
+def build_light_payload(light, rgb: tuple = None, luminance: int = None, onoff: bool = None, channel: int = 0) -> dict:
+    """Build an Appliance.Control.Light payload, mirroring LightMixin.async_set_light_color()."""
+    light_payload = {}
+    if onoff is not None and not _uses_toggle(light):
+        light_payload['onoff'] = 1 if onoff else 0
+    if rgb is not None and light.get_supports_rgb(channel=channel):
+        light_payload['rgb'] = rgb_to_int(rgb)
+        light_payload['capacity'] = light_payload.get('capacity', 0) | LightMode.MODE_RGB.value
+    if luminance is not None and light.get_supports_luminance(channel=channel):
+        light_payload['luminance'] = luminance
+        light_payload['capacity'] = light_payload.get('capacity', 0) | LightMode.MODE_LUMINANCE.value
+    if not light_payload:
+        return {}
+    light_payload.update({'channel': channel, 'gradual': 0})
+    return {'light': light_payload}
+
+
+def _toggle_command(light, onoff: bool, channel: int = 0):
+    if isinstance(light, ToggleXMixin):
+        return Namespace.CONTROL_TOGGLEX, {'togglex': {'onoff': 1 if onoff else 0, 'channel': channel}}
+    return Namespace.CONTROL_TOGGLE, {'toggle': {'onoff': 1 if onoff else 0, 'channel': channel}}
+
+
+def _mark_toggle_state(light, onoff: bool, channel: int = 0):
+    # The library only updates the toggle state from its own turn_on/turn_off calls
+    if isinstance(light, ToggleXMixin):
+        light._channel_togglex_status[channel] = onoff
+    elif isinstance(light, ToggleMixin):
+        light._channel_toggle_status[channel] = onoff
+
+
+async def _async_send_multiple(light, commands: list, timeout: float = None):
+    """Send several (namespace, payload) SET commands to one device inside a single Multiple message."""
+    messages = []
+    for namespace, payload in commands:
+        raw, _ = light._manager._build_mqtt_message(method="SET", namespace=namespace, payload=payload,
+                                                    destination_device_uuid=light.uuid)
+        messages.append(json.loads(raw))
+    await light._execute_command(method="SET", namespace=MULTIPLE_NAMESPACE,
+                                 payload={'multiple': messages}, timeout=timeout)
+
+
+async def async_send_light_state(light, onoff: bool = None, rgb: tuple = None, luminance: int = None,
+                                 channel: int = 0, timeout: float = None) -> int:
+    """Apply on/off, color and luminance changes to one light with as few messages as possible.
+
+    Returns the number of messages sent:
+    - turning off only needs the toggle (color changes on a bulb going dark are dropped);
+    - bulbs without Toggle/ToggleX carry onoff inside the light payload, so one message;
+    - Toggle/ToggleX bulbs that must be switched on and recolored use a single
+      Appliance.Control.Multiple message when the device supports it. Otherwise
+      the light command alone is sent, since Appliance.Control.Light switches
+      those bulbs on by itself.
+    """
+    if onoff is True and light.get_light_is_on(channel=channel):
+        onoff = None
+    has_light_fields = rgb is not None or luminance is not None
+
+    if onoff is False:
+        await light.async_turn_off(channel=channel, timeout=timeout)
+        return 1
+    if not has_light_fields:
+        if onoff:
+            await light.async_turn_on(channel=channel, timeout=timeout)
+            return 1
+        return 0
+
+    if onoff and _uses_toggle(light) and supports_multiple(light):
+        payload = build_light_payload(light, rgb=rgb, luminance=luminance, channel=channel)
+        toggle_namespace, toggle_payload = _toggle_command(light, True, channel)
+        commands = [(toggle_namespace, toggle_payload)]
+        if payload:
+            commands.append((Namespace.CONTROL_LIGHT, payload))
+        await _async_send_multiple(light, commands, timeout=timeout)
+        light._update_channel_status(channel, rgb=rgb, luminance=luminance)
+    else:
+        await light.async_set_light_color(channel=channel, onoff=onoff, rgb=rgb, luminance=luminance, timeout=timeout)
+    if onoff and _uses_toggle(light):
+        _mark_toggle_state(light, True, channel)
+    return 1
+
+
+class LightCommandBuilder:
+    """Collects the changes an effect makes to its lights during one frame.
+
+    Calls to set() for the same light are merged (later values win), and flush()
+    sends one combined message per light. When an output filter is given, the
+    merged fields go through it first so unchanged values are not resent. When a
+    CommandExecutor is given, every message runs under its deadline and circuit
+    breaker and a failing light no longer raises out of flush(). A
+    SyncGroupDispatcher additionally staggers the messages of a frame so that
+    the lights change together; it brings its own executor.
+    """
+
+    def __init__(self, output_filter=None, timeout: float = None, executor=None, dispatcher=None):
+        self.output_filter = output_filter
+        self.timeout = timeout
+        self.dispatcher = dispatcher
+        self.executor = dispatcher.executor if dispatcher is not None else executor
+        self._pending = {}
+        self.messages_sent = 0
+        # Messages that failed or timed out
+        self.failures = 0
+        # Messages the same changes would have cost as separate turn_on/set_light_color calls
+        self.messages_unmerged = 0
+
+    def set(self, light, onoff: bool = None, rgb: tuple = None, luminance: int = None):
+        _, fields = self._pending.setdefault(light.uuid, (light, {}))
+        if onoff is not None:
+            fields["onoff"] = onoff
+        if rgb is not None:
+            fields["rgb"] = tuple(rgb)
+        if luminance is not None:
+            fields["luminance"] = luminance
+
+    def discard(self, light=None):
+        """Drop pending changes for one light, or for all of them."""
+        if light is None:
+            self._pending.clear()
+        else:
+            self._pending.pop(light.uuid, None)
+
+    async def flush(self):
+        pending, self._pending = self._pending, {}
+        to_send = {}
+        for light, fields in pending.values():
+            if self.output_filter is not None:
+                fields = self.output_filter.filter(light, **fields)
+            if not fields:
+                continue
+            # A separate turn_on/turn_off plus a set_light_color call per changed group
+            self.messages_unmerged += ("onoff" in fields) + ("rgb" in fields or "luminance" in fields)
+            to_send[light.uuid] = (light, fields)
+        if not to_send:
+            return
+
+        if self.dispatcher is not None:
+            lights = [light for light, _ in to_send.values()]
+            results = await self.dispatcher.dispatch(
+                lights, lambda light: self._deliver(light, to_send[light.uuid][1]))
+            for light in lights:
+                if results[light.uuid] is SUPERSEDED:
+                    # Never sent, so the light still has the state the filter last confirmed
+                    if self.output_filter is not None:
+                        self.output_filter.discard(light)
+                elif not results[light.uuid]:
+                    self.failures += 1
+                    self._forget(light)
+        else:
+            await asyncio.gather(*(self._send(light, fields) for light, fields in to_send.values()))
+
+    async def _deliver(self, light, fields: dict):
+        sent = await async_send_light_state(light, timeout=self.timeout, **fields)
+        self.messages_sent += sent
+        if self.output_filter is not None:
+            self.output_filter.commit(light)
+
+    async def _send(self, light, fields: dict):
+        if self.executor is None:
+            try:
+                await self._deliver(light, fields)
+            except Exception:
+                self.failures += 1
+                self._forget(light)
+                raise
+        elif not await self.executor.run(light, lambda: self._deliver(light, fields)):
+            self.failures += 1
+            self._forget(light)
+
+    def _forget(self, light):
+        # The light may or may not have applied the change, resend everything next time
+        if self.output_filter is not None:
+            self.output_filter.forget(light)
+
+    def log_summary(self):
+        if self.messages_unmerged:
+            logging.info(f"Command builder: sent {self.messages_sent} message(s) for changes that would have "
+                         f"taken {self.messages_unmerged} separate command(s).")
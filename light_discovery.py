@@ -0,0 +1,58 @@
+import logging
+import time
+
+from meross_iot.controller.mixins.light import LightMixin
+
+from command_trace import attach_trace
+from light_registry import LightRegistry, load_registry_config, uses_capability_tags
+
+# Targeted device discovery.
+#
+# A full async_device_discovery() enrolls every device of the account, one
+# ability query after the other, before the scripts throw away everything that
+# is not a requested light. When the wanted lights are known up front, the
+# HTTP device list is fetched once, the requested selectors are resolved
+# against it through a LightRegistry, and only those devices are handed to the
+# manager for enrollment.
+
+
+async def async_discover_lights(manager, http_client, light_names: list = None, uuids: list = None,
+                                registry_config: dict = None, http_devices: list = None) -> list:
+    """Discover and return the requested lights, in the order they were asked for.
+
+    light_names are registry selectors (names, aliases, uuids, group:, tag: and
+    glob patterns, see light_registry.py). Without names or uuids every light of
+    the account is discovered. Selectors that need initialized devices (such as
+    tag:rgb) also fall back to a full discovery. Selectors that match nothing,
+    and matched devices that turn out not to be lights, are logged and left out.
+    An HTTP device list fetched beforehand can be passed as http_devices.
+    """
+    start = time.monotonic()
+    config = load_registry_config() if registry_config is None else registry_config
+    selectors = list(light_names or []) + list(uuids or [])
+    if not selectors or uses_capability_tags(selectors, config):
+        await manager.async_device_discovery(cached_http_device_list=http_devices)
+        lights = [dev for dev in manager.find_devices() if isinstance(dev, LightMixin)]
+        logging.debug(f"Full discovery took {time.monotonic() - start:.2f}s.")
+        return attach_trace(LightRegistry(lights, config).select(selectors) if selectors else lights)
+
+    if http_devices is None:
+        http_devices = await http_client.async_list_devices()
+    wanted = LightRegistry(http_devices, config).select(selectors)
+    if not wanted:
+        return []
+
+    await manager.async_device_discovery(cached_http_device_list=wanted)
+    enrolled = {dev.uuid: dev for dev in manager.find_devices(device_uuids=[device.uuid for device in wanted])}
+    lights = []
+    for device in wanted:
+        dev = enrolled.get(device.uuid)
+        if dev is None:
+            logging.warning(f"Could not initialize '{device.dev_name}', it may be offline.")
+        elif not isinstance(dev, LightMixin):
+            logging.info(f"Skipping '{device.dev_name}', it is not a light.")
+        else:
+            lights.append(dev)
+    logging.debug(f"Targeted discovery of {len(wanted)} of {len(http_devices)} device(s) "
+                  f"took {time.monotonic() - start:.2f}s.")
+    return attach_trace(lights)
@@ -0,0 +1,332 @@
+import asyncio
+import bisect
+import datetime
+import json
+import logging
+import math
+import mmap
+import os
+import struct
+import time
+from collections import namedtuple
+
+# Append-only history of light states and command outcomes.
+#
+# Every command a CommandExecutor runs ends up as one fixed-width record: when
+# it finished, which device, whether it succeeded, failed or timed out, the
+# round-trip, and the state the light is in afterwards (on/off, color,
+# luminance, from the device cache the command just updated). Records go into
+# one file per UTC day, so the file names are the per-day index and a time
+# range only opens the days it covers. Within a day the records are in time
+# order, so a query memory-maps the file and bisects straight to the first
+# record of the range.
+#
+#     light_history/devices.json     device number -> uuid and name
+#     light_history/2026-10-19.hist  22-byte records, see RECORD
+#
+# Effect frames are too many to keep every one: for them a record is only
+# written when the light switched on or off, the outcome changed, or
+# sample_interval seconds passed since the light's last record, so the on
+# times and the colors an effect showed are still in the history.
+#
+# The event loop only packs records into a buffer; HistoryWriter writes the
+# buffer in batches from a worker thread. One writer per directory: a second
+# one would number the devices on its own and interleave out-of-order records
+# into the day files, so the writer holds a lock file (writer.lock) while open.
+
+HISTORY_DIR = "light_history"
+HISTORY_VERSION = 1
+DEVICES_FILE = "devices.json"
+LOCK_FILE = "writer.lock"
+DAY_SUFFIX = ".hist"
+
+# time (unix seconds), device number, outcome, state flags, r, g, b, luminance, round-trip in ms
+RECORD = struct.Struct("<dIBBBBBBf")
+
+# State flags: whether the light is on, and which of the state fields are known
+IS_ON = 1
+ONOFF_KNOWN = 2
+RGB_KNOWN = 4
+LUMINANCE_KNOWN = 8
+
+OK = 0
+FAILED = 1
+TIMEOUT = 2
+OUTCOMES = {OK: "ok", FAILED: "failed", TIMEOUT: "timeout"}
+
+HistoryRecord = namedtuple("HistoryRecord", "time uuid name outcome onoff rgb luminance latency_ms")
+
+
+def day_of(t: float) -> str:
+    return datetime.datetime.fromtimestamp(t, datetime.timezone.utc).strftime("%Y-%m-%d")
+
+
+def _day_start(day: str) -> float:
+    return datetime.datetime.strptime(day, "%Y-%m-%d").replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+def _light_state(light):
+    """The cached state of a light as (flags, rgb, luminance); fields the light cannot tell are left out of the flags."""
+    flags = 0
+    rgb = (0, 0, 0)
+    luminance = 0
+    try:
+        flags |= ONOFF_KNOWN | (IS_ON if light.get_light_is_on() else 0)
+        if light.get_supports_rgb() and light.get_rgb_color() is not None:
+            rgb = tuple(int(c) for c in light.get_rgb_color())
+            flags |= RGB_KNOWN
+        if light.get_supports_luminance() and light.get_luminance() is not None:
+            luminance = int(light.get_luminance())
+            flags |= LUMINANCE_KNOWN
+    except Exception:
+        pass
+    return flags, rgb, luminance
+
+
+class HistoryLockedError(Exception):
+    """Another process is already writing to the history directory."""
+
+
+def _lock_directory(directory: str):
+    """Take the writer lock of a history directory. Returns the open lock file; the lock goes with it."""
+    path = os.path.join(directory, LOCK_FILE)
+    f = open(path, 'a+')
+    try:
+        if os.name == "nt":
+            import msvcrt
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        raise HistoryLockedError(f"The light history in '{directory}' is already being written by another process")
+    return f
+
+
+def _load_devices(directory: str) -> list:
+    path = os.path.join(directory, DEVICES_FILE)
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r') as f:
+        data = json.load(f)
+    if data.get("version") != HISTORY_VERSION:
+        raise ValueError(f"Unsupported history version: {data.get('version')}")
+    return data["devices"]
+
+
+class HistoryWriter:
+    """Buffers history records on the event loop and appends them to the day files in batches, off the loop."""
+
+    def __init__(self, directory: str = HISTORY_DIR, flush_interval: float = 2.0, sample_interval: float = 10.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.sample_interval = sample_interval
+        os.makedirs(directory, exist_ok=True)
+        self._lock = _lock_directory(directory)
+        try:
+            self._devices = _load_devices(directory)
+        except Exception:
+            self._lock.close()
+            raise
+        self._numbers = {device["uuid"]: i for i, device in enumerate(self._devices)}
+        self._devices_dirty = False
+        self._buffer = []
+        self._last_time = 0.0
+        # uuid -> (time, outcome, on) of the light's last record
+        self._last_recorded = {}
+        self._task = None
+        self._writing = None
+        self.records = 0
+        self.batches = 0
+
+    def _device_number(self, light) -> int:
+        number = self._numbers.get(light.uuid)
+        if number is None:
+            number = len(self._devices)
+            self._devices.append({"uuid": light.uuid, "name": light.name})
+            self._numbers[light.uuid] = number
+            self._devices_dirty = True
+        return number
+
+    def record(self, light, outcome: int, latency: float = None, changes_only: bool = False):
+        """Queue one record for a command that just finished. Cheap enough for every command.
+
+        changes_only=True skips the record unless the light switched on or off, the outcome changed or
+        sample_interval passed since the light's last record, e.g. for effect frames.
+        """
+        # Records of a day file must stay in time order, even if the wall clock steps back
+        now = max(time.time(), self._last_time)
+        flags, (r, g, b), luminance = _light_state(light)
+        on = bool(flags & IS_ON) if flags & ONOFF_KNOWN else None
+        last = self._last_recorded.get(light.uuid)
+        if changes_only and last is not None and last[1:] == (outcome, on) and now - last[0] < self.sample_interval:
+            return
+        self._last_recorded[light.uuid] = (now, outcome, on)
+        self._last_time = now
+        latency_ms = latency * 1000 if latency is not None else math.nan
+        self._buffer.append((now, RECORD.pack(now, self._device_number(light), outcome, flags, r, g, b, luminance,
+                                              latency_ms)))
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        # One write at a time, in order: a write of a cancelled flush keeps running in its thread
+        if self._writing is not None:
+            await asyncio.wait({self._writing})
+        if not self._buffer:
+            return
+        batch, self._buffer = self._buffer, []
+        devices = list(self._devices) if self._devices_dirty else None
+        self._devices_dirty = False
+        self._writing = asyncio.get_running_loop().run_in_executor(None, self._write, batch, devices)
+        await asyncio.shield(self._writing)
+
+    def _write(self, batch: list, devices: list = None):
+        # The device table goes first, so a day file never refers to a device number the table lacks
+        if devices is not None:
+            path = os.path.join(self.directory, DEVICES_FILE)
+            with open(path + ".tmp", 'w') as f:
+                json.dump({"version": HISTORY_VERSION, "devices": devices}, f, indent=2)
+            os.replace(path + ".tmp", path)
+        by_day = {}
+        for t, data in batch:
+            by_day.setdefault(day_of(t), []).append(data)
+        for day, records in by_day.items():
+            with open(os.path.join(self.directory, day + DAY_SUFFIX), 'ab') as f:
+                f.write(b"".join(records))
+        self.records += len(batch)
+        self.batches += 1
+
+    async def close(self):
+        """Stop the periodic flush, write what is still buffered and release the directory."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        try:
+            await self.flush()
+        finally:
+            self._lock.close()
+        if self.records:
+            logging.info(f"History: {self.records} record(s) written in {self.batches} batch(es) to {self.directory}.")
+
+
+class HistoryStore:
+    """Time-range queries over a history directory."""
+
+    def __init__(self, directory: str = HISTORY_DIR):
+        self.directory = directory
+        self.devices = _load_devices(directory)
+
+    def days(self) -> list:
+        return sorted(name[:-len(DAY_SUFFIX)] for name in os.listdir(self.directory) if name.endswith(DAY_SUFFIX))
+
+    def _day_records(self, day: str, start: float, end: float) -> list:
+        """Decode the records of one day file with start <= time < end."""
+        path = os.path.join(self.directory, day + DAY_SUFFIX)
+        size = os.path.getsize(path)
+        count = size // RECORD.size
+        if not count:
+            return []
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), count * RECORD.size, access=mmap.ACCESS_READ) as view:
+            def time_at(i):
+                return struct.unpack_from("<d", view, i * RECORD.size)[0]
+
+            lo = bisect.bisect_left(range(count), start, key=time_at)
+            hi = bisect.bisect_left(range(count), end, lo=lo, key=time_at)
+            return list(RECORD.iter_unpack(view[lo * RECORD.size:hi * RECORD.size]))
+
+    def _decode(self, raw: tuple) -> HistoryRecord:
+        t, number, outcome, flags, r, g, b, luminance, latency_ms = raw
+        device = self._device(number)
+        return HistoryRecord(t, device["uuid"], device["name"], OUTCOMES.get(outcome, str(outcome)),
+                             bool(flags & IS_ON) if flags & ONOFF_KNOWN else None,
+                             (r, g, b) if flags & RGB_KNOWN else None,
+                             luminance if flags & LUMINANCE_KNOWN else None,
+                             None if math.isnan(latency_ms) else round(latency_ms, 1))
+
+    def _device(self, number: int) -> dict:
+        # A record written after the last device table update still gets a name
+        if number < len(self.devices):
+            return self.devices[number]
+        return {"uuid": f"#{number}", "name": f"#{number}"}
+
+    def _numbers(self, uuids) -> set:
+        if uuids is None:
+            return None
+        wanted = set(uuids)
+        return {i for i, device in enumerate(self.devices) if device["uuid"] in wanted}
+
+    def _raw_range(self, start: float, end: float, numbers: set = None):
+        for day in self.days():
+            day_start = _day_start(day)
+            if day_start + 86400 <= start or day_start >= end:
+                continue
+            for raw in self._day_records(day, start, end):
+                if numbers is None or raw[1] in numbers:
+                    yield raw
+
+    def query(self, start: float, end: float, uuids: list = None):
+        """Yield the records with start <= time < end, oldest first, optionally only for some devices."""
+        for raw in self._raw_range(start, end, self._numbers(uuids)):
+            yield self._decode(raw)
+
+    def _last_known(self, before: float, numbers: set = None, lookback_days: int = 31) -> dict:
+        """Return {device number: raw record} of the last record before a time, looking back a limited number of days."""
+        last = {}
+        days = [day for day in self.days() if _day_start(day) < before][-lookback_days:]
+        for day in reversed(days):
+            for raw in reversed(self._day_records(day, 0.0, before)):
+                if (numbers is None or raw[1] in numbers) and raw[1] not in last:
+                    last[raw[1]] = raw
+            if numbers is not None and len(last) == len(numbers):
+                break
+        return last
+
+    def summary(self, start: float, end: float, uuids: list = None) -> dict:
+        """Per device over a time range: commands, failures, timeouts, mean round-trip and the time it was on."""
+        numbers = self._numbers(uuids)
+        report = {}
+        state = {}
+        for number, raw in self._last_known(start, numbers).items():
+            state[number] = (start, bool(raw[3] & IS_ON))
+
+        def entry(number):
+            device = self._device(number)
+            return report.setdefault(number, {"uuid": device["uuid"], "name": device["name"], "commands": 0,
+                                              "failed": 0, "timeouts": 0, "latency_sum": 0.0, "latency_count": 0,
+                                              "on_seconds": 0.0})
+
+        for t, number, outcome, flags, *_, latency_ms in self._raw_range(start, end, numbers):
+            stats = entry(number)
+            stats["commands"] += 1
+            if outcome == FAILED:
+                stats["failed"] += 1
+            elif outcome == TIMEOUT:
+                stats["timeouts"] += 1
+            if not math.isnan(latency_ms):
+                stats["latency_sum"] += latency_ms
+                stats["latency_count"] += 1
+            since, was_on = state.get(number, (t, False))
+            if was_on:
+                stats["on_seconds"] += t - since
+            state[number] = (t, bool(flags & IS_ON) if flags & ONOFF_KNOWN else was_on)
+        until = min(end, time.time())
+        for number, (since, was_on) in state.items():
+            if was_on and until > since:
+                entry(number)["on_seconds"] += until - since
+
+        result = {}
+        for stats in report.values():
+            count = stats.pop("latency_count")
+            total = stats.pop("latency_sum")
+            stats["latency_ms"] = round(total / count, 1) if count else None
+            stats["on_seconds"] = round(stats["on_seconds"], 1)
+            result[stats["uuid"]] = stats
+        return result
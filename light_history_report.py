@@ -0,0 +1,92 @@
+import argparse
+import datetime
+import fnmatch
+import os
+import re
+import sys
+import time
+from light_history import HISTORY_DIR, HistoryStore
+
+DURATION = re.compile(r"^(\d+(?:\.\d+)?)([smhdw])$")
+UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 7 * 86400}
+
+def parse_time(value: str, now: float) -> float:
+    """A time given as a span back from now (30m, 12h, 7d, 4w) or as an ISO date or date and time (local time)."""
+    match = DURATION.match(value)
+    if match:
+        return now - float(match.group(1)) * UNITS[match.group(2)]
+    try:
+        return datetime.datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"'{value}' is neither a span like 7d nor an ISO date")
+
+def format_time(t: float) -> str:
+    return datetime.datetime.fromtimestamp(t).isoformat(sep=' ', timespec='seconds')
+
+def format_duration(seconds: float) -> str:
+    hours, rest = divmod(int(seconds), 3600)
+    return f"{hours}h{rest // 60:02d}m"
+
+def main():
+    parser = argparse.ArgumentParser(description="Report when lights were on, in which color, and how often their commands failed, from the light history.")
+    parser.add_argument("--history-dir", default=HISTORY_DIR, help=f"The history directory (default: {HISTORY_DIR}).")
+    parser.add_argument("--since", default="1d", help="Start of the range: a span back from now such as 12h, 7d or 4w, or an ISO date (default: 1d).")
+    parser.add_argument("--until", help="End of the range, in the same forms as --since (default: now).")
+    parser.add_argument("--light-names", nargs='+', help="Only these lights, by name or uuid; glob patterns are accepted (default: all lights).")
+    parser.add_argument("--records", action="store_true", help="List every record of the range instead of the per-light summary.")
+    parser.add_argument("--failures", action="store_true", help="With --records, list only failed and timed out commands.")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.history_dir):
+        print(f"Error: History directory '{args.history_dir}' not found. Run meross_gui_app.py or schedule_lights.py with --history-dir first.", file=sys.stderr)
+        sys.exit(1)
+    now = time.time()
+    try:
+        start = parse_time(args.since, now)
+        end = parse_time(args.until, now) if args.until else now
+    except argparse.ArgumentTypeError as e:
+        print(f"Error: {e}.", file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        store = HistoryStore(args.history_dir)
+    except ValueError as e:
+        print(f"Error: {e} in '{args.history_dir}'.", file=sys.stderr)
+        sys.exit(1)
+    uuids = None
+    if args.light_names:
+        uuids = [device["uuid"] for device in store.devices
+                 if any(fnmatch.fnmatch(device["name"], pattern) or device["uuid"] == pattern
+                        for pattern in args.light_names)]
+        if not uuids:
+            print(f"Error: No light in the history matches {args.light_names}.", file=sys.stderr)
+            sys.exit(1)
+
+    print(f"Light history from {format_time(start)} to {format_time(end)}:")
+    if args.records:
+        count = 0
+        for record in store.query(start, end, uuids):
+            if args.failures and record.outcome == "ok":
+                continue
+            state = "unknown" if record.onoff is None else "on" if record.onoff else "off"
+            color = f" rgb{record.rgb}" if record.rgb and record.onoff else ""
+            luminance = f" {record.luminance}%" if record.luminance is not None and record.onoff else ""
+            latency = f" in {record.latency_ms} ms" if record.latency_ms is not None else ""
+            print(f"  {format_time(record.time)}  {record.name}: {record.outcome}{latency}, {state}{color}{luminance}")
+            count += 1
+        print(f"{count} record(s).")
+        return
+
+    summary = store.summary(start, end, uuids)
+    if not summary:
+        print("  No commands in this range.")
+        return
+    for stats in sorted(summary.values(), key=lambda s: s["name"]):
+        failed = stats["failed"] + stats["timeouts"]
+        rate = failed / stats["commands"] * 100 if stats["commands"] else 0.0
+        latency = f", mean round-trip {stats['latency_ms']} ms" if stats["latency_ms"] is not None else ""
+        print(f"  {stats['name']}: on for {format_duration(stats['on_seconds'])}, {stats['commands']} command(s), "
+              f"{failed} failed ({stats['timeouts']} timeouts, {rate:.1f}%){latency}")
+
+if __name__ == "__main__":
+    main()
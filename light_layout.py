@@ -0,0 +1,117 @@
+import json
+import logging
+
+import numpy as np
+
+from audio_features import hsv_to_rgb
+
+# Spatial layout of the lights and the position based effects built on it.
+#
+# A layout file gives every light a 2D or 3D position. The positions of the
+# lights an effect drives are gathered once into an (n, 3) array, and every
+# effect frame is a handful of numpy operations over that array, so computing a
+# frame stays in the microseconds even for hundreds of lights.
+#
+# Layout file format:
+#     {"version": 1, "lights": {"<uuid or light name>": [x, y] or [x, y, z], ...}}
+
+LAYOUT_VERSION = 1
+
+
+def load_layout(path: str) -> dict:
+    """Return {uuid or name: (x, y, z)} from a layout file."""
+    with open(path, 'r') as f:
+        data = json.load(f)
+    if data.get("version") != LAYOUT_VERSION:
+        raise ValueError(f"Unsupported layout file version: {data.get('version')}")
+    positions = {}
+    for key, coords in data["lights"].items():
+        if len(coords) not in (2, 3):
+            raise ValueError(f"Position of '{key}' must have 2 or 3 coordinates, got {coords}")
+        positions[key] = tuple(float(c) for c in coords) + (0.0,) * (3 - len(coords))
+    return positions
+
+
+def layout_coordinates(lights: list, positions: dict = None) -> np.ndarray:
+    """Return the (n, 3) positions of the lights, scaled so the layout spans [0, 1] on its longest axis.
+
+    Lights are looked up by uuid, then by name (case-insensitive). Lights the
+    layout does not mention, or all lights when there is no layout, are placed
+    on a line along x after the known ones.
+    """
+    positions = positions or {}
+    by_name = {str(key).lower(): value for key, value in positions.items()}
+    coords = np.zeros((len(lights), 3))
+    missing = []
+    for i, light in enumerate(lights):
+        position = positions.get(light.uuid) or by_name.get(light.name.lower())
+        if position is None:
+            missing.append(i)
+        else:
+            coords[i, :len(position)] = position
+    if missing:
+        if len(missing) < len(lights):
+            logging.warning(f"No layout position for {[lights[i].name for i in missing]}, placing them in a row.")
+        known = np.setdiff1d(np.arange(len(lights)), missing)
+        start = coords[known, 0].max() + 1.0 if known.size else 0.0
+        coords[missing, 0] = start + np.arange(len(missing))
+
+    low = coords.min(axis=0)
+    extent = float((coords.max(axis=0) - low).max())
+    return (coords - low) / extent if extent > 0 else coords - low
+
+
+def _unit(vector) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float64)
+    vector = np.pad(vector, (0, 3 - vector.shape[0]))
+    norm = np.linalg.norm(vector)
+    if norm == 0:
+        raise ValueError("Direction must not be a zero vector")
+    return vector / norm
+
+
+def wave(coords: np.ndarray, t: float, direction=(1.0, 0.0), wavelength: float = 0.5,
+         speed: float = 0.25, hue_spread: float = 0.3, base_hue: float = 0.0):
+    """A plane wave of brightness and hue travelling along direction. Returns (rgb, brightness)."""
+    along = coords @ _unit(direction)
+    phase = (along - speed * t) / wavelength
+    brightness = 0.5 + 0.5 * np.cos(2.0 * np.pi * phase)
+    hues = base_hue + hue_spread * (phase % 1.0)
+    return hsv_to_rgb(hues), brightness
+
+
+def radial_pulse(coords: np.ndarray, t: float, center=None, speed: float = 0.5, width: float = 0.15,
+                 period: float = 2.0, hue: float = 0.6):
+    """Rings expanding from center every period seconds. Returns (rgb, brightness)."""
+    if center is None:
+        center = (coords.min(axis=0) + coords.max(axis=0)) / 2.0
+    center = np.pad(np.asarray(center, dtype=np.float64), (0, 3 - len(center)))
+    distance = np.linalg.norm(coords - center, axis=1)
+    # Distance of every light to the closest ring currently travelling outwards
+    spacing = speed * period
+    offset = (distance - speed * t) % spacing
+    to_ring = np.minimum(offset, spacing - offset)
+    brightness = np.exp(-0.5 * (to_ring / width) ** 2)
+    return hsv_to_rgb(np.full(coords.shape[0], hue)), brightness
+
+
+def gradient(coords: np.ndarray, t: float, direction=(1.0, 0.0), speed: float = 0.1,
+             hue_start: float = 0.0, hue_end: float = 0.8):
+    """A hue gradient along direction that slowly scrolls. Returns (rgb, brightness)."""
+    along = coords @ _unit(direction)
+    position = (along - speed * t) % 1.0
+    # Mirror the position so the gradient scrolls without a hard seam
+    position = 1.0 - np.abs(2.0 * position - 1.0)
+    hues = hue_start + (hue_end - hue_start) * position
+    return hsv_to_rgb(hues), np.ones(coords.shape[0])
+
+
+EFFECTS = {
+    "wave": wave,
+    "radial": radial_pulse,
+    "gradient": gradient,
+}
+
+
+def brightness_to_luminance(brightness: np.ndarray, min_luminance: int = 1) -> np.ndarray:
+    return np.clip(np.rint(brightness * 100.0), min_luminance, 100).astype(np.int64)
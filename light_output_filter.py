@@ -0,0 +1,146 @@
+import logging
+
+# Per-device output filter that sits between the effects and the bulbs.
+#
+# Every requested update is first quantized to what the bulb can actually
+# render, then compared field by field against the last value the device
+# acknowledged. Fields that did not change by at least the configured delta are
+# dropped, and an update with no remaining fields is not sent at all. The
+# quantized values are only used for that comparison; the color that is sent is
+# the one requested.
+
+
+def quantize_rgb(rgb: tuple, color_step: int = 1) -> tuple:
+    """Quantize an (r, g, b) tuple to a color the bulb renders differently.
+
+    Meross bulbs take brightness from the luminance field, so the color is only
+    hue and saturation: (128, 0, 0) renders exactly like (255, 0, 0). Colors are
+    therefore scaled so that the brightest channel is 255, then snapped to
+    multiples of color_step.
+    """
+    r, g, b = (max(0, min(255, int(round(c)))) for c in rgb)
+    peak = max(r, g, b)
+    if peak == 0:
+        return (0, 0, 0)
+    scale = 255.0 / peak
+    channels = [int(round(c * scale)) for c in (r, g, b)]
+    if color_step > 1:
+        channels = [min(255, int(round(c / color_step)) * color_step) for c in channels]
+    return tuple(channels)
+
+
+def quantize_luminance(luminance: float, luminance_step: int = 1) -> int:
+    """Clamp luminance to the 0-100 range the bulbs accept and snap it to luminance_step."""
+    value = int(round(luminance))
+    if luminance_step > 1:
+        value = int(round(value / luminance_step)) * luminance_step
+    return max(0, min(100, value))
+
+
+class LightOutputFilter:
+    """Drops light updates that would not visibly change a bulb.
+
+    filter() returns the dict of fields (onoff, rgb, luminance) that still need
+    to be sent. They become the device's current state once commit() is called
+    after the send succeeded; call forget() for a device whose command failed
+    so the next update is sent in full, and discard() when it was never sent.
+    """
+
+    def __init__(self, luminance_threshold: int = 1, color_threshold: int = 1,
+                 luminance_step: int = 1, color_step: int = 1):
+        self.luminance_threshold = luminance_threshold
+        self.color_threshold = color_threshold
+        self.luminance_step = luminance_step
+        self.color_step = color_step
+        self._last_sent = {}
+        # Quantized values returned by filter() that were not acknowledged yet
+        self._unconfirmed = {}
+        self.requested_updates = 0
+        self.sent_updates = 0
+        self.requested_fields = 0
+        self.sent_fields = 0
+
+    def seed(self, light):
+        """Start from the state the device reported, so the first update is filtered too."""
+        state = {}
+        is_on = light.is_on() if hasattr(light, "is_on") else None
+        if is_on is not None:
+            state["onoff"] = bool(is_on)
+        if _supports(light, "get_supports_rgb"):
+            rgb = light.get_rgb_color()
+            if rgb is not None:
+                state["rgb"] = quantize_rgb(rgb, self.color_step)
+        if _supports(light, "get_supports_luminance"):
+            luminance = light.get_luminance()
+            if luminance is not None:
+                state["luminance"] = quantize_luminance(luminance, self.luminance_step)
+        self._last_sent[light.uuid] = state
+
+    def commit(self, light):
+        """Record the fields last returned by filter() for the device as sent."""
+        self._last_sent.setdefault(light.uuid, {}).update(self._unconfirmed.pop(light.uuid, {}))
+
+    def discard(self, light):
+        """Drop the fields last returned by filter() for the device, when they were never sent."""
+        self._unconfirmed.pop(light.uuid, None)
+
+    def forget(self, light):
+        self._last_sent.pop(light.uuid, None)
+        self._unconfirmed.pop(light.uuid, None)
+
+    def filter(self, light, onoff: bool = None, rgb: tuple = None, luminance: float = None) -> dict:
+        requested = {}
+        to_send = {}
+        if onoff is not None:
+            requested["onoff"] = bool(onoff)
+        if rgb is not None and _supports(light, "get_supports_rgb"):
+            requested["rgb"] = quantize_rgb(rgb, self.color_step)
+            to_send["rgb"] = tuple(max(0, min(255, int(round(c)))) for c in rgb)
+        if luminance is not None and _supports(light, "get_supports_luminance"):
+            requested["luminance"] = quantize_luminance(luminance, self.luminance_step)
+
+        last = self._last_sent.get(light.uuid, {})
+        changes = {}
+        for field, value in requested.items():
+            previous = last.get(field)
+            if previous is None or self._differs(field, previous, value):
+                changes[field] = value
+
+        self.requested_updates += 1
+        self.requested_fields += len(requested)
+        if changes:
+            self.sent_updates += 1
+            self.sent_fields += len(changes)
+            self._unconfirmed.setdefault(light.uuid, {}).update(changes)
+        return {field: to_send.get(field, value) for field, value in changes.items()}
+
+    def _differs(self, field: str, previous, value) -> bool:
+        if field == "luminance":
+            return abs(value - previous) >= self.luminance_threshold
+        if field == "rgb":
+            return max(abs(a - b) for a, b in zip(value, previous)) >= self.color_threshold
+        return value != previous
+
+    def stats(self) -> dict:
+        return {
+            "requested_updates": self.requested_updates,
+            "sent_updates": self.sent_updates,
+            "suppressed_updates": self.requested_updates - self.sent_updates,
+            "requested_fields": self.requested_fields,
+            "sent_fields": self.sent_fields,
+        }
+
+    def log_summary(self):
+        if not self.requested_updates:
+            return
+        suppressed = self.requested_updates - self.sent_updates
+        saved = 100.0 * suppressed / self.requested_updates
+        logging.info(f"Output filter: sent {self.sent_updates} of {self.requested_updates} updates "
+                     f"({suppressed} suppressed, {saved:.0f}% saved), "
+                     f"{self.sent_fields} of {self.requested_fields} fields.")
+
+
+def _supports(light, capability: str) -> bool:
+    # Objects without capability information (e.g. test doubles) are assumed to support everything
+    check = getattr(light, capability, None)
+    return check() if check is not None else True
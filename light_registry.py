@@ -0,0 +1,160 @@
+import fnmatch
+import json
+import logging
+import os
+
+from meross_iot.controller.mixins.light import LightMixin
+from meross_iot.model.enums import OnlineStatus
+
+# Light lookup by name, alias, uuid, tag and group.
+#
+# The registry indexes the discovered lights once, so resolving a name, alias,
+# uuid, tag or group is a dictionary lookup. Only glob patterns scan the names.
+# It works on device objects as well as on the HTTP device list, which lets the
+# targeted discovery resolve selectors before any device is initialized.
+#
+# Selectors:
+#     Desk Lamp        name or alias (case-insensitive)
+#     <uuid>           device uuid
+#     group:kitchen    every selector of a group from the registry file
+#     tag:rgb          lights with a tag (device type, online/offline, rgb/luminance/temperature, or from the file)
+#     Desk*            glob pattern over the names
+#
+# Registry file format (all sections optional):
+#     {"version": 1,
+#      "aliases": {"desk": "Desk Lamp"},
+#      "groups": {"kitchen": ["Lamp 1", "Lamp 2"], "downstairs": ["group:kitchen", "tag:hall"]},
+#      "tags": {"Desk Lamp": ["office"]}}
+
+REGISTRY_FILE = "light_groups.json"
+REGISTRY_VERSION = 1
+
+# Tags that are only known once a device is initialized, not from the HTTP device list
+CAPABILITY_TAGS = ("rgb", "luminance", "temperature")
+
+_GLOB_CHARS = set("*?[")
+
+
+def load_registry_config(path: str = REGISTRY_FILE) -> dict:
+    """Load the registry file. A missing default file simply means no aliases, groups or tags."""
+    if not os.path.exists(path):
+        if path != REGISTRY_FILE:
+            raise FileNotFoundError(f"Registry file '{path}' not found")
+        return {}
+    with open(path, 'r') as f:
+        config = json.load(f)
+    if not isinstance(config, dict):
+        raise ValueError("The registry file must contain a JSON object")
+    if config.get("version") != REGISTRY_VERSION:
+        raise ValueError(f"Unsupported registry file version: {config.get('version')}")
+    return config
+
+
+def _name_of(device) -> str:
+    # Device objects have name, entries of the HTTP device list have dev_name
+    name = getattr(device, "name", None)
+    return name if name is not None else device.dev_name
+
+
+def _builtin_tags(device) -> set:
+    tags = set()
+    device_type = getattr(device, "type", None) or getattr(device, "device_type", None)
+    if device_type:
+        tags.add(device_type.casefold())
+    status = getattr(device, "online_status", None)
+    if status is not None:
+        tags.add("online" if status == OnlineStatus.ONLINE else "offline")
+    if isinstance(device, LightMixin):
+        for tag, supported in (("rgb", device.get_supports_rgb()), ("luminance", device.get_supports_luminance()),
+                               ("temperature", device.get_supports_temperature())):
+            if supported:
+                tags.add(tag)
+    return tags
+
+
+def uses_capability_tags(selectors: list, config: dict = None) -> bool:
+    """Tell if resolving the selectors needs initialized devices (capability tags, possibly inside groups)."""
+    groups = {name.casefold(): members for name, members in (config or {}).get("groups", {}).items()}
+    pending = list(selectors)
+    seen = set()
+    while pending:
+        selector = pending.pop()
+        kind, _, value = selector.partition(":")
+        kind = kind.casefold()
+        if kind == "tag" and value.casefold() in CAPABILITY_TAGS:
+            return True
+        if kind == "group" and value.casefold() not in seen:
+            seen.add(value.casefold())
+            pending.extend(groups.get(value.casefold(), []))
+    return False
+
+
+class LightRegistry:
+    """Indexes devices by case-folded name, alias, uuid and tag, and resolves selectors against them."""
+
+    def __init__(self, devices: list, config: dict = None):
+        config = config or {}
+        self.devices = list(devices)
+        self._by_uuid = {}
+        self._by_name = {}
+        self._by_tag = {}
+        self._groups = {name.casefold(): list(members) for name, members in config.get("groups", {}).items()}
+        for device in self.devices:
+            self._by_uuid[device.uuid] = device
+            self._by_name.setdefault(_name_of(device).casefold(), []).append(device)
+            for tag in _builtin_tags(device):
+                self._by_tag.setdefault(tag, []).append(device)
+        for key, tags in config.get("tags", {}).items():
+            for device in self._lookup(key):
+                for tag in tags:
+                    self._by_tag.setdefault(tag.casefold(), []).append(device)
+        self._by_alias = {}
+        for alias, target in config.get("aliases", {}).items():
+            matches = self._lookup(target)
+            if matches:
+                self._by_alias[alias.casefold()] = matches
+            else:
+                logging.debug(f"Alias '{alias}' points to '{target}', which was not discovered.")
+
+    def _lookup(self, key: str) -> list:
+        device = self._by_uuid.get(key)
+        if device is not None:
+            return [device]
+        return self._by_name.get(key.casefold(), [])
+
+    def resolve(self, selector: str, _seen: set = None) -> list:
+        """Return the devices a single selector stands for."""
+        kind, sep, value = selector.partition(":")
+        if sep:
+            kind = kind.casefold()
+            if kind == "tag":
+                return list(self._by_tag.get(value.casefold(), []))
+            if kind == "group":
+                key = value.casefold()
+                _seen = _seen or set()
+                if key in _seen:
+                    logging.warning(f"Group '{value}' includes itself, ignoring the loop.")
+                    return []
+                members = self._groups.get(key)
+                if members is None:
+                    return []
+                matches = []
+                for member in members:
+                    matches.extend(self.resolve(member, _seen | {key}))
+                return matches
+        matches = self._lookup(selector) or self._by_alias.get(selector.casefold(), [])
+        if not matches and _GLOB_CHARS & set(selector):
+            pattern = selector.casefold()
+            matches = [device for device in self.devices if fnmatch.fnmatchcase(_name_of(device).casefold(), pattern)]
+        return list(matches)
+
+    def select(self, selectors: list) -> list:
+        """Resolve several selectors. Returns the devices in selector order, each device once."""
+        selected = {}
+        for selector in selectors:
+            matches = self.resolve(selector)
+            if not matches:
+                logging.warning(f"Light '{selector}' not found.")
+            for device in matches:
+                selected.setdefault(device.uuid, device)
+        return list(selected.values())
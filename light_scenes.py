@@ -0,0 +1,118 @@
+import asyncio
+import json
+import logging
+import time
+
+from light_commands import async_send_light_state
+
+# Scene snapshots: the on/off state, color and luminance of a set of lights.
+#
+# A snapshot is read from the state meross_iot already caches for every device,
+# so taking one right after the usual async_update() costs nothing. Restoring
+# compares the snapshot with the cached current state and only sends the
+# fields that differ, one combined message per light.
+
+SCENE_VERSION = 1
+
+
+def snapshot_scene(lights: list) -> dict:
+    """Build a scene from the cached state of the lights (no network traffic)."""
+    scene = {}
+    for light in lights:
+        state = {"name": light.name}
+        is_on = light.get_light_is_on()
+        if is_on is not None:
+            state["on"] = 1 if is_on else 0
+        rgb = light.get_rgb_color() if light.get_supports_rgb() else None
+        if rgb is not None:
+            state["rgb"] = (rgb[0] << 16) | (rgb[1] << 8) | rgb[2]
+        luminance = light.get_luminance() if light.get_supports_luminance() else None
+        if luminance is not None:
+            state["lum"] = luminance
+        scene[light.uuid] = state
+    return scene
+
+
+async def capture_scene(lights: list, executor=None) -> dict:
+    """Refresh all lights concurrently, then snapshot them."""
+    if executor is not None:
+        await executor.run_all(lights, lambda light: light.async_update())
+    else:
+        await asyncio.gather(*(light.async_update() for light in lights))
+    return snapshot_scene(lights)
+
+
+def save_scene(scene: dict, path: str):
+    with open(path, 'w') as f:
+        json.dump({"version": SCENE_VERSION, "captured_at": int(time.time()), "lights": scene},
+                  f, separators=(',', ':'))
+
+
+def load_scene(path: str) -> dict:
+    with open(path, 'r') as f:
+        data = json.load(f)
+    if data.get("version") != SCENE_VERSION:
+        raise ValueError(f"Unsupported scene file version: {data.get('version')}")
+    return data["lights"]
+
+
+def scene_diff(lights: list, scene: dict) -> dict:
+    """Return {uuid: fields} with only the changes needed to bring the lights back to the scene."""
+    current = snapshot_scene(lights)
+    diff = {}
+    for light in lights:
+        target = scene.get(light.uuid)
+        if target is None:
+            continue
+        now = current.get(light.uuid, {})
+        if target.get("on") == 0:
+            # Nothing else matters for a light that should end up off
+            if now.get("on") != 0:
+                diff[light.uuid] = {"onoff": False}
+            continue
+        fields = {}
+        if target.get("on") == 1 and now.get("on") != 1:
+            fields["onoff"] = True
+        if "rgb" in target and target["rgb"] != now.get("rgb"):
+            value = target["rgb"]
+            fields["rgb"] = ((value >> 16) & 0xFF, (value >> 8) & 0xFF, value & 0xFF)
+        if "lum" in target and target["lum"] != now.get("lum"):
+            fields["luminance"] = target["lum"]
+        if fields:
+            diff[light.uuid] = fields
+    return diff
+
+
+async def restore_scene(lights: list, scene: dict, executor=None) -> int:
+    """Send the minimal set of commands that brings the lights back to the scene. Returns the number of lights changed."""
+    diff = scene_diff(lights, scene)
+    changed = [light for light in lights if light.uuid in diff]
+    if not changed:
+        logging.info("Scene already in place, nothing to restore.")
+        return 0
+
+    def send(light):
+        return async_send_light_state(light, **diff[light.uuid])
+
+    if executor is not None:
+        results = await executor.run_all(changed, send)
+        failed = [light.name for light in changed if not results[light.uuid]]
+        if failed:
+            logging.warning(f"Could not restore the scene on: {failed}")
+    else:
+        await asyncio.gather(*(send(light) for light in changed))
+    logging.info(f"Restored scene on {len(changed)} of {len(lights)} light(s).")
+    return len(changed)
+
+
+async def release_lights(lights: list, prior_scene: dict = None, executor=None):
+    """End an effect: put the prior scene back when one was captured, otherwise turn the lights off."""
+    if prior_scene is not None:
+        logging.info("Restoring the previous scene.")
+        await restore_scene(lights, prior_scene, executor)
+        return
+    logging.info("Turning off all lights.")
+    if executor is not None:
+        await executor.run_all(lights, lambda light: light.async_turn_off())
+    else:
+        await asyncio.gather(*(light.async_turn_off() for light in lights))
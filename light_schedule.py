@@ -0,0 +1,458 @@
+import asyncio
+import datetime
+import json
+import logging
+import math
+import time
+from collections import deque
+
+# Timed scenes and routines against warm device handles.
+#
+# A resident process keeps the lights discovered and runs the rules of a
+# schedule file, instead of cron paying login and discovery for every run.
+# Pending firings live in a hierarchical timer wheel: insert and cancel are
+# O(1), and a tick only touches the timers of one slot, so thousands of rules
+# cost next to nothing between firings. The wheel hands out timers one tick
+# early and each one is fired with loop.call_at() at its exact time, not at
+# the tick boundary. Recurring rules are re-armed from the time they were due,
+# not from when they ran, so they never drift.
+#
+# Schedule file format:
+#     {"version": 1,
+#      "location": {"latitude": 52.37, "longitude": 4.89},
+#      "rules": [
+#          {"name": "Porch on", "sunset": -15, "lights": ["Porch"], "action": "on"},
+#          {"name": "Porch off", "at": "23:30", "lights": ["Porch"], "action": "off"},
+#          {"name": "Wake up", "at": "07:00", "days": ["mon", "tue", "wed", "thu", "fri"],
+#           "lights": ["group:bedroom"], "action": "color", "color": "white", "luminance": 30},
+#          {"name": "Evening", "sunset": 0, "lights": ["tag:living"], "action": "scene", "scene_file": "evening.json"},
+#          {"name": "Heartbeat", "every": 900, "lights": ["Desk"], "action": "on"},
+#          {"name": "Party", "once": "2026-12-31T23:59:00", "lights": ["tag:rgb"], "action": "color", "color": "magenta"}]}
+# "sunrise"/"sunset" take an offset in minutes; "days" works with "at", "sunrise" and "sunset".
+
+SCHEDULE_FILE = "meross_schedule.json"
+SCHEDULE_VERSION = 1
+
+WEEKDAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+
+COLORS = {
+    "red": (255, 0, 0),
+    "green": (0, 255, 0),
+    "blue": (0, 0, 255),
+    "yellow": (255, 255, 0),
+    "cyan": (0, 255, 255),
+    "magenta": (255, 0, 255),
+    "white": (255, 255, 255),
+}
+
+# A firing more than this late is skipped and counted as missed (process suspended, clock jumped)
+MISFIRE_GRACE = 60.0
+# A firing more than this late is counted as late
+LATE_THRESHOLD = 1.0
+
+
+# ---- Sun position ----
+
+def sun_times(date: datetime.date, latitude: float, longitude: float):
+    """Return (sunrise, sunset) of a date as aware UTC datetimes, None for polar day or night.
+
+    The sunrise equation with the NOAA approximations, good to about a minute.
+    """
+    n = date.toordinal() - datetime.date(2000, 1, 1).toordinal()
+    mean_solar_noon = n - longitude / 360.0
+    anomaly = math.radians((357.5291 + 0.98560028 * mean_solar_noon) % 360)
+    center = 1.9148 * math.sin(anomaly) + 0.02 * math.sin(2 * anomaly) + 0.0003 * math.sin(3 * anomaly)
+    ecliptic = math.radians((math.degrees(anomaly) + center + 180 + 102.9372) % 360)
+    transit = mean_solar_noon + 0.0053 * math.sin(anomaly) - 0.0069 * math.sin(2 * ecliptic)
+    declination = math.asin(math.sin(ecliptic) * math.sin(math.radians(23.4397)))
+    phi = math.radians(latitude)
+    cos_hour_angle = ((math.sin(math.radians(-0.833)) - math.sin(phi) * math.sin(declination))
+                      / (math.cos(phi) * math.cos(declination)))
+    if not -1.0 <= cos_hour_angle <= 1.0:
+        return None
+    half_day = math.degrees(math.acos(cos_hour_angle)) / 360.0
+    epoch = datetime.datetime(2000, 1, 1, 12, tzinfo=datetime.timezone.utc)
+    return epoch + datetime.timedelta(days=transit - half_day), epoch + datetime.timedelta(days=transit + half_day)
+
+
+# ---- Triggers: next_after(t) returns the next firing strictly after wall time t, or None ----
+
+def _local_days_from(t: float, days: int = 370):
+    start = datetime.datetime.fromtimestamp(t).date()
+    for i in range(days):
+        yield start + datetime.timedelta(days=i)
+
+
+class DailyTrigger:
+    """A local time of day, optionally only on some weekdays."""
+
+    def __init__(self, at: datetime.time, days: set = None):
+        self.at = at
+        self.days = days
+
+    def next_after(self, t: float):
+        for date in _local_days_from(t):
+            if self.days is not None and date.weekday() not in self.days:
+                continue
+            when = datetime.datetime.combine(date, self.at).timestamp()
+            if when > t:
+                return when
+        return None
+
+    def __str__(self):
+        return f"at {self.at.isoformat()}"
+
+
+class SunTrigger:
+    """Sunrise or sunset, shifted by an offset in minutes."""
+
+    def __init__(self, event: str, offset: float, latitude: float, longitude: float, days: set = None):
+        self.event = event
+        self.offset = offset
+        self.latitude = latitude
+        self.longitude = longitude
+        self.days = days
+
+    def next_after(self, t: float):
+        # Start a day early: a late sunset shifted past midnight belongs to the previous date
+        for date in _local_days_from(t - 86400):
+            if self.days is not None and date.weekday() not in self.days:
+                continue
+            times = sun_times(date, self.latitude, self.longitude)
+            if times is None:
+                continue
+            when = times[0 if self.event == "sunrise" else 1].timestamp() + self.offset * 60
+            if when > t:
+                return when
+        return None
+
+    def __str__(self):
+        return f"{self.event} {self.offset:+g} min"
+
+
+class IntervalTrigger:
+    """Every so many seconds, on a grid that starts at start (default: the epoch, so restarts keep the phase)."""
+
+    def __init__(self, every: float, start: float = 0.0):
+        if every <= 0:
+            raise ValueError("'every' must be positive")
+        self.every = every
+        self.start = start
+
+    def next_after(self, t: float):
+        return self.start + (math.floor((t - self.start) / self.every) + 1) * self.every
+
+    def __str__(self):
+        return f"every {self.every:g}s"
+
+
+class OnceTrigger:
+    def __init__(self, at: float):
+        self.at = at
+
+    def next_after(self, t: float):
+        return self.at if self.at > t else None
+
+    def __str__(self):
+        return f"once at {datetime.datetime.fromtimestamp(self.at).isoformat()}"
+
+
+# ---- Rules ----
+
+class ScheduleRule:
+    """A trigger and what to do with which lights when it fires."""
+
+    def __init__(self, name: str, trigger, lights: list, action: str, rgb: tuple = None, luminance: int = None,
+                 scene_file: str = None):
+        self.name = name
+        self.trigger = trigger
+        self.lights = lights
+        self.action = action
+        self.rgb = rgb
+        self.luminance = luminance
+        self.scene_file = scene_file
+        self.fired = 0
+        self.missed = 0
+        self.late = 0
+        self.failed = 0
+        self.max_late = 0.0
+
+    def state(self) -> dict:
+        """The light state the rule sends, for the actions that are not a scene."""
+        if self.action == "off":
+            return {"onoff": False}
+        return {"onoff": True, "rgb": self.rgb, "luminance": self.luminance}
+
+
+def _parse_days(spec: dict):
+    days = spec.get("days")
+    if days is None:
+        return None
+    try:
+        return {WEEKDAYS.index(day[:3].lower()) for day in days}
+    except ValueError:
+        raise ValueError(f"Rule '{spec.get('name')}': days must be {', '.join(WEEKDAYS)}")
+
+
+def parse_rule(spec: dict, location: dict = None) -> ScheduleRule:
+    name = spec.get("name")
+    if not name:
+        raise ValueError("Every rule needs a name")
+    if "at" in spec:
+        trigger = DailyTrigger(datetime.time.fromisoformat(spec["at"]), _parse_days(spec))
+    elif "sunrise" in spec or "sunset" in spec:
+        if not location or "latitude" not in location or "longitude" not in location:
+            raise ValueError(f"Rule '{name}': sunrise and sunset need a location with latitude and longitude")
+        event = "sunrise" if "sunrise" in spec else "sunset"
+        trigger = SunTrigger(event, float(spec[event]), float(location["latitude"]), float(location["longitude"]),
+                             _parse_days(spec))
+    elif "every" in spec:
+        start = datetime.datetime.fromisoformat(spec["start"]).timestamp() if "start" in spec else 0.0
+        trigger = IntervalTrigger(float(spec["every"]), start)
+    elif "once" in spec:
+        trigger = OnceTrigger(datetime.datetime.fromisoformat(spec["once"]).timestamp())
+    else:
+        raise ValueError(f"Rule '{name}' needs one of 'at', 'sunrise', 'sunset', 'every' or 'once'")
+
+    action = spec.get("action", "on")
+    rgb = None
+    if action == "color":
+        color = spec.get("color")
+        rgb = COLORS.get(color.lower()) if isinstance(color, str) else tuple(color) if color else None
+        if rgb is None:
+            raise ValueError(f"Rule '{name}': unknown color {color!r}, use one of {list(COLORS)} or [r, g, b]")
+    elif action == "scene":
+        if not spec.get("scene_file"):
+            raise ValueError(f"Rule '{name}': the scene action needs a scene_file")
+    elif action not in ("on", "off"):
+        raise ValueError(f"Rule '{name}': unknown action {action!r}")
+    return ScheduleRule(name, trigger, spec.get("lights", []), action, rgb, spec.get("luminance"),
+                        spec.get("scene_file"))
+
+
+def load_schedule(path: str = SCHEDULE_FILE) -> list:
+    with open(path, 'r') as f:
+        data = json.load(f)
+    if data.get("version") != SCHEDULE_VERSION:
+        raise ValueError(f"Unsupported schedule file version: {data.get('version')}")
+    rules = [parse_rule(spec, data.get("location")) for spec in data.get("rules", [])]
+    names = [rule.name for rule in rules]
+    if len(set(names)) != len(names):
+        raise ValueError("Rule names must be unique")
+    return rules
+
+
+# ---- Timer wheel ----
+
+class Timer:
+    __slots__ = ("when", "expires", "rule", "cancelled")
+
+    def __init__(self, when: float, rule):
+        self.when = when
+        self.expires = 0
+        self.rule = rule
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerWheel:
+    """Hierarchical timing wheel over wall-clock ticks.
+
+    Level 0 has one slot per tick, every higher level slots as wide as a whole
+    turn of the level below. A timer goes into the lowest level whose range
+    covers it and moves down a level each time its slot comes up (cascading),
+    until it lands in level 0. Timers further out than the top level wait in
+    an overflow list that is re-examined once per top-level turn.
+    """
+
+    def __init__(self, origin: float, tick: float = 1.0, bits: int = 6, levels: int = 4):
+        self.origin = origin
+        self.tick = tick
+        self.bits = bits
+        self.mask = (1 << bits) - 1
+        self.levels = levels
+        self.current = 0
+        self.wheels = [[[] for _ in range(1 << bits)] for _ in range(levels)]
+        self.overflow = []
+        self.count = 0
+
+    def tick_of(self, when: float) -> int:
+        return int((when - self.origin) // self.tick)
+
+    def wall_time(self, tick: int) -> float:
+        return self.origin + tick * self.tick
+
+    def add(self, when: float, rule) -> Timer:
+        timer = Timer(when, rule)
+        # Anything already due goes into the next tick
+        timer.expires = max(self.tick_of(when), self.current + 1)
+        self._place(timer)
+        self.count += 1
+        return timer
+
+    def _place(self, timer: Timer):
+        delta = timer.expires - self.current
+        for level in range(self.levels):
+            if delta < 1 << (self.bits * (level + 1)):
+                self.wheels[level][(timer.expires >> (self.bits * level)) & self.mask].append(timer)
+                return
+        self.overflow.append(timer)
+
+    def _cascade(self, level: int):
+        slot = self.wheels[level][(self.current >> (self.bits * level)) & self.mask]
+        timers = slot[:]
+        slot.clear()
+        for timer in timers:
+            if timer.cancelled:
+                self.count -= 1
+            else:
+                self._place(timer)
+
+    def advance(self, to_tick: int) -> list:
+        """Move the wheel forward to to_tick and return the timers that came due, in order."""
+        due = []
+        while self.current < to_tick:
+            self.current += 1
+            for level in range(1, self.levels):
+                if (self.current >> (self.bits * (level - 1))) & self.mask:
+                    break
+                self._cascade(level)
+            else:
+                if not self.current & ((1 << (self.bits * self.levels)) - 1):
+                    overflow, self.overflow = self.overflow, []
+                    for timer in overflow:
+                        if timer.cancelled:
+                            self.count -= 1
+                        else:
+                            self._place(timer)
+            slot = self.wheels[0][self.current & self.mask]
+            for timer in slot:
+                self.count -= 1
+                if not timer.cancelled:
+                    due.append(timer)
+            slot.clear()
+        due.sort(key=lambda timer: timer.when)
+        return due
+
+
+# ---- Scheduler ----
+
+class Scheduler:
+    """Fires the rules of a schedule through a TimerWheel and keeps score of late and missed firings.
+
+    execute(rule) is awaited in its own task, so a slow light never holds up
+    the wheel.
+    """
+
+    def __init__(self, rules: list, execute, tick: float = 1.0, misfire_grace: float = MISFIRE_GRACE,
+                 late_threshold: float = LATE_THRESHOLD):
+        self.rules = rules
+        self.execute = execute
+        self.tick = tick
+        self.misfire_grace = misfire_grace
+        self.late_threshold = late_threshold
+        self.wheel = None
+        self.timers = {}
+        self.lateness = deque(maxlen=10000)
+        self._tasks = set()
+
+    def _arm(self, rule: ScheduleRule, after: float):
+        when = rule.trigger.next_after(after)
+        if when is None:
+            self.timers.pop(rule.name, None)
+            logging.info(f"Rule '{rule.name}' will not fire again.")
+            return
+        self.timers[rule.name] = self.wheel.add(when, rule)
+
+    def next_firings(self) -> list:
+        """Return [(when, rule)] of the armed rules, soonest first."""
+        return sorted(((timer.when, timer.rule) for timer in self.timers.values()), key=lambda item: item[0])
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        now = time.time()
+        self.wheel = TimerWheel(origin=now, tick=self.tick)
+        for rule in self.rules:
+            self._arm(rule, now)
+        logging.info(f"Scheduler armed {len(self.timers)} of {len(self.rules)} rule(s).")
+        try:
+            while True:
+                now = time.time()
+                # One tick of lookahead, so every timer is handed to call_at before it is due
+                horizon = self.wheel.tick_of(now) + 1
+                for timer in self.wheel.advance(horizon):
+                    delay = timer.when - time.time()
+                    if delay < -self.misfire_grace:
+                        self._missed(timer, now)
+                        continue
+                    loop.call_at(loop.time() + max(0.0, delay), self._fire, timer)
+                # Sleep to an absolute tick boundary, so the ticks never drift either
+                await asyncio.sleep(max(0.0, self.wheel.wall_time(horizon) - time.time()))
+        finally:
+            for task in list(self._tasks):
+                task.cancel()
+
+    def _missed(self, timer: Timer, now: float):
+        rule = timer.rule
+        rule.missed += 1
+        logging.warning(f"Rule '{rule.name}' missed its firing at "
+                        f"{datetime.datetime.fromtimestamp(timer.when).isoformat(timespec='seconds')} "
+                        f"({now - timer.when:.0f}s ago).")
+        self._arm(rule, now)
+
+    def _fire(self, timer: Timer):
+        if timer.cancelled:
+            return
+        rule = timer.rule
+        late = time.time() - timer.when
+        rule.fired += 1
+        self.lateness.append(late)
+        rule.max_late = max(rule.max_late, late)
+        if late > self.late_threshold:
+            rule.late += 1
+            logging.warning(f"Rule '{rule.name}' fired {late:.2f}s late.")
+        else:
+            logging.info(f"Rule '{rule.name}' fired ({rule.trigger}).")
+        # Re-arm from when it was due, not from now
+        self._arm(rule, timer.when)
+        task = asyncio.ensure_future(self._execute(rule))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _execute(self, rule: ScheduleRule):
+        try:
+            if not await self.execute(rule):
+                rule.failed += 1
+        except Exception as e:
+            rule.failed += 1
+            logging.error(f"Rule '{rule.name}' failed: {e}")
+
+    def report(self) -> dict:
+        ordered = sorted(self.lateness)
+
+        def percentile(q):
+            return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 1) if ordered else None
+
+        return {
+            "rules": len(self.rules),
+            "armed": len(self.timers),
+            "fired": sum(rule.fired for rule in self.rules),
+            "late": sum(rule.late for rule in self.rules),
+            "missed": sum(rule.missed for rule in self.rules),
+            "failed": sum(rule.failed for rule in self.rules),
+            "lateness_ms": {"p50": percentile(0.5), "p99": percentile(0.99),
+                            "max": round(ordered[-1] * 1000, 1) if ordered else None},
+        }
+
+    def log_report(self):
+        report = self.report()
+        lateness = report["lateness_ms"]
+        logging.info(f"Scheduler: {report['fired']} firing(s), {report['late']} late, {report['missed']} missed, "
+                     f"{report['failed']} failed; lateness p50 {lateness['p50']} ms, p99 {lateness['p99']} ms, "
+                     f"max {lateness['max']} ms; {report['armed']} of {report['rules']} rule(s) armed.")
+        for rule in self.rules:
+            if rule.late or rule.missed or rule.failed:
+                logging.info(f"  {rule.name}: {rule.fired} fired, {rule.late} late (max {rule.max_late:.2f}s), "
+                             f"{rule.missed} missed, {rule.failed} failed.")
@@ -0,0 +1,238 @@
+import argparse
+import importlib
+import importlib.util
+import json
+import os
+import sys
+
+# One entry point for every light command and effect.
+#
+# Only the standard library is imported at module level. The simple commands
+# (list, on, off, color, cycle-colors, save-scene, restore-scene) import
+# cryptography and meross_iot when they run; an effect imports its own module,
+# and with it numpy, sounddevice, speech_recognition and friends, only when it
+# is selected. import_benchmark.py keeps the simple commands within an
+# import-time budget.
+#
+# Effects are plugins: a name, the module whose main() runs it, and the pip
+# packages it needs. More effects can be registered in meross_effects.json:
+#     {"version": 1, "effects": {"strobe": {"module": "my_strobe", "help": "Strobe the lights.",
+#                                           "requires": ["numpy"]}}}
+# The module's main() parses the remaining arguments itself.
+
+KEY_FILE = "secret.key"
+CONFIG_FILE = "meross_config.json"
+PLUGIN_FILE = "meross_effects.json"
+PLUGIN_VERSION = 1
+
+SIMPLE_COMMANDS = {
+    "list": "List the lights of the account.",
+    "on": "Turn lights on.",
+    "off": "Turn lights off.",
+    "color": "Set the color of lights.",
+    "cycle-colors": "Cycle lights through the colors until interrupted.",
+    "save-scene": "Save the state of lights to a scene file.",
+    "restore-scene": "Put lights back into the state of a scene file.",
+}
+
+
+class EffectPlugin:
+    """An effect the CLI can run: the module with its main(), and the packages it needs."""
+
+    __slots__ = ("name", "module", "help", "requires")
+
+    def __init__(self, name: str, module: str, help: str, requires: tuple = ()):
+        self.name = name
+        self.module = module
+        self.help = help
+        self.requires = tuple(requires)
+
+    def missing_requirements(self) -> list:
+        """Return the required packages that are not installed, without importing any of them."""
+        return [package for package in self.requires if importlib.util.find_spec(package) is None]
+
+
+EFFECTS = {}
+
+
+def register_effect(name: str, module: str, help: str, requires: tuple = ()):
+    EFFECTS[name] = EffectPlugin(name, module, help, requires)
+
+
+register_effect("fade", "fade_light", "Fade lights to a beat.")
+register_effect("pulse", "music_light_sync", "Pulse lights to a beat, optionally in several colors.")
+register_effect("mic", "mic_light_control", "Drive lights from the microphone.", ("numpy", "sounddevice"))
+register_effect("spatial", "spatial_effects", "Run a wave, pulse or gradient over a room layout.", ("numpy",))
+register_effect("composite", "composite_effects", "Layer a color cycle, the microphone level and a beat flash.",
+                ("numpy", "sounddevice"))
+register_effect("dmx", "dmx_bridge", "Bridge a lighting console over sACN/Art-Net to the lights.", ("numpy",))
+register_effect("dmx-test", "dmx_test_sender", "Send a rainbow over sACN/Art-Net to test the DMX bridge.", ("numpy",))
+register_effect("calibrate", "calibrate_latency", "Measure how far the lights trail the sound, against simulated or real lights.", ("numpy",))
+register_effect("ws", "ws_frame_server", "Serve the WebSocket frame streaming API.", ("numpy", "websockets"))
+register_effect("fleet", "fleet_server", "Drive several accounts at once, every shard of lights in its own process.")
+register_effect("schedule", "schedule_lights", "Run timed scenes and routines, including sunrise and sunset, from one resident process.")
+register_effect("history", "light_history_report", "Report when lights were on, in which color, and how often their commands failed.")
+register_effect("replay", "replay_trace", "Replay a command trace against simulated lights, in real time or as fast as possible.")
+register_effect("voice", "voice_controller", "Control lights with voice commands.", ("speech_recognition",))
+
+
+def load_plugin_file(path: str = PLUGIN_FILE):
+    """Register the effects of the plugin file. A missing default file simply means no extra effects."""
+    if not os.path.exists(path):
+        if path != PLUGIN_FILE:
+            raise FileNotFoundError(f"Plugin file '{path}' not found")
+        return
+    with open(path, 'r') as f:
+        data = json.load(f)
+    if data.get("version") != PLUGIN_VERSION:
+        raise ValueError(f"Unsupported plugin file version: {data.get('version')}")
+    for name, spec in data.get("effects", {}).items():
+        register_effect(name, spec["module"], spec.get("help", ""), spec.get("requires", ()))
+
+
+def import_command(command: str):
+    """Import what a command needs and return the module that runs it.
+
+    Simple commands return meross_light_controller, effects their plugin module.
+    The import-time benchmark calls this to measure exactly what a command loads.
+    """
+    if command in SIMPLE_COMMANDS:
+        importlib.import_module("cryptography.fernet")
+        return importlib.import_module("meross_light_controller")
+    return importlib.import_module(EFFECTS[command].module)
+
+
+def load_credentials():
+    """Return (email, password) from the config file, decrypting the password with the key file."""
+    from cryptography.fernet import Fernet, InvalidToken
+
+    try:
+        with open(KEY_FILE, "rb") as key_file:
+            key = key_file.read()
+    except FileNotFoundError:
+        key = None
+    if not key:
+        print(f"Error: Encryption key '{KEY_FILE}' not found. Please run the GUI app once to generate it.", file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        with open(CONFIG_FILE, 'r') as f:
+            config = json.load(f)
+        email = config.get('email')
+        encrypted_password = config.get('password')
+        if not email or not encrypted_password:
+            print(f"Error: Could not find 'email' or 'password' in {CONFIG_FILE}.", file=sys.stderr)
+            sys.exit(1)
+        password = Fernet(key).decrypt(encrypted_password.encode()).decode()
+    except FileNotFoundError:
+        print(f"Error: Configuration file '{CONFIG_FILE}' not found.", file=sys.stderr)
+        sys.exit(1)
+    except json.JSONDecodeError:
+        print(f"Error: Could not decode '{CONFIG_FILE}'. Please ensure it is valid JSON.", file=sys.stderr)
+        sys.exit(1)
+    except InvalidToken:
+        print("Error: Failed to decrypt password. The encryption key may have changed.", file=sys.stderr)
+        sys.exit(1)
+    return email, password
+
+
+def run_simple_command(args):
+    import asyncio
+    from profiler import run_profiled
+    from command_trace import start_trace
+
+    controller = import_command(args.command)
+    email, password = load_credentials()
+    start_trace(args.trace)
+    try:
+        asyncio.run(run_profiled(controller.discover_and_control_lights(
+            email=email,
+            password=password,
+            action=args.command,
+            light_names=getattr(args, "lights", None) or None,
+            color=getattr(args, "color", None),
+            cycle_speed=getattr(args, "cycle_speed", 1.0),
+            serial_numbers=args.serial_numbers,
+            scene_file=getattr(args, "scene_file", "meross_scene.json"),
+            restore_prior_scene=getattr(args, "restore_scene", False),
+            verbose=args.verbose
+        ), args.profile))
+    except KeyboardInterrupt:
+        print("\nScript interrupted by user.")
+
+
+def run_effect(name: str, effect_args: list):
+    plugin = EFFECTS[name]
+    missing = plugin.missing_requirements()
+    if missing:
+        print(f"Error: The '{name}' effect needs {', '.join(missing)}.", file=sys.stderr)
+        print(f"Please install them: pip install {' '.join(missing)}", file=sys.stderr)
+        sys.exit(1)
+    module = import_command(name)
+    # The effect's own parser reads sys.argv, with the usage line naming the subcommand
+    sys.argv = [f"{os.path.basename(sys.argv[0])} effect {name}"] + effect_args
+    module.main()
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Control Meross smart lights and run light effects.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    selector_help = "The light(s) to control. Also accepts aliases, group:<name>, tag:<name> and glob patterns."
+
+    for command, help in SIMPLE_COMMANDS.items():
+        sub = subparsers.add_parser(command, help=help, description=help)
+        if command == "color":
+            sub.add_argument("color", help="The color to set (e.g., red, blue, green).")
+        if command == "list":
+            sub.add_argument("--serial-numbers", nargs='+', help="Only list the devices with these serial numbers.")
+        else:
+            sub.add_argument("lights", nargs='*', help=selector_help)
+            sub.add_argument("--serial-numbers", nargs='+', help="A list of device serial numbers to target.")
+        if command == "cycle-colors":
+            sub.add_argument("--cycle-speed", type=float, default=1.0, help="The speed of the color cycle in seconds (default: 1.0).")
+            sub.add_argument("--restore-scene", action="store_true", help="When stopping, put the light back the way it was instead of turning it off.")
+        if command in ("save-scene", "restore-scene"):
+            sub.add_argument("--scene-file", default="meross_scene.json", help="The scene file (default: meross_scene.json).")
+        sub.add_argument("--profile", nargs='?', const="meross_profile", metavar="PREFIX", help="Profile the run and write PREFIX.collapsed, PREFIX.svg (flamegraph) and PREFIX-lag.json (event-loop lag); the prefix defaults to meross_profile.")
+        sub.add_argument("--trace", metavar="FILE", help="Record every device command, its acknowledgement and round-trip to FILE (gzipped JSON lines), to replay with replay_trace.py.")
+        sub.add_argument("-v", "--verbose", action="store_true", help="Enable verbose (DEBUG) logging.")
+
+    effect = subparsers.add_parser("effect", help="Run a light effect.", description="Run a light effect. "
+                                   "Arguments after the effect name are passed to the effect; use '<effect> -h' to list them.")
+    effect.add_argument("effect", nargs='?', choices=sorted(EFFECTS), metavar="EFFECT",
+                        help=f"The effect to run: {', '.join(sorted(EFFECTS))}.")
+    effect.add_argument("effect_args", nargs=argparse.REMAINDER, help=argparse.SUPPRESS)
+    effect.add_argument("--list", action="store_true", help="List the effects and whether their dependencies are installed.")
+    return parser
+
+
+def list_effects():
+    for name in sorted(EFFECTS):
+        plugin = EFFECTS[name]
+        missing = plugin.missing_requirements()
+        status = f" (needs {', '.join(missing)})" if missing else ""
+        print(f"  {name:<12} {plugin.help}{status}")
+
+
+def main():
+    try:
+        load_plugin_file()
+    except (FileNotFoundError, json.JSONDecodeError, ValueError, KeyError) as e:
+        print(f"Error: Could not load plugin file '{PLUGIN_FILE}': {e}", file=sys.stderr)
+        sys.exit(1)
+    parser = build_parser()
+    args = parser.parse_args()
+
+    if args.command == "effect":
+        if args.list or not args.effect:
+            list_effects()
+            return
+        run_effect(args.effect, args.effect_args)
+        return
+    if args.command in ("on", "off", "color", "cycle-colors") and not args.lights and not args.serial_numbers:
+        parser.error(f"'{args.command}' needs the lights to control or --serial-numbers.")
+    run_simple_command(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+import argparse
 import tkinter as tk
 from tkinter import ttk, scrolledtext, messagebox
 import asyncio
@@ -6,27 +7,52 @@ import logging
 import json
 import os
 import sys
+import time
 
-from meross_iot.controller.mixins.light import LightMixin
-from meross_iot.http_api import MerossHttpClient
-from meross_iot.manager import MerossManager
 from cryptography.fernet import Fernet, InvalidToken
+from command_executor import CommandExecutor
+from connection_supervisor import ConnectionSupervisor
+from group_sync import SyncGroupDispatcher
+from command_scheduler import DeviceCommandScheduler, INTERACTIVE, SCENE
+from light_commands import async_send_light_state
+from light_scenes import snapshot_scene, scene_diff
+from light_registry import LightRegistry
+from startup import StartupGraph, add_light_steps
+from profiler import DEFAULT_OUTPUT, ProfileSession
+from command_trace import start_trace
+from effect_runtime import EFFECTS, EffectTaskManager
+from light_history import HISTORY_DIR, HistoryLockedError, HistoryWriter
 
 # Custom handler to redirect logs to the GUI text widget
 class TextWidgetHandler(logging.Handler):
+    # Lines are inserted in batches at most this often, and the widget keeps at most MAX_LINES of them
+    FLUSH_INTERVAL_MS = 100
+    MAX_LINES = 5000
+
     def __init__(self, text_widget):
         super().__init__()
         self.text_widget = text_widget
         self.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+        self._pending = []
+        self._pending_lock = threading.Lock()
 
     def emit(self, record):
         msg = self.format(record)
-        # Use root.after to safely update the Text widget from a different thread
-        self.text_widget.after(0, self._insert_text, msg)
-
-    def _insert_text(self, msg):
+        with self._pending_lock:
+            self._pending.append(msg)
+            schedule = len(self._pending) == 1
+        if schedule:
+            # Use root.after to safely update the Text widget from a different thread
+            self.text_widget.after(self.FLUSH_INTERVAL_MS, self._insert_text)
+
+    def _insert_text(self):
+        with self._pending_lock:
+            lines, self._pending = self._pending, []
         self.text_widget.config(state='normal')
-        self.text_widget.insert(tk.END, msg + '\n')
+        self.text_widget.insert(tk.END, '\n'.join(lines) + '\n')
+        excess = int(self.text_widget.index('end-1c').split('.')[0]) - 1 - self.MAX_LINES
+        if excess > 0:
+            self.text_widget.delete('1.0', f'{excess + 1}.0')
         self.text_widget.see(tk.END) # Auto-scroll to the end
         self.text_widget.config(state='disabled')
 
@@ -43,23 +69,46 @@ def load_key():
         return None
 
 class MerossApp:
-    def __init__(self, root):
+    def __init__(self, root, profile: ProfileSession = None, history_dir: str = None, connection_metrics: str = None):
         self.root = root
         self.root.title("Meross Light Controller (Simplified)")
-        self.root.geometry("500x600")
+        self.root.geometry("720x760")
 
         self.meross_email = tk.StringVar()
         self.meross_password = tk.StringVar()
         self.remember_me = tk.BooleanVar(value=True)
+        self.restore_after_effect = tk.BooleanVar(value=True)
 
         self.http_client = None
         self.manager = None
+        # Pauses the running effects while the cloud connection is down and gets the session back
+        self.supervisor = None
+        self.connection_metrics = connection_metrics
         self.controllable_lights = []
+        self.registry = LightRegistry([])
+        self.light_index = {} # uuid -> position in controllable_lights / light_vars
+        self.selector_var = tk.StringVar()
 
         self.asyncio_loop = None
         self.asyncio_thread = None
-        self.fade_task = None # Initialize fade_task
-        self.active_effect_lights = []
+        self.profile = profile # Samples the Tk, asyncio and worker threads when started with --profile
+        # Every button and scene command and the state it left the light in, when started with --history-dir
+        self.history = None
+        if history_dir:
+            try:
+                self.history = HistoryWriter(history_dir)
+            except HistoryLockedError as e:
+                logging.error(f"{e}, running without a history.")
+                messagebox.showwarning("Warning", f"{e}. The app runs without recording a history.")
+        # Deadlines and circuit breakers so one unresponsive bulb can't hold up the others
+        self.executor = CommandExecutor(history=self.history)
+        # Staggers group commands by each light's latency so the lights change together
+        self.group_sync = SyncGroupDispatcher(self.executor)
+        # Button presses jump ahead of (and replace) pending effect frames
+        self.scheduler = DeviceCommandScheduler(self.executor)
+        # Effects run side by side, each on its own lights; only used from the asyncio loop thread
+        self.effects = EffectTaskManager(self.scheduler, self._release_effect_lights, self.group_sync)
+        self.bpm_var = tk.IntVar(value=60)
 
         self._create_widgets()
         self._setup_logging()
@@ -85,10 +134,22 @@ class MerossApp:
             messagebox.showerror("Error", "Could not generate or save encryption key. Credentials will not be saved.")
 
     def _on_closing(self):
-        if self.fade_task and not self.fade_task.done():
-            self.fade_task.cancel()
-
         if self.asyncio_loop and self.asyncio_loop.is_running():
+            # Release the effect lights while the session and the history writer are still open
+            try:
+                asyncio.run_coroutine_threadsafe(self.effects.stop_all(), self.asyncio_loop).result(timeout=10)
+            except Exception as e:
+                logging.warning(f"Could not release the effect lights: {e}")
+            if self.history:
+                # Write the records still buffered before the loop goes away
+                try:
+                    asyncio.run_coroutine_threadsafe(self.history.close(), self.asyncio_loop).result(timeout=5)
+                except Exception as e:
+                    logging.warning(f"Could not write the light history: {e}")
+            try:
+                asyncio.run_coroutine_threadsafe(self._close_session(), self.asyncio_loop).result(timeout=5)
+            except Exception as e:
+                logging.warning(f"Could not log out: {e}")
             self.asyncio_loop.call_soon_threadsafe(self.asyncio_loop.stop)
         self.root.destroy()
 
@@ -111,6 +172,12 @@ class MerossApp:
         lights_frame = ttk.LabelFrame(self.root, text="Discovered Lights", padding="10")
         lights_frame.pack(pady=10, padx=10, fill="both", expand=True)
 
+        selector_frame = ttk.Frame(lights_frame)
+        selector_frame.pack(fill="x", pady=(0, 5))
+        ttk.Entry(selector_frame, textvariable=self.selector_var, width=30).pack(side="left", padx=5)
+        ttk.Button(selector_frame, text="Select", command=self.select_by_selector).pack(side="left", padx=5)
+        ttk.Label(selector_frame, text="names, aliases, group:, tag:, glob").pack(side="left", padx=5)
+
         self.lights_checkbox_frame = ttk.Frame(lights_frame)
         self.lights_checkbox_frame.pack(fill="both", expand=True)
 
@@ -134,17 +201,40 @@ class MerossApp:
         self.off_button = ttk.Button(controls_frame, text="Off", command=lambda: self.start_asyncio_and_run(self.turn_off_selected_light))
         self.off_button.pack(side="left", padx=5)
 
+        # Effects Frame: every run is a task of its own on the lights selected when it started
+        effects_frame = ttk.LabelFrame(self.root, text="Effects", padding="10")
+        effects_frame.pack(pady=10, padx=10, fill="x")
+
+        effect_controls = ttk.Frame(effects_frame)
+        effect_controls.pack(fill="x")
+
         self.effect_var = tk.StringVar(value="Flashing")
-        self.effect_dropdown = ttk.Combobox(controls_frame, textvariable=self.effect_var)
-        self.effect_dropdown['values'] = ["Flashing"]
+        self.effect_dropdown = ttk.Combobox(effect_controls, textvariable=self.effect_var, width=10, state="readonly")
+        self.effect_dropdown['values'] = list(EFFECTS)
         self.effect_dropdown.pack(side="left", padx=5)
 
-        self.run_effect_button = ttk.Button(controls_frame, text="Run Effect", command=lambda: self.start_asyncio_and_run(self.run_selected_effect))
+        ttk.Label(effect_controls, text="BPM:").pack(side="left")
+        ttk.Spinbox(effect_controls, from_=20, to=240, textvariable=self.bpm_var, width=5).pack(side="left", padx=5)
+
+        self.run_effect_button = ttk.Button(effect_controls, text="Run Effect", command=self.run_selected_effect)
         self.run_effect_button.pack(side="left", padx=5)
 
-        self.stop_effect_button = ttk.Button(controls_frame, text="Stop Effect", command=self.stop_effect)
+        self.stop_effect_button = ttk.Button(effect_controls, text="Stop Effect", command=self.stop_effect)
         self.stop_effect_button.pack(side="left", padx=5)
 
+        ttk.Button(effect_controls, text="Stop All", command=self.stop_all_effects).pack(side="left", padx=5)
+
+        ttk.Checkbutton(effect_controls, text="Restore lights after effect", variable=self.restore_after_effect).pack(side="left", padx=5)
+
+        columns = {"effect": ("Effect", 90), "lights": ("Lights", 200), "cpu": ("CPU", 80), "rate": ("Msg/s", 60),
+                   "failed": ("Failed", 60), "lag": ("Lag p50/max", 110)}
+        self.effects_view = ttk.Treeview(effects_frame, columns=list(columns), show="headings", height=4)
+        for column, (heading, width) in columns.items():
+            self.effects_view.heading(column, text=heading)
+            self.effects_view.column(column, width=width, anchor="w")
+        self.effects_view.pack(fill="x", pady=(5, 0))
+        self.root.after(1000, self._refresh_effect_stats)
+
         # Log Frame
         log_frame = ttk.LabelFrame(self.root, text="Logs", padding="10")
         log_frame.pack(pady=10, padx=10, fill="both", expand=True)
@@ -218,6 +308,10 @@ class MerossApp:
         self.asyncio_loop = asyncio.new_event_loop()
         self.asyncio_thread = threading.Thread(target=self._run_asyncio_loop, daemon=True)
         self.asyncio_thread.start()
+        if self.profile:
+            self.asyncio_loop.call_soon_threadsafe(self.profile.attach_loop, self.asyncio_loop)
+        if self.history:
+            self.asyncio_loop.call_soon_threadsafe(self.history.start)
         self.asyncio_loop.call_soon_threadsafe(asyncio.create_task, self._discover_devices_async())
 
     def _run_asyncio_loop(self):
@@ -240,12 +334,28 @@ class MerossApp:
         self.controllable_lights = []
 
         try:
-            self.http_client = await MerossHttpClient.async_from_user_password(email=email, password=password, api_base_url="https://iot.meross.com")
-            self.manager = MerossManager(http_client=self.http_client)
-            await self.manager.async_init()
-            await self.manager.async_device_discovery()
-            all_devices = self.manager.find_devices()
-            self.controllable_lights = [dev for dev in all_devices if isinstance(dev, LightMixin)]
+            # Login, MQTT connection, device list and registry file load overlap where they can
+            startup = StartupGraph()
+            add_light_steps(startup, email, password)
+            try:
+                results = await startup.run()
+            finally:
+                self.http_client = startup.results.get("login")
+                self.manager = startup.results.get("manager")
+            startup.log_report()
+            self.controllable_lights = results["light state"]
+            if self.supervisor:
+                # Also logs out of the previous session, which may be a newer one than it started with
+                await self.supervisor.close()
+            self.supervisor = ConnectionSupervisor(self.manager, self.http_client, email, password,
+                                                   self.controllable_lights, metrics_file=self.connection_metrics)
+            self.supervisor.on_reconnect(self._adopt_session)
+            self.supervisor.on_reconnect(self.executor.reset_breakers)
+            self.supervisor.on_reconnect(self.effects.forget_sent)
+            self.supervisor.start()
+            self.effects.supervisor = self.supervisor
+            self.light_index = {light.uuid: i for i, light in enumerate(self.controllable_lights)}
+            self.registry = LightRegistry(self.controllable_lights, results["registry file"])
 
             if not self.controllable_lights:
                 logging.warning("No Meross lights found on your account.")
@@ -269,12 +379,37 @@ class MerossApp:
         finally:
             self.root.after(0, lambda: self.login_button.config(state=tk.NORMAL, text="Login & Discover Devices"))
 
+    def _adopt_session(self):
+        # After logging in again the supervisor holds a new session and has closed the old one
+        self.manager = self.supervisor.manager
+        self.http_client = self.supervisor.http_client
+
+    async def _close_session(self):
+        # Stop watching the connection first, so the supervisor does not log in again while the app closes
+        if self.supervisor:
+            await self.supervisor.close()
+        elif self.http_client:
+            await self.http_client.async_logout()
+        self.supervisor = None
+        self.http_client = None
+        self.manager = None
+
     def start_asyncio_and_run(self, coro):
         if not self.asyncio_loop or not self.asyncio_loop.is_running():
             logging.error("Asyncio loop not running.")
             return
         self.asyncio_loop.call_soon_threadsafe(asyncio.create_task, coro())
 
+    def select_by_selector(self):
+        """Check the lights matching the comma separated selectors, uncheck all others."""
+        selectors = [s.strip() for s in self.selector_var.get().split(",") if s.strip()]
+        if not selectors:
+            return
+        matched = {self.light_index[light.uuid] for light in self.registry.select(selectors)}
+        for i, var in enumerate(self.light_vars):
+            var.set(1 if i in matched else 0)
+        logging.info(f"Selected {len(matched)} light(s).")
+
     def get_selected_lights(self):
         selected_lights = []
         for i, var in enumerate(self.light_vars):
@@ -308,81 +443,142 @@ class MerossApp:
         rgb = COLORS.get(color_name)
 
         if rgb:
-            for light in lights:
-                try:
-                    await light.async_set_light_color(rgb=rgb)
-                    logging.info(f"Set color of {light.name} to {color_name}.")
-                except Exception as e:
-                    logging.error(f"Failed to set color of {light.name}: {e}")
+            await self._run_interactive(lights, lambda light: light.async_set_light_color(rgb=rgb),
+                                        f"Set color of {{}} to {color_name}.", "Failed to set color of {}")
+            self.group_sync.log_report()
 
     async def turn_on_selected_light(self):
         lights = self.get_selected_lights()
-        for light in lights:
-            try:
-                await light.async_turn_on()
-                logging.info(f"{light.name} turned on.")
-            except Exception as e:
-                logging.error(f"Failed to turn on {light.name}: {e}")
+        await self._run_interactive(lights, lambda light: light.async_turn_on(), "{} turned on.", "Failed to turn on {}")
 
     async def turn_off_selected_light(self):
         lights = self.get_selected_lights()
+        await self._run_interactive(lights, lambda light: light.async_turn_off(), "{} turned off.", "Failed to turn off {}")
+
+    async def _run_interactive(self, lights, command_factory, success_msg, failure_msg, priority=INTERACTIVE):
+        """Send a user command to the lights ahead of any running effect and log how long it took.
+
+        Releases and scene restores pass priority=SCENE, so they still go ahead of effect frames but
+        queue behind the user's clicks.
+        """
+        if not lights:
+            return
+        start = time.monotonic()
+        results = await self.group_sync.dispatch(
+            lights, command_factory, run=lambda light, factory: self.scheduler.submit(light, factory, priority))
+        self._log_results(lights, results, success_msg, failure_msg)
+        logging.debug(f"Command reached {len(lights)} light(s) in {(time.monotonic() - start) * 1000:.0f} ms.")
+
+    def _log_results(self, lights, results, success_msg, failure_msg):
         for light in lights:
-            try:
-                await light.async_turn_off()
-                logging.info(f"{light.name} turned off.")
-            except Exception as e:
-                logging.error(f"Failed to turn off {light.name}: {e}")
+            if results[light.uuid]:
+                logging.info(success_msg.format(light.name))
+            else:
+                health = self.executor.breaker(light).health()
+                reason = health["last_error"] if health["state"] != "open" else "light is unresponsive, retrying later"
+                logging.error(f"{failure_msg.format(light.name)}: {reason}")
 
     def run_selected_effect(self):
+        if not self.asyncio_loop or not self.asyncio_loop.is_running():
+            logging.error("Asyncio loop not running.")
+            return
         lights = self.get_selected_lights()
         if not lights:
             return
-        self.active_effect_lights = lights # Store the lights involved in the effect
-
-        effect = self.effect_var.get()
-        if effect == "Flashing":
-            self.fade_task = self.asyncio_loop.create_task(self.flashing_selected_lights())
+        # The cached state is kept current by the device push notifications, so this costs no request
+        prior_scene = snapshot_scene(lights) if self.restore_after_effect.get() else None
+        try:
+            bpm = max(1, int(self.bpm_var.get()))
+        except (tk.TclError, ValueError):
+            bpm = 60
+        color = self.color_var.get() or None
+        # Called from the Tk thread, so hand the effect over to the asyncio loop thread
+        self.asyncio_loop.call_soon_threadsafe(self._start_effect, self.effect_var.get(), lights, prior_scene, bpm, color)
+
+    def _start_effect(self, effect, lights, prior_scene, bpm, color):
+        try:
+            self.effects.start(effect, lights, prior_scene, bpm=bpm, color=color)
+        except ValueError as e:
+            message = f"Cannot start {effect}, some lights are {e}."
+            logging.warning(message)
+            self.root.after(0, lambda: messagebox.showwarning("Warning", f"{message} Stop that effect first or pick other lights."))
 
     def stop_effect(self):
-        if self.fade_task and not self.fade_task.done():
-            self.fade_task.cancel()
-            logging.info("Active effect stopped.")
-        
-        # Explicitly turn off all lights that were part of the effect
-        for light in self.active_effect_lights:
-            try:
-                # Use asyncio.run_coroutine_threadsafe to safely turn off lights
-                asyncio.run_coroutine_threadsafe(light.async_turn_off(), self.asyncio_loop)
-                logging.info(f"Turned off {light.name}.")
-            except Exception as e:
-                logging.error(f"Failed to turn off {light.name}: {e}")
-        self.active_effect_lights = [] # Clear the list of active effect lights
-
-    async def flashing_selected_lights(self):
-        lights = self.get_selected_lights()
-        if not lights:
+        """Stop the effects selected in the list and release their lights."""
+        task_ids = [int(item) for item in self.effects_view.selection()]
+        if not task_ids:
+            messagebox.showwarning("Warning", "Please select the effect to stop in the list.")
+            return
+        if not self.asyncio_loop or not self.asyncio_loop.is_running():
+            logging.error("Asyncio loop not running.")
             return
+        for task_id in task_ids:
+            asyncio.run_coroutine_threadsafe(self.effects.stop(task_id), self.asyncio_loop)
 
-        logging.info(f"Starting flashing effect for selected lights.")
-        try:
-            while True:
-                for light in lights:
-                    await light.async_turn_on()
-                await asyncio.sleep(0.5)
-                for light in lights:
-                    await light.async_turn_off()
-                await asyncio.sleep(0.5)
-        except asyncio.CancelledError:
-            logging.info("Flashing effect stopped.")
-
-def run_app():
+    def stop_all_effects(self):
+        if self.asyncio_loop and self.asyncio_loop.is_running():
+            asyncio.run_coroutine_threadsafe(self.effects.stop_all(), self.asyncio_loop)
+
+    def _refresh_effect_stats(self):
+        # The counters live on the asyncio loop thread: collect them there and show them here
+        if self.asyncio_loop and self.asyncio_loop.is_running():
+            self.asyncio_loop.call_soon_threadsafe(self._collect_effect_stats)
+        self.root.after(1000, self._refresh_effect_stats)
+
+    def _collect_effect_stats(self):
+        stats = self.effects.stats()
+        self.root.after(0, self._show_effect_stats, stats)
+
+    def _show_effect_stats(self, stats):
+        shown = set(self.effects_view.get_children())
+        for task in stats:
+            item = str(task["id"])
+            lag = f"{task['lag_p50_ms']}/{task['lag_max_ms']} ms" if task["lag_p50_ms"] is not None else ""
+            values = (f"{task['effect']} #{task['id']}", ", ".join(task["lights"]),
+                      f"{task['cpu_ms']:.0f} ms ({task['cpu_percent']:.1f}%)", task["messages_per_s"],
+                      task["failed"], lag)
+            if item in shown:
+                self.effects_view.item(item, values=values)
+                shown.discard(item)
+            else:
+                self.effects_view.insert("", "end", iid=item, values=values)
+        for item in shown:
+            self.effects_view.delete(item)
+
+    async def _release_effect_lights(self, lights, prior_scene=None):
+        self.scheduler.cancel_effect_frames(lights)
+        if prior_scene is None:
+            await self._run_interactive(lights, lambda light: light.async_turn_off(), "Turned off {}.",
+                                        "Failed to turn off {}", SCENE)
+            return
+        # Only the lights (and fields) the effect actually changed get a command
+        diff = scene_diff(lights, prior_scene)
+        changed = [light for light in lights if light.uuid in diff]
+        await self._run_interactive(changed, lambda light: async_send_light_state(light, **diff[light.uuid]),
+                                    "Restored {}.", "Failed to restore {}", SCENE)
+
+def run_app(profile_output: str = None, history_dir: str = None, connection_metrics: str = None):
+    profile = ProfileSession(profile_output) if profile_output else None
     root = tk.Tk()
-    app = MerossApp(root)
-    root.mainloop()
+    app = MerossApp(root, profile, history_dir, connection_metrics)
+    if profile:
+        profile.start()
+    try:
+        root.mainloop()
+    finally:
+        if profile:
+            profile.stop()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Meross Light Controller GUI.")
+    parser.add_argument("--profile", nargs='?', const=DEFAULT_OUTPUT, metavar="PREFIX", help="Profile the session and write PREFIX.collapsed, PREFIX.svg (flamegraph) and PREFIX-lag.json (event-loop lag); the prefix defaults to meross_profile.")
+    parser.add_argument("--connection-metrics", metavar="FILE", help="Write the connection drops, reconnect times and downtime to FILE as JSON whenever the connection changes state.")
+    parser.add_argument("--trace", metavar="FILE", help="Record every device command, its acknowledgement and round-trip to FILE (gzipped JSON lines), to replay with replay_trace.py.")
+    parser.add_argument("--history-dir", nargs='?', const=HISTORY_DIR, metavar="DIR", help="Keep a history of every light command (effect frames when they switch a light or every 10 s) and the state it left the light in, under DIR (default: light_history); query it with light_history_report.py.")
+    args = parser.parse_args()
+    start_trace(args.trace)
     try:
-        run_app()
+        run_app(args.profile, args.history_dir, args.connection_metrics)
     except Exception as e:
         logging.error(f"An unhandled error occurred: {e}")
         sys.exit(1)
\ No newline at end of file
@@ -4,12 +4,17 @@ import os
 import logging
 import sys
 import json
-from meross_iot.controller.mixins.light import LightMixin
 from meross_iot.http_api import MerossHttpClient
 from meross_iot.manager import MerossManager
+from light_discovery import async_discover_lights
+from light_output_filter import LightOutputFilter
+from light_scenes import capture_scene, save_scene, load_scene, restore_scene, snapshot_scene, release_lights
+from hot_path_log import HotPathLog
+from profiler import DEFAULT_OUTPUT, run_profiled
+from command_trace import start_trace
 # Setup basic logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-async def discover_and_control_lights(email: str, password: str, action: str, light_names: list = None, color: str = None, cycle_speed: float = 1.0, serial_numbers: list = None, verbose: bool = False):
+async def discover_and_control_lights(email: str, password: str, action: str, light_names: list = None, color: str = None, cycle_speed: float = 1.0, serial_numbers: list = None, scene_file: str = "meross_scene.json", restore_prior_scene: bool = False, verbose: bool = False):
     if verbose:
         logging.getLogger().setLevel(logging.DEBUG)
 
@@ -35,20 +40,20 @@ async def discover_and_control_lights(email: str, password: str, action: str, li
         logging.error(f"Failed to initialize MerossManager: {e}")
         await http_client.async_logout()
         return
-    # Discover devices
-    await manager.async_device_discovery()
-    all_devices = manager.find_devices()
-    if not all_devices:
-        logging.warning("No Meross devices found on your account.")
-        await http_client.async_logout()
-        return
-    
-    controllable_lights = [dev for dev in all_devices if isinstance(dev, LightMixin)]
-    
-    if serial_numbers:
-        controllable_lights = [light for light in controllable_lights if light.uuid in serial_numbers]
+    # Discover devices. Listing needs every light, the other actions only initialize the requested ones
+    if action == 'list':
+        controllable_lights = await async_discover_lights(manager, http_client, uuids=serial_numbers)
+    elif light_names and serial_numbers:
+        # The names pick among the lights of the given serial numbers, so only lights matching both are targeted
+        named_lights = await async_discover_lights(manager, http_client, light_names)
+        controllable_lights = [light for light in named_lights if light.uuid in serial_numbers]
+        for light in named_lights:
+            if light.uuid not in serial_numbers:
+                logging.warning(f"Light '{light.name}' is not one of the specified serial numbers.")
+    else:
+        controllable_lights = await async_discover_lights(manager, http_client, light_names, serial_numbers)
     if not controllable_lights:
-        logging.warning("No controllable lights found with the specified serial numbers.")
+        logging.warning("No controllable lights found on your account (or with the specified names/serial numbers).")
         await http_client.async_logout()
         return
     print("Found the following controllable lights:")
@@ -58,16 +63,8 @@ async def discover_and_control_lights(email: str, password: str, action: str, li
         await http_client.async_logout()
         return
 
-    target_lights = []
-    if light_names:
-        for light_name in light_names:
-            light = next((light for light in controllable_lights if light.name.lower() == light_name.lower()), None)
-            if light:
-                target_lights.append(light)
-            else:
-                logging.warning(f"Light '{light_name}' not found.")
-    elif len(controllable_lights) > 0:
-        target_lights.extend(controllable_lights)
+    target_lights = controllable_lights
+    if not light_names and not serial_numbers:
         logging.info("No light name specified, targeting all controllable lights.")
 
     if not target_lights:
@@ -75,6 +72,25 @@ async def discover_and_control_lights(email: str, password: str, action: str, li
         await http_client.async_logout()
         return
 
+    if action == "save-scene":
+        scene = await capture_scene(target_lights)
+        save_scene(scene, scene_file)
+        logging.info(f"Saved the scene of {len(scene)} light(s) to {scene_file}.")
+        await http_client.async_logout()
+        return
+    if action == "restore-scene":
+        try:
+            scene = load_scene(scene_file)
+        except (FileNotFoundError, json.JSONDecodeError, ValueError) as e:
+            logging.error(f"Could not load scene file '{scene_file}': {e}")
+            await http_client.async_logout()
+            return
+        # The diff is computed against the current state, so fetch it for all lights at once
+        await asyncio.gather(*(light.async_update() for light in target_lights))
+        await restore_scene(target_lights, scene)
+        await http_client.async_logout()
+        return
+
     # Perform the action on all target lights
     for target_light in target_lights:
         await target_light.async_update()
@@ -105,17 +121,25 @@ async def discover_and_control_lights(email: str, password: str, action: str, li
                 logging.error("You must specify a color with the --color argument.")
         elif action == "cycle-colors":
             logging.info(f"Starting color cycle for {target_light.name}. Press Ctrl+C to stop.")
+            output_filter = LightOutputFilter()
+            output_filter.seed(target_light)
+            prior_scene = snapshot_scene([target_light]) if restore_prior_scene else None
+            hot_log = HotPathLog("cycle-colors", level=logging.INFO)
             try:
                 while True:
                     for color_name, rgb in COLORS.items():
-                        logging.info(f"Setting color to {color_name}...")
-                        await target_light.async_set_light_color(rgb=rgb)
+                        changes = output_filter.filter(target_light, rgb=rgb)
+                        if changes:
+                            hot_log.update("Setting color to %s...", color_name)
+                            await target_light.async_set_light_color(rgb=changes["rgb"])
+                            output_filter.commit(target_light)
                         await asyncio.sleep(cycle_speed)
             except asyncio.CancelledError:
                 logging.info("Color cycle stopped.")
             finally:
-                logging.info(f"Turning off {target_light.name}.")
-                await target_light.async_turn_off()
+                hot_log.log_summary()
+                output_filter.log_summary()
+                await release_lights([target_light], prior_scene)
 
     # Close the HTTP client session
     await http_client.async_logout()
@@ -139,11 +163,15 @@ def main():
         print("Error: 'email' and 'password' must be set in 'meross_config.json'.")
         sys.exit(1)
 
-    parser.add_argument("action", choices=["on", "off", "list", "color", "cycle-colors"], help="The action to perform.")
-    parser.add_argument("--light-name", nargs='+', help="The name(s) of the light(s) to control.")
+    parser.add_argument("action", choices=["on", "off", "list", "color", "cycle-colors", "save-scene", "restore-scene"], help="The action to perform.")
+    parser.add_argument("--light-name", nargs='+', help="The name(s) of the light(s) to control. Also accepts aliases, group:<name>, tag:<name> and glob patterns.")
     parser.add_argument("--color", help="The color to set the light to (e.g., red, blue, green).")
     parser.add_argument("--cycle-speed", type=float, default=1.0, help="The speed of the color cycle in seconds (default: 1.0).")
     parser.add_argument("--serial-numbers", nargs='+', help="A list of device serial numbers to target.")
+    parser.add_argument("--scene-file", default="meross_scene.json", help="The scene file used by save-scene and restore-scene (default: meross_scene.json).")
+    parser.add_argument("--restore-scene", action="store_true", help="When cycle-colors stops, put the light back the way it was instead of turning it off.")
+    parser.add_argument("--profile", nargs='?', const=DEFAULT_OUTPUT, metavar="PREFIX", help="Profile the run and write PREFIX.collapsed, PREFIX.svg (flamegraph) and PREFIX-lag.json (event-loop lag); the prefix defaults to meross_profile.")
+    parser.add_argument("--trace", metavar="FILE", help="Record every device command, its acknowledgement and round-trip to FILE (gzipped JSON lines), to replay with replay_trace.py.")
     parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose (DEBUG) logging.")
     args = parser.parse_args()
     # Validate arguments
@@ -152,8 +180,9 @@ def main():
     if args.action == "color" and not args.color:
         parser.error("When action is 'color', you must specify the --color argument.")
         
+    start_trace(args.trace)
     try:
-        asyncio.run(discover_and_control_lights(
+        asyncio.run(run_profiled(discover_and_control_lights(
             email=email,
             password=password,
             action=args.action,
@@ -161,8 +190,10 @@ def main():
             color=args.color,
             cycle_speed=args.cycle_speed,
             serial_numbers=args.serial_numbers,
+            scene_file=args.scene_file,
+            restore_prior_scene=args.restore_scene,
             verbose=args.verbose
-        ))
+        ), args.profile))
     except KeyboardInterrupt:
         print("\nScript interrupted by user.")
 
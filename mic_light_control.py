@@ -1,93 +1,328 @@
 import argparse
 import asyncio
+import contextlib
 import logging
+import sys
+import time
 import numpy as np
 import sounddevice as sd
 import json
 from cryptography.fernet import Fernet, InvalidToken
-from meross_iot.controller.mixins.light import LightMixin
-from meross_iot.http_api import MerossHttpClient
-from meross_iot.manager import MerossManager
+from startup import StartupGraph, add_light_steps, async_close_login
+from audio_features import SpectrumAnalyzer, assign_bands, band_hues, levels_to_light_values, make_band_edges
+from audio_capture_process import AudioCaptureProcess
+from light_output_filter import LightOutputFilter
+from light_commands import LightCommandBuilder
+from command_executor import CommandExecutor
+from light_scenes import snapshot_scene, release_lights
+from hot_path_log import HotPathLog
+from profiler import DEFAULT_OUTPUT, run_profiled
+from command_trace import start_trace
+
+# How often the control process checks the capture process ring buffer for new features
+CAPTURE_POLL_INTERVAL = 0.01
+# How often capture process counters are logged
+CAPTURE_STATS_INTERVAL = 10.0
 
 # Setup basic logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-async def mic_to_light(email: str, password: str, light_names: list, sensitivity: float, verbose: bool = False):
+def positive_int(value: str) -> int:
+    """argparse type for counts that must be at least 1."""
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"'{value}' is not a whole number")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
+
+async def mic_to_light(email: str, password: str, light_names: list, sensitivity: float, mode: str = "luminance",
+                       bands: int = None, fmin: float = 40.0, fmax: float = None, update_interval: float = 0.1,
+                       luminance_threshold: int = 5, color_threshold: int = 16, capture_process: bool = False,
+                       command_deadline: float = 2.0, hedge_after: float = None, restore_scene: bool = False,
+                       verbose: bool = False):
     if verbose:
         logging.getLogger().setLevel(logging.DEBUG)
 
-    # Setup Meross HTTP API client and manager
-    http_client = await MerossHttpClient.async_from_user_password(email=email, password=password, api_base_url="https://iot.meross.com")
-    manager = MerossManager(http_client=http_client)
+    loop = asyncio.get_running_loop()
+    state = {}
+    # One volume line per interval at DEBUG, and a summary line, instead of a line per audio block
+    hot_log = HotPathLog("mic")
+
+    def audio_callback(indata, frames, time, status):
+        # Only called once the stream is started, after startup filled in the state
+        volume_norm = np.linalg.norm(indata) * 10
+        luminance = min(100, int(volume_norm * sensitivity))
+        hot_log.update("Volume: %.2f, Luminance: %d", volume_norm, luminance)
+        loop.call_soon_threadsafe(asyncio.create_task, set_lights_luminance(state["lights"], luminance))
+
+    def spectrum_bands(lights):
+        n_bands = bands or len(lights)
+        if n_bands > len(lights):
+            logging.warning(f"{n_bands} bands requested but only {len(lights)} light(s) available, using {len(lights)} bands.")
+            n_bands = len(lights)
+        return n_bands
+
+    def open_capture_process(lights=None):
+        if mode == "spectrum" and not lights:
+            # Nothing to map bands to; reported as "No target lights found" once startup is done
+            return None
+        n_features = spectrum_bands(lights) if mode == "spectrum" else 1
+        capture = AudioCaptureProcess(mode, n_features, sensitivity=sensitivity, fmin=fmin, fmax=fmax)
+        samplerate = capture.start()
+        logging.info(f"Audio capture running in a separate process at {samplerate:.0f} Hz.")
+        return capture
+
+    def open_input_stream():
+        # Opening the device is slow, the stream only starts delivering once it is started
+        return sd.InputStream(callback=audio_callback)
+
+    def query_samplerate():
+        return sd.query_devices(kind='input')['default_samplerate']
+
+    def warm_up_analyzer(samplerate, lights):
+        if not lights:
+            return None
+        # The luminance mode treats 10 as a neutral sensitivity, keep the same scale here
+        analyzer = SpectrumAnalyzer(samplerate, spectrum_bands(lights), fmin=fmin, fmax=fmax, sensitivity=sensitivity / 10.0)
+        analyzer.process(np.zeros(1024))
+        return analyzer
 
-    # Discover devices
+    # Login, MQTT connection, discovery and the light state fetch run as a dependency graph, and the
+    # audio setup runs alongside. The spectrum mode needs the number of lights, so it waits for discovery.
+    startup = StartupGraph()
+    add_light_steps(startup, email, password, light_names)
+    light_deps = ("discovery",) if mode == "spectrum" else ()
+    if capture_process:
+        startup.step("audio capture", open_capture_process, *light_deps, blocking=True)
+    elif mode == "spectrum":
+        startup.step("audio device", query_samplerate, blocking=True)
+        startup.step("dsp warm-up", warm_up_analyzer, "audio device", "discovery", blocking=True)
+    else:
+        startup.step("audio device", open_input_stream, blocking=True)
     try:
-        await manager.async_init()
-        await manager.async_device_discovery()
+        results = await startup.run()
         logging.info("MerossManager initialized and devices discovered.")
+        startup.log_report()
     except Exception as e:
         logging.error(f"Failed to initialize MerossManager: {e}")
-        await http_client.async_logout()
+        close_audio(startup.results)
+        await async_close_login(startup)
         return
-
-    all_devices = manager.find_devices()
-    controllable_lights = [dev for dev in all_devices if isinstance(dev, LightMixin)]
-
-    target_lights = []
-    if light_names:
-        for light_name in light_names:
-            light = next((l for l in controllable_lights if l.name.lower() == light_name.lower()), None)
-            if light:
-                target_lights.append(light)
-            else:
-                logging.warning(f"Light '{light_name}' not found.")
-    else:
-        target_lights.extend(controllable_lights)
+    http_client = results["login"]
+    target_lights = results["light state"]
+    state["lights"] = target_lights
 
     if not target_lights:
         logging.error("No target lights found.")
+        close_audio(results)
         await http_client.async_logout()
         return
 
-    # Update the state of all target lights
-    tasks = [light.async_update() for light in target_lights]
-    await asyncio.gather(*tasks)
-
-    # Explicitly turn on the lights
-    tasks = [light.async_turn_on() for light in target_lights]
-    await asyncio.gather(*tasks)
+    prior_scene = snapshot_scene(target_lights) if restore_scene else None
 
+    # The lights are switched on by the first update, in the same message as its color/luminance
     logging.info(f"Listening to microphone... Lights: {[light.name for light in target_lights]}. Press Ctrl+C to stop.")
 
-    loop = asyncio.get_running_loop()
+    # Keeps a dead bulb from stalling the updates of the others
+    executor = CommandExecutor(deadline=command_deadline, hedge_after=hedge_after)
+
+    if mode == "spectrum":
+        capture = results.get("audio capture")
+        analyzer = results.get("dsp warm-up")
+        # Also stops the capture process and logs out when the mode fails before its own cleanup is in place
+        try:
+            await run_spectrum_mode(target_lights, loop, capture, analyzer, fmin, fmax, update_interval,
+                                    luminance_threshold, color_threshold, executor, prior_scene, startup)
+        finally:
+            close_audio(results)
+            await http_client.async_logout()
+        return
+
+    output_filter = LightOutputFilter(luminance_threshold=luminance_threshold, color_threshold=color_threshold)
+    for light in target_lights:
+        output_filter.seed(light)
+    commands = LightCommandBuilder(output_filter, executor=executor)
+    hot_log.track_commands(commands)
+
+    if capture_process:
+        try:
+            await run_luminance_capture_process(target_lights, results["audio capture"], sensitivity,
+                                                update_interval, commands, prior_scene, startup)
+        finally:
+            close_audio(results)
+            await http_client.async_logout()
+        return
 
     async def set_lights_luminance(lights, luminance):
-        tasks = [light.async_set_light_color(luminance=luminance) for light in lights]
-        await asyncio.gather(*tasks)
+        await send_luminance(lights, luminance, commands)
+        startup.mark("first light command")
         await asyncio.sleep(0.05) # Add a small delay to prevent overwhelming the devices
 
-    def audio_callback(indata, frames, time, status):
-        volume_norm = np.linalg.norm(indata) * 10
-        luminance = min(100, int(volume_norm * sensitivity))
-        print(f"Volume: {volume_norm:.2f}, Luminance: {luminance}")
-        loop.call_soon_threadsafe(asyncio.create_task, set_lights_luminance(target_lights, luminance))
-
     try:
-        with sd.InputStream(callback=audio_callback):
+        with results["audio device"]:
             await asyncio.Future()  # Run forever
 
     except asyncio.CancelledError:
         logging.info("Mic listening stopped.")
     finally:
-        logging.info("Turning off all lights.")
-        tasks = [light.async_turn_off() for light in target_lights]
-        await asyncio.gather(*tasks)
+        hot_log.log_summary()
+        output_filter.log_summary()
+        commands.log_summary()
+        await release_lights(target_lights, prior_scene, executor)
+        executor.log_health()
         await http_client.async_logout()
 
+def close_audio(results: dict):
+    """Release audio resources opened during a startup that did not complete."""
+    if results.get("audio capture") is not None:
+        results["audio capture"].stop()
+    stream = results.get("audio device")
+    if isinstance(stream, sd.InputStream):
+        stream.close()
+
+async def send_luminance(lights: list, luminance: int, commands: LightCommandBuilder):
+    """Switch the lights on at the given luminance, sending only what changed since the last update."""
+    for light in lights:
+        commands.set(light, onoff=True, luminance=luminance)
+    await commands.flush()
+
+async def next_captured_features(capture: AudioCaptureProcess, stats_state: dict):
+    """Wait for the next feature row from the capture process, logging its counters now and then."""
+    while True:
+        now = time.monotonic()
+        if now - stats_state.setdefault("last_log", now) >= CAPTURE_STATS_INTERVAL:
+            stats_state["last_log"] = now
+            logging.info(f"Capture stats: {capture.stats()}")
+        features = capture.poll()
+        if features is not None:
+            return features
+        await asyncio.sleep(CAPTURE_POLL_INTERVAL)
+
+async def run_luminance_capture_process(target_lights: list, capture: AudioCaptureProcess, sensitivity: float,
+                                        update_interval: float, commands: LightCommandBuilder, prior_scene: dict = None,
+                                        startup: StartupGraph = None):
+    """Luminance mode with audio capture and analysis moved to a separate (already started) process."""
+    stats_state = {}
+    hot_log = HotPathLog("mic")
+    hot_log.track_commands(commands)
+    try:
+        while True:
+            features = await next_captured_features(capture, stats_state)
+            volume_norm = features[0]
+            luminance = min(100, int(volume_norm * sensitivity))
+            hot_log.update("Volume: %.2f, Luminance: %d", volume_norm, luminance)
+            await send_luminance(target_lights, luminance, commands)
+            if startup is not None:
+                startup.mark("first light command")
+            await asyncio.sleep(update_interval)
+
+    except asyncio.CancelledError:
+        logging.info("Mic listening stopped.")
+    finally:
+        hot_log.log_summary()
+        logging.info(f"Capture stats: {capture.stats()}")
+        capture.stop()
+        commands.output_filter.log_summary()
+        commands.log_summary()
+        await release_lights(target_lights, prior_scene, commands.executor)
+        commands.executor.log_health()
+
+async def run_spectrum_mode(target_lights: list, loop, capture: AudioCaptureProcess, analyzer: SpectrumAnalyzer,
+                            fmin: float, fmax: float, update_interval: float, luminance_threshold: int,
+                            color_threshold: int, executor: CommandExecutor = None, prior_scene: dict = None,
+                            startup: StartupGraph = None):
+    """Spectrum analyzer mode: every frequency band drives the hue and brightness of its own light group.
+
+    Audio comes either from an already started capture process or from a local
+    stream analysed by analyzer.
+    """
+    if capture is not None:
+        n_bands = capture.n_features
+        samplerate = capture.samplerate
+        edges = make_band_edges(n_bands, samplerate, fmin, fmax)
+    else:
+        n_bands = analyzer.n_bands
+        samplerate = analyzer.samplerate
+        edges = analyzer.edges
+    hues = band_hues(n_bands)
+    light_bands = assign_bands(len(target_lights), n_bands)
+    for band, (low, high) in enumerate(zip(edges[:-1], edges[1:])):
+        names = [light.name for light, b in zip(target_lights, light_bands) if b == band]
+        logging.info(f"Band {band + 1}: {low:.0f}-{high:.0f} Hz -> {names}")
+
+    latest = {"levels": None}
+    new_levels = asyncio.Event()
+    stats_state = {}
+
+    def publish_levels(levels):
+        latest["levels"] = levels
+        new_levels.set()
+
+    def audio_callback(indata, frames, time, status):
+        # Only the newest analysis matters, older frames are simply overwritten
+        loop.call_soon_threadsafe(publish_levels, analyzer.process(indata))
+
+    async def next_levels():
+        if capture is not None:
+            return await next_captured_features(capture, stats_state)
+        await new_levels.wait()
+        new_levels.clear()
+        return latest["levels"]
+
+    # Skips per-light changes too small to notice
+    output_filter = LightOutputFilter(luminance_threshold=luminance_threshold, color_threshold=color_threshold)
+    for light in target_lights:
+        output_filter.seed(light)
+    executor = executor or CommandExecutor()
+    commands = LightCommandBuilder(output_filter, executor=executor)
+    hot_log = HotPathLog("mic spectrum")
+    hot_log.track_commands(commands)
+
+    try:
+        stream = contextlib.nullcontext() if capture else sd.InputStream(samplerate=samplerate, callback=audio_callback)
+        with stream:
+            while True:
+                levels = await next_levels()
+                rgb_values, luminances = levels_to_light_values(levels, hues, light_bands)
+                for light, rgb, luminance in zip(target_lights, rgb_values.tolist(), luminances.tolist()):
+                    commands.set(light, onoff=True, rgb=rgb, luminance=luminance)
+                await commands.flush()
+                hot_log.update("Band levels: %s", levels)
+                if startup is not None:
+                    startup.mark("first light command")
+                await asyncio.sleep(update_interval)
+
+    except asyncio.CancelledError:
+        logging.info("Mic listening stopped.")
+    finally:
+        hot_log.log_summary()
+        if capture is not None:
+            logging.info(f"Capture stats: {capture.stats()}")
+            capture.stop()
+        output_filter.log_summary()
+        commands.log_summary()
+        await release_lights(target_lights, prior_scene, executor)
+        executor.log_health()
+
 def main():
     parser = argparse.ArgumentParser(description="Control Meross smart lights with your microphone.")
-    parser.add_argument("--light-names", nargs='+', required=True, help="The name(s) of the light(s) to control.")
+    parser.add_argument("--light-names", nargs='+', required=True, help="The name(s) of the light(s) to control. Also accepts aliases, group:<name>, tag:<name> and glob patterns.")
     parser.add_argument("--sensitivity", type=float, default=10.0, help="The sensitivity of the microphone (default: 10.0).")
+    parser.add_argument("--mode", choices=["luminance", "spectrum"], default="luminance", help="'luminance' drives the brightness of all lights from the volume, 'spectrum' maps frequency bands to different lights (default: luminance).")
+    parser.add_argument("--bands", type=positive_int, help="Number of frequency bands in spectrum mode (default: one per light).")
+    parser.add_argument("--fmin", type=float, default=40.0, help="Lowest frequency in Hz analysed in spectrum mode (default: 40).")
+    parser.add_argument("--fmax", type=float, help="Highest frequency in Hz analysed in spectrum mode (default: half the sample rate).")
+    parser.add_argument("--update-interval", type=float, default=0.1, help="Minimum seconds between light updates in spectrum mode or with --capture-process (default: 0.1).")
+    parser.add_argument("--luminance-threshold", type=int, default=5, help="Minimum luminance change sent to a light (default: 5).")
+    parser.add_argument("--color-threshold", type=int, default=16, help="Minimum per-channel RGB change sent to a light (default: 16).")
+    parser.add_argument("--capture-process", action="store_true", help="Run audio capture and analysis in a separate process that shares features through shared memory.")
+    parser.add_argument("--command-deadline", type=float, default=2.0, help="Seconds a light gets to acknowledge a command before it counts as failed (default: 2.0).")
+    parser.add_argument("--hedge-after", type=float, help="Send a second copy of a command that has not been acknowledged after this many seconds.")
+    parser.add_argument("--restore-scene", action="store_true", help="When stopping, put the lights back the way they were instead of turning them off.")
+    parser.add_argument("--profile", nargs='?', const=DEFAULT_OUTPUT, metavar="PREFIX", help="Profile the run and write PREFIX.collapsed, PREFIX.svg (flamegraph) and PREFIX-lag.json (event-loop lag); the prefix defaults to meross_profile.")
+    parser.add_argument("--trace", metavar="FILE", help="Record every device command, its acknowledgement and round-trip to FILE (gzipped JSON lines), to replay with replay_trace.py.")
     parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose (DEBUG) logging.")
     args = parser.parse_args()
 
@@ -129,16 +364,29 @@ def main():
         print("Error: Failed to decrypt password. The encryption key may have changed.", file=sys.stderr)
         sys.exit(1)
 
+    start_trace(args.trace)
     try:
-        asyncio.run(
+        asyncio.run(run_profiled(
             mic_to_light(
                 email=email,
                 password=password,
                 light_names=args.light_names,
                 sensitivity=args.sensitivity,
+                mode=args.mode,
+                bands=args.bands,
+                fmin=args.fmin,
+                fmax=args.fmax,
+                update_interval=args.update_interval,
+                luminance_threshold=args.luminance_threshold,
+                color_threshold=args.color_threshold,
+                capture_process=args.capture_process,
+                command_deadline=args.command_deadline,
+                hedge_after=args.hedge_after,
+                restore_scene=args.restore_scene,
                 verbose=args.verbose
-            )
-        )
+            ),
+            args.profile
+        ))
     except KeyboardInterrupt:
         print("\nScript interrupted by user.")
     except Exception as e:
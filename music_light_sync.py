@@ -2,15 +2,25 @@ import argparse
 import asyncio
 import logging
 import json
+import sys
 from cryptography.fernet import Fernet, InvalidToken
-from meross_iot.controller.mixins.light import LightMixin
-from meross_iot.http_api import MerossHttpClient
-from meross_iot.manager import MerossManager
+from startup import StartupGraph, add_light_steps, async_close_login
+from light_output_filter import LightOutputFilter
+from light_commands import LightCommandBuilder
+from command_executor import CommandExecutor
+from connection_supervisor import ConnectionSupervisor
+from group_sync import SyncGroupDispatcher
+from light_scenes import snapshot_scene, release_lights
+from hot_path_log import HotPathLog
+from profiler import DEFAULT_OUTPUT, run_profiled
+from command_trace import start_trace
 
 # Setup basic logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-async def pulse_lights(email: str, password: str, light_names: list, bpm: int, color: str = None, multicolor: bool = False, verbose: bool = False):
+async def pulse_lights(email: str, password: str, light_names: list, bpm: int, color: str = None, multicolor: bool = False,
+                       command_deadline: float = 2.0, hedge_after: float = None, skew_compensation: bool = True,
+                       restore_scene: bool = False, connection_metrics: str = None, verbose: bool = False):
     if verbose:
         logging.getLogger().setLevel(logging.DEBUG)
 
@@ -26,39 +36,28 @@ async def pulse_lights(email: str, password: str, light_names: list, bpm: int, c
     color_names = list(COLORS.keys())
     color_index = 0
 
-    # Setup Meross HTTP API client and manager
-    http_client = await MerossHttpClient.async_from_user_password(email=email, password=password, api_base_url="https://iot.meross.com")
-    manager = MerossManager(http_client=http_client)
-
-    # Discover devices
+    # Login, MQTT connection, discovery and the light state fetch run as a dependency graph,
+    # so independent steps overlap
+    startup = StartupGraph()
+    add_light_steps(startup, email, password, light_names)
     try:
-        await manager.async_init()
-        await manager.async_device_discovery()
+        results = await startup.run()
         logging.info("MerossManager initialized and devices discovered.")
+        startup.log_report()
     except Exception as e:
         logging.error(f"Failed to initialize MerossManager: {e}")
-        await http_client.async_logout()
+        await async_close_login(startup)
         return
-
-    all_devices = manager.find_devices()
-    controllable_lights = [dev for dev in all_devices if isinstance(dev, LightMixin)]
-
-    target_lights = []
-    if light_names:
-        for light_name in light_names:
-            light = next((l for l in controllable_lights if l.name.lower() == light_name.lower()), None)
-            if light:
-                target_lights.append(light)
-            else:
-                logging.warning(f"Light '{light_name}' not found.")
-    else:
-        target_lights.extend(controllable_lights)
+    http_client = results["login"]
+    target_lights = results["light state"]
 
     if not target_lights:
         logging.error("No target lights found.")
         await http_client.async_logout()
         return
 
+    prior_scene = snapshot_scene(target_lights) if restore_scene else None
+
     # Set initial color if provided and not in multicolor mode
     if color and not multicolor:
         rgb = COLORS.get(color.lower())
@@ -66,6 +65,7 @@ async def pulse_lights(email: str, password: str, light_names: list, bpm: int, c
             logging.info(f"Setting color to {color}...")
             tasks = [light.async_set_light_color(rgb=rgb) for light in target_lights]
             await asyncio.gather(*tasks)
+            startup.mark("first light command")
         else:
             logging.error(f"Invalid color: {color}. Supported colors are: {list(COLORS.keys())}")
             await http_client.async_logout()
@@ -74,41 +74,73 @@ async def pulse_lights(email: str, password: str, light_names: list, bpm: int, c
     logging.info(f"Pulsing lights: {[light.name for light in target_lights]} at {bpm} BPM. Press Ctrl+C to stop.")
 
     beat_interval = 60.0 / bpm
+    output_filter = LightOutputFilter()
+    for light in target_lights:
+        output_filter.seed(light)
+    executor = CommandExecutor(deadline=command_deadline, hedge_after=hedge_after)
+    # Stagger the sends so every beat lands on all lights at once
+    group_sync = SyncGroupDispatcher(executor, compensate=skew_compensation)
+    commands = LightCommandBuilder(output_filter, dispatcher=group_sync)
+    hot_log = HotPathLog("pulse", level=logging.INFO)
+    hot_log.track_commands(commands)
+
+    # A dropped connection pauses the pulse; once it is back the lights get their full state again
+    supervisor = ConnectionSupervisor(results["manager"], http_client, email, password, target_lights,
+                                      metrics_file=connection_metrics)
+    supervisor.on_reconnect(executor.reset_breakers)
+    supervisor.on_reconnect(lambda: [output_filter.forget(light) for light in target_lights])
+    supervisor.start()
+    beat_origin = asyncio.get_running_loop().time()
 
     try:
         while True:
+            # After a pause the pulse picks up again on the next beat
+            await supervisor.wait_connected(beat_interval, beat_origin)
+            # Turn on all lights, in multicolor mode in the same message as the beat's color
+            rgb = None
+            color_name = color or "unchanged"
             if multicolor:
                 color_name = color_names[color_index]
                 rgb = COLORS[color_name]
-                logging.info(f"Pulsing color: {color_name}")
-                tasks = [light.async_set_light_color(rgb=rgb) for light in target_lights]
-                await asyncio.gather(*tasks)
                 color_index = (color_index + 1) % len(color_names)
-
-            # Turn on all lights
-            tasks = [light.async_turn_on() for light in target_lights]
-            await asyncio.gather(*tasks)
+            for light in target_lights:
+                commands.set(light, onoff=True, rgb=rgb)
+            await commands.flush()
+            hot_log.update("Pulsing color: %s", color_name)
+            startup.mark("first light command")
             await asyncio.sleep(0.1)  # Keep the light on for a short pulse
 
             # Turn off all lights
-            tasks = [light.async_turn_off() for light in target_lights]
-            await asyncio.gather(*tasks)
+            for light in target_lights:
+                commands.set(light, onoff=False)
+            await commands.flush()
             await asyncio.sleep(beat_interval - 0.1)
 
     except asyncio.CancelledError:
         logging.info("Light pulsing stopped.")
     finally:
-        logging.info("Turning off all lights.")
-        tasks = [light.async_turn_off() for light in target_lights]
-        await asyncio.gather(*tasks)
-        await http_client.async_logout()
+        hot_log.log_summary()
+        output_filter.log_summary()
+        commands.log_summary()
+        await release_lights(target_lights, prior_scene, executor)
+        executor.log_health()
+        group_sync.log_report()
+        supervisor.log_stats()
+        await supervisor.close()
 
 def main():
     parser = argparse.ArgumentParser(description="Pulse Meross smart lights to a beat.")
-    parser.add_argument("--light-names", nargs='+', required=True, help="The name(s) of the light(s) to pulse.")
+    parser.add_argument("--light-names", nargs='+', required=True, help="The name(s) of the light(s) to pulse. Also accepts aliases, group:<name>, tag:<name> and glob patterns.")
     parser.add_argument("--bpm", type=int, default=120, help="The beats per minute to pulse the lights to (default: 120).")
     parser.add_argument("--color", help="The color to pulse the lights in.")
     parser.add_argument("--multicolor", action="store_true", help="Cycle through multiple colors with each pulse.")
+    parser.add_argument("--command-deadline", type=float, default=2.0, help="Seconds a light gets to acknowledge a command before it counts as failed (default: 2.0).")
+    parser.add_argument("--hedge-after", type=float, help="Send a second copy of a command that has not been acknowledged after this many seconds.")
+    parser.add_argument("--no-skew-compensation", action="store_true", help="Send to all lights at once instead of staggering the sends by each light's latency.")
+    parser.add_argument("--restore-scene", action="store_true", help="When stopping, put the lights back the way they were instead of turning them off.")
+    parser.add_argument("--connection-metrics", metavar="FILE", help="Write the connection drops, reconnect times and downtime to FILE as JSON whenever the connection changes state.")
+    parser.add_argument("--profile", nargs='?', const=DEFAULT_OUTPUT, metavar="PREFIX", help="Profile the run and write PREFIX.collapsed, PREFIX.svg (flamegraph) and PREFIX-lag.json (event-loop lag); the prefix defaults to meross_profile.")
+    parser.add_argument("--trace", metavar="FILE", help="Record every device command, its acknowledgement and round-trip to FILE (gzipped JSON lines), to replay with replay_trace.py.")
     parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose (DEBUG) logging.")
     args = parser.parse_args()
 
@@ -150,8 +182,9 @@ def main():
         print("Error: Failed to decrypt password. The encryption key may have changed.", file=sys.stderr)
         sys.exit(1)
 
+    start_trace(args.trace)
     try:
-        asyncio.run(
+        asyncio.run(run_profiled(
             pulse_lights(
                 email=email,
                 password=password,
@@ -159,9 +192,15 @@ def main():
                 bpm=args.bpm,
                 color=args.color,
                 multicolor=args.multicolor,
+                command_deadline=args.command_deadline,
+                hedge_after=args.hedge_after,
+                skew_compensation=not args.no_skew_compensation,
+                restore_scene=args.restore_scene,
+                connection_metrics=args.connection_metrics,
                 verbose=args.verbose
-            )
-        )
+            ),
+            args.profile
+        ))
     except KeyboardInterrupt:
         print("\nScript interrupted by user.")
 
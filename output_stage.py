@@ -0,0 +1,68 @@
+import asyncio
+import logging
+
+from light_commands import LightCommandBuilder
+
+# Coalescing output stage for external frame sources.
+#
+# Lighting consoles and other programs push frames far faster than the bulbs
+# can take commands. Sources submit the full state they want for a light, which
+# replaces whatever was still waiting for that light, and a single output loop
+# sends the newest states at its own pace through a LightCommandBuilder. With
+# an output filter on the builder, states equal to what the light already shows
+# are dropped, so only the latest changed values reach the bulbs.
+
+
+class CoalescingOutput:
+    """Latest-value-wins staging between fast frame sources and the lights."""
+
+    def __init__(self, commands: LightCommandBuilder, update_interval: float = 0.05, hot_log=None):
+        self.commands = commands
+        self.update_interval = update_interval
+        # An optional HotPathLog that counts every output tick
+        self.hot_log = hot_log
+        self._latest = {}
+        self._wakeup = asyncio.Event()
+        self.received = 0
+        self.coalesced = 0
+        self.ticks = 0
+
+    def submit(self, light, onoff: bool = None, rgb: tuple = None, luminance: int = None) -> bool:
+        """Stage the state a light should have. Returns True when it replaced a state that was never sent."""
+        fields = {}
+        if onoff is not None:
+            fields["onoff"] = onoff
+        if rgb is not None:
+            fields["rgb"] = tuple(rgb)
+        if luminance is not None:
+            fields["luminance"] = luminance
+        self.received += 1
+        replaced = light.uuid in self._latest
+        if replaced:
+            self.coalesced += 1
+        self._latest[light.uuid] = (light, fields)
+        self._wakeup.set()
+        return replaced
+
+    async def run(self):
+        """Send staged states until cancelled, at most once per update_interval."""
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            pending, self._latest = self._latest, {}
+            for light, fields in pending.values():
+                self.commands.set(light, **fields)
+            self.ticks += 1
+            await self.commands.flush()
+            if self.hot_log is not None:
+                self.hot_log.update("Output tick: %d light state(s)", len(pending))
+            await asyncio.sleep(self.update_interval)
+
+    def stats(self) -> dict:
+        return {"received": self.received, "coalesced": self.coalesced, "ticks": self.ticks,
+                "messages_sent": self.commands.messages_sent}
+
+    def log_summary(self):
+        if self.received:
+            logging.info(f"Output stage: {self.received} light state(s) received, {self.coalesced} replaced "
+                         f"before sending, {self.ticks} output tick(s), {self.commands.messages_sent} message(s) sent.")
@@ -0,0 +1,282 @@
+import asyncio
+import bisect
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import zlib
+from collections import Counter
+
+# Built-in sampling profiler.
+#
+# A background thread reads the stack of every thread through
+# sys._current_frames() at a fixed interval and counts each distinct stack.
+# Stacks are labelled by what the thread is doing: the asyncio loop thread is
+# split by task, with the event loop machinery above the task left out and
+# time spent waiting in select() counted as idle; threads running sounddevice
+# callbacks are labelled as the audio callback and the thread running Tk as tk.
+# Alongside, a coroutine on the loop measures how late its sleeps wake up,
+# which is the delay every other coroutine sees as well.
+#
+# Output, for a prefix such as meross_profile:
+#     meross_profile.collapsed   one "frame;frame;frame count" line per stack, for flamegraph.pl or speedscope
+#     meross_profile.svg         a flamegraph of the same stacks
+#     meross_profile-lag.json    the event-loop lag histogram
+
+DEFAULT_OUTPUT = "meross_profile"
+# Upper bounds of the lag histogram buckets in ms; the last bucket is everything above
+LAG_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+_ASYNCIO_DIR = os.path.dirname(asyncio.__file__)
+
+
+def _frame_label(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ":")
+
+
+class SamplingProfiler:
+    """Samples the stacks of all threads from a background thread and counts them."""
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.loop_samples = 0
+        self.loop_idle = 0
+        self._loop = None
+        self._loop_thread = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._thread_names = {}
+        self._names_refreshed = 0.0
+
+    def attach_loop(self, loop, thread_id: int = None):
+        """Tell the profiler which thread runs the asyncio loop, so its samples are split by task."""
+        self._loop = loop
+        self._loop_thread = thread_id if thread_id is not None else threading.get_ident()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        own = threading.get_ident()
+        next_sample = time.perf_counter()
+        while not self._stop.is_set():
+            self._sample(own)
+            next_sample += self.interval
+            delay = next_sample - time.perf_counter()
+            if delay > 0:
+                self._stop.wait(delay)
+            else:
+                # Fell behind, start counting from now instead of sampling in a burst
+                next_sample = time.perf_counter()
+
+    def _sample(self, own: int):
+        now = time.monotonic()
+        frames = sys._current_frames()
+        if now - self._names_refreshed > 1.0 or not frames.keys() <= self._thread_names.keys():
+            self._thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            self._names_refreshed = now
+        self.samples += 1
+        for thread_id, frame in frames.items():
+            if thread_id == own:
+                continue
+            codes = []
+            while frame is not None:
+                codes.append(frame.f_code)
+                frame = frame.f_back
+            codes.reverse()
+            self.stacks[self._label(thread_id, codes)] += 1
+
+    def _label(self, thread_id: int, codes: list) -> str:
+        name = self._thread_names.get(thread_id, f"thread-{thread_id}")
+        if thread_id == self._loop_thread:
+            return self._loop_label(name, codes)
+        files = [code.co_filename for code in codes]
+        if any("sounddevice" in filename for filename in files):
+            root = f"audio callback ({name})"
+        elif any(f"{os.sep}tkinter{os.sep}" in filename for filename in files):
+            root = f"tk ({name})"
+        else:
+            root = f"thread {name}"
+        return ";".join([root] + [_frame_label(code) for code in codes])
+
+    def _loop_label(self, name: str, codes: list) -> str:
+        self.loop_samples += 1
+        root = f"asyncio ({name})"
+        top = codes[-1] if codes else None
+        if top is not None and top.co_name in ("select", "poll", "_poll") and "selectors" in top.co_filename:
+            self.loop_idle += 1
+            return f"{root};[idle]"
+        # Everything up to the handle being run is event loop machinery
+        start = 0
+        for i, code in enumerate(codes):
+            if code.co_name == "_run" and code.co_filename.startswith(_ASYNCIO_DIR):
+                start = i + 1
+        if start == 0:
+            return ";".join([root] + [_frame_label(code) for code in codes])
+        task = getattr(asyncio.tasks, "_current_tasks", {}).get(self._loop)
+        owner = f"task {task.get_name()}" if task is not None else "callback"
+        return ";".join([root, owner] + [_frame_label(code) for code in codes[start:]])
+
+    def self_time(self, top: int = 10) -> list:
+        """Return [(samples, frame)] of the frames most often on top of a stack."""
+        counts = Counter()
+        for stack, count in self.stacks.items():
+            counts[stack.rsplit(";", 1)[-1]] += count
+        return counts.most_common(top)
+
+
+class LoopLagMonitor:
+    """Measures how late sleeps on the event loop wake up, as a histogram."""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.counts = [0] * (len(LAG_BUCKETS_MS) + 1)
+        self.lags = []
+        self.max_ms = 0.0
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag_ms = max(loop.time() - start - self.interval, 0.0) * 1000
+            self.counts[bisect.bisect_left(LAG_BUCKETS_MS, lag_ms)] += 1
+            self.max_ms = max(self.max_ms, lag_ms)
+            # Keep a bounded sample for the percentiles of long sessions
+            if len(self.lags) < 100000:
+                self.lags.append(lag_ms)
+
+    def report(self) -> dict:
+        lags = sorted(self.lags)
+
+        def percentile(p):
+            return round(lags[min(int(len(lags) * p), len(lags) - 1)], 2) if lags else None
+
+        labels = [f"<={bound}" for bound in LAG_BUCKETS_MS] + [f">{LAG_BUCKETS_MS[-1]}"]
+        return {
+            "interval_ms": self.interval * 1000,
+            "measurements": sum(self.counts),
+            "buckets_ms": dict(zip(labels, self.counts)),
+            "p50_ms": percentile(0.5),
+            "p99_ms": percentile(0.99),
+            "max_ms": round(self.max_ms, 2),
+        }
+
+
+def write_flamegraph_svg(stacks: Counter, path: str, title: str = "Meross lights profile", width: int = 1200):
+    """Render collapsed stacks as a self-contained flamegraph SVG (root at the bottom)."""
+    tree = {"children": {}, "count": 0}
+    for stack, count in stacks.items():
+        node = tree
+        node["count"] += count
+        for frame in stack.split(";"):
+            node = node["children"].setdefault(frame, {"children": {}, "count": 0})
+            node["count"] += count
+
+    def depth_of(node):
+        return 1 + max((depth_of(child) for child in node["children"].values()), default=0)
+
+    row = 16
+    depth = depth_of(tree) - 1
+    height = (depth + 2) * row + 10
+    total = max(tree["count"], 1)
+    rects = []
+
+    def place(node, x, level):
+        for name, child in sorted(node["children"].items()):
+            w = child["count"] / total * (width - 20)
+            if w >= 0.5:
+                rects.append((name, child["count"], x, level, w))
+                place(child, x, level + 1)
+            x += w
+
+    place(tree, 10.0, 0)
+    escape = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;"})
+    lines = [f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" font-family="monospace" font-size="11">',
+             f'<text x="10" y="14">{title.translate(escape)} ({total} samples)</text>']
+    for name, count, x, level, w in rects:
+        y = height - (level + 1) * row - 4
+        hue = zlib.crc32(name.split(" (")[0].encode()) % 60
+        label = name.translate(escape)
+        lines.append(f'<g><title>{label} - {count} samples ({count / total:.1%})</title>'
+                     f'<rect x="{x:.1f}" y="{y}" width="{w:.1f}" height="{row - 1}" fill="hsl({hue},80%,60%)"/>')
+        chars = int(w / 7)
+        if chars >= 3:
+            text = name if len(name) <= chars else name[:chars - 2] + ".."
+            lines.append(f'<text x="{x + 2:.1f}" y="{y + 11}">{text.translate(escape)}</text>')
+        lines.append('</g>')
+    lines.append('</svg>')
+    with open(path, 'w') as f:
+        f.write("\n".join(lines))
+
+
+class ProfileSession:
+    """A sampling profiler plus an event-loop lag monitor, written out as one profile."""
+
+    def __init__(self, output: str = DEFAULT_OUTPUT, interval: float = 0.005):
+        self.output = output
+        self.profiler = SamplingProfiler(interval)
+        self.lag = LoopLagMonitor()
+        self._lag_task = None
+        self._loop = None
+
+    def start(self):
+        self.profiler.start()
+        logging.info(f"Profiling every {self.profiler.interval * 1000:.0f} ms, writing {self.output}.* on exit.")
+
+    def attach_loop(self, loop=None):
+        """Watch an event loop. Call from the thread running it, e.g. through call_soon_threadsafe."""
+        self._loop = loop or asyncio.get_running_loop()
+        self.profiler.attach_loop(self._loop)
+        self._lag_task = self._loop.create_task(self.lag.run())
+
+    def stop(self):
+        if self._lag_task is not None and self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._lag_task.cancel)
+        self.profiler.stop()
+        self.write()
+
+    def write(self):
+        profiler = self.profiler
+        with open(f"{self.output}.collapsed", 'w') as f:
+            for stack, count in profiler.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        write_flamegraph_svg(profiler.stacks, f"{self.output}.svg")
+        lag = self.lag.report()
+        with open(f"{self.output}-lag.json", 'w') as f:
+            json.dump(lag, f, indent=2)
+
+        logging.info(f"Profile: {profiler.samples} sample(s) written to {self.output}.collapsed and {self.output}.svg.")
+        if profiler.loop_samples:
+            busy = 1 - profiler.loop_idle / profiler.loop_samples
+            logging.info(f"Profile: event loop busy {busy:.0%} of the time.")
+        for count, frame in ((count, frame) for frame, count in profiler.self_time()):
+            logging.info(f"Profile: {count / max(profiler.samples, 1):6.1%} {frame}")
+        if lag["measurements"]:
+            logging.info(f"Event loop lag: p50 {lag['p50_ms']} ms, p99 {lag['p99_ms']} ms, max {lag['max_ms']} ms; "
+                         + ", ".join(f"{bucket} ms: {count}" for bucket, count in lag["buckets_ms"].items() if count))
+
+
+async def run_profiled(coro, output: str = None, interval: float = 0.005):
+    """Await coro, profiling the process while it runs when an output prefix is given."""
+    if output is None:
+        return await coro
+    session = ProfileSession(output, interval)
+    session.attach_loop()
+    session.start()
+    try:
+        return await coro
+    finally:
+        session.stop()
@@ -0,0 +1,55 @@
+import argparse
+import json
+import logging
+import sys
+from command_trace import run_replay
+
+# Setup basic logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+def print_report(report: dict):
+    print(f"Replayed {report['commands']} command(s) to {report['lights']} simulated light(s): "
+          + ", ".join(f"{count} {outcome}" for outcome, count in sorted(report["outcomes"].items())))
+    print(f"  Trace {report['trace_seconds']}s, replay {report['replay_seconds']}s on the loop clock, "
+          f"{report['wall_seconds']}s wall clock")
+    print(f"  Issue lag p50 {report['issue_lag_ms']['p50']} ms, p99 {report['issue_lag_ms']['p99']} ms, "
+          f"max {report['issue_lag_ms']['max']} ms")
+    print(f"  Round-trip p50 {report['round_trip_ms']['p50']} ms, p99 {report['round_trip_ms']['p99']} ms")
+    if report["outcomes"].get("cancelled"):
+        print(f"  {report['outcomes']['cancelled']} cancelled command(s) reached the lights, the caller stopped "
+              f"waiting for them (deadline cancels and hedges that lost the race)")
+    print(f"  Final state digest {report['state_digest']}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a command trace recorded with --trace against simulated lights, with the recorded timing, round-trips and losses.")
+    parser.add_argument("trace", help="The trace file to replay.")
+    parser.add_argument("--fast", action="store_true", help="Replay on a virtual clock that skips every wait: deterministic, and as fast as the machine goes.")
+    parser.add_argument("--speed", type=float, default=1.0, help="Play the trace this many times faster than it was recorded (default: 1.0).")
+    parser.add_argument("--report", metavar="FILE", help="Also write the report as JSON to FILE, e.g. to compare two versions on the same trace.")
+    args = parser.parse_args()
+
+    if args.speed <= 0:
+        print("Error: --speed must be positive.", file=sys.stderr)
+        sys.exit(1)
+    try:
+        report = run_replay(args.trace, speed=args.speed, fast=args.fast)
+    except FileNotFoundError:
+        print(f"Error: Trace file '{args.trace}' not found.", file=sys.stderr)
+        sys.exit(1)
+    except (OSError, json.JSONDecodeError) as e:
+        print(f"Error: Could not read trace file '{args.trace}': {e}", file=sys.stderr)
+        sys.exit(1)
+    except ValueError as e:
+        print(f"Error: {e} in '{args.trace}'.", file=sys.stderr)
+        sys.exit(1)
+    except KeyboardInterrupt:
+        print("\nReplay interrupted by user.")
+        return
+
+    print_report(report)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+import argparse
+import asyncio
+import datetime
+import logging
+import json
+import sys
+from cryptography.fernet import Fernet, InvalidToken
+from startup import StartupGraph, add_light_steps, async_close_login
+from light_schedule import SCHEDULE_FILE, MISFIRE_GRACE, LATE_THRESHOLD, Scheduler, load_schedule
+from light_registry import LightRegistry
+from light_commands import async_send_light_state
+from light_scenes import load_scene, restore_scene
+from command_executor import CommandExecutor
+from light_history import HISTORY_DIR, HistoryLockedError, HistoryWriter
+from simulated_lights import make_simulated_lights
+from profiler import DEFAULT_OUTPUT, run_profiled
+from command_trace import start_trace
+
+# Setup basic logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+def print_next_firings(rules: list, count: int = 20):
+    """Print the next firings of the schedule, without logging in."""
+    now = datetime.datetime.now().timestamp()
+    upcoming = []
+    for rule in rules:
+        when = rule.trigger.next_after(now)
+        if when is not None:
+            upcoming.append((when, rule))
+    upcoming.sort(key=lambda item: item[0])
+    print(f"Next firings of {len(rules)} rule(s):")
+    for when, rule in upcoming[:count]:
+        print(f"  {datetime.datetime.fromtimestamp(when).isoformat(sep=' ', timespec='seconds')}  {rule.name} "
+              f"({rule.trigger}): {rule.action} {rule.lights or 'all lights'}")
+
+async def run_schedule(email: str, password: str, rules: list, backend: str = "meross", tick: float = 1.0,
+                       misfire_grace: float = MISFIRE_GRACE, late_threshold: float = LATE_THRESHOLD,
+                       report_interval: float = 3600.0, sim_lights: int = 3, command_deadline: float = 5.0,
+                       hedge_after: float = None, history_dir: str = None, verbose: bool = False):
+    if verbose:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    http_client = None
+    registry_config = None
+    if backend == "meross":
+        # Discover every light once; the rules then run against the warm handles for as long as the process lives
+        startup = StartupGraph()
+        add_light_steps(startup, email, password)
+        try:
+            results = await startup.run()
+            logging.info("MerossManager initialized and devices discovered.")
+            startup.log_report()
+        except Exception as e:
+            logging.error(f"Failed to initialize MerossManager: {e}")
+            await async_close_login(startup)
+            return
+        http_client = results["login"]
+        lights = results["light state"]
+        registry_config = results["registry file"]
+    else:
+        lights = make_simulated_lights(sim_lights)
+        logging.info(f"Using {sim_lights} simulated light(s).")
+
+    if not lights:
+        logging.error("No target lights found.")
+        if http_client:
+            await http_client.async_logout()
+        return
+
+    registry = LightRegistry(lights, registry_config)
+    targets = {rule.name: registry.select(rule.lights) if rule.lights else list(lights) for rule in rules}
+    for rule in rules:
+        if not targets[rule.name]:
+            logging.warning(f"Rule '{rule.name}' matches no lights.")
+    history = None
+    if history_dir:
+        try:
+            history = HistoryWriter(history_dir)
+        except HistoryLockedError as e:
+            logging.error(f"{e}, running without a history.")
+    executor = CommandExecutor(deadline=command_deadline, hedge_after=hedge_after, history=history)
+
+    async def execute(rule) -> bool:
+        target_lights = targets[rule.name]
+        if not target_lights:
+            return False
+        if rule.action == "scene":
+            try:
+                scene = load_scene(rule.scene_file)
+            except (FileNotFoundError, json.JSONDecodeError, ValueError) as e:
+                logging.error(f"Rule '{rule.name}' could not load scene file '{rule.scene_file}': {e}")
+                return False
+            await restore_scene(target_lights, scene, executor)
+            return True
+        state = rule.state()
+        results = await executor.run_all(target_lights, lambda light: async_send_light_state(light, **state))
+        failed = [light.name for light in target_lights if not results[light.uuid]]
+        if failed:
+            logging.warning(f"Rule '{rule.name}' did not reach: {failed}")
+        return not failed
+
+    scheduler = Scheduler(rules, execute, tick=tick, misfire_grace=misfire_grace, late_threshold=late_threshold)
+
+    async def log_report():
+        while True:
+            await asyncio.sleep(report_interval)
+            scheduler.log_report()
+
+    logging.info(f"Running {len(rules)} rule(s) against {len(lights)} light(s). Press Ctrl+C to stop.")
+    if history:
+        history.start()
+    try:
+        await asyncio.gather(scheduler.run(), log_report())
+    except asyncio.CancelledError:
+        logging.info("Scheduler stopped.")
+    finally:
+        scheduler.log_report()
+        executor.log_health()
+        if history:
+            await history.close()
+        if http_client:
+            await http_client.async_logout()
+
+def main():
+    parser = argparse.ArgumentParser(description="Run timed scenes and routines against Meross smart lights from one resident process.")
+    parser.add_argument("--schedule-file", default=SCHEDULE_FILE, help=f"The schedule file with the rules (default: {SCHEDULE_FILE}).")
+    parser.add_argument("--next", type=int, nargs='?', const=20, metavar="COUNT", help="Print the next COUNT firings (default: 20) and exit, without logging in.")
+    parser.add_argument("--backend", choices=["meross", "simulated"], default="meross", help="Run the rules against the Meross lights or simulated lights (default: meross).")
+    parser.add_argument("--sim-lights", type=int, default=3, help="Number of simulated lights (default: 3).")
+    parser.add_argument("--tick", type=float, default=1.0, help="Resolution of the timer wheel in seconds; rules still fire at their exact time (default: 1.0).")
+    parser.add_argument("--misfire-grace", type=float, default=MISFIRE_GRACE, help=f"Seconds a firing may be overdue before it is skipped and counted as missed (default: {MISFIRE_GRACE:g}).")
+    parser.add_argument("--late-threshold", type=float, default=LATE_THRESHOLD, help=f"Seconds after which a firing counts as late (default: {LATE_THRESHOLD:g}).")
+    parser.add_argument("--report-interval", type=float, default=3600.0, help="Seconds between two logged reports of fired, late and missed rules (default: 3600).")
+    parser.add_argument("--command-deadline", type=float, default=5.0, help="Seconds a light gets to acknowledge a command before it counts as failed (default: 5.0).")
+    parser.add_argument("--hedge-after", type=float, help="Send a second copy of a command that has not been acknowledged after this many seconds.")
+    parser.add_argument("--history-dir", nargs='?', const=HISTORY_DIR, metavar="DIR", help="Keep a history of every light command and the state it left the light in, under DIR (default: light_history); query it with light_history_report.py.")
+    parser.add_argument("--profile", nargs='?', const=DEFAULT_OUTPUT, metavar="PREFIX", help="Profile the run and write PREFIX.collapsed, PREFIX.svg (flamegraph) and PREFIX-lag.json (event-loop lag); the prefix defaults to meross_profile.")
+    parser.add_argument("--trace", metavar="FILE", help="Record every device command, its acknowledgement and round-trip to FILE (gzipped JSON lines), to replay with replay_trace.py.")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose (DEBUG) logging.")
+    args = parser.parse_args()
+
+    try:
+        rules = load_schedule(args.schedule_file)
+    except FileNotFoundError:
+        print(f"Error: Schedule file '{args.schedule_file}' not found.", file=sys.stderr)
+        sys.exit(1)
+    except json.JSONDecodeError:
+        print(f"Error: Could not decode '{args.schedule_file}'. Please ensure it is valid JSON.", file=sys.stderr)
+        sys.exit(1)
+    except ValueError as e:
+        print(f"Error: {e} in '{args.schedule_file}'.", file=sys.stderr)
+        sys.exit(1)
+
+    if args.next is not None:
+        print_next_firings(rules, args.next)
+        return
+
+    email = password = None
+    if args.backend == "meross":
+        KEY_FILE = "secret.key"
+        CONFIG_FILE = "meross_config.json"
+
+        def load_key():
+            """Load the encryption key from the key file."""
+            try:
+                with open(KEY_FILE, "rb") as key_file:
+                    return key_file.read()
+            except FileNotFoundError:
+                return None
+
+        key = load_key()
+        if not key:
+            print(f"Error: Encryption key '{KEY_FILE}' not found. Please run the GUI app once to generate it.", file=sys.stderr)
+            sys.exit(1)
+
+        try:
+            with open(CONFIG_FILE, 'r') as f:
+                config = json.load(f)
+            email = config.get('email')
+            encrypted_password = config.get('password')
+            if not email or not encrypted_password:
+                print(f"Error: Could not find 'email' or 'password' in {CONFIG_FILE}.", file=sys.stderr)
+                sys.exit(1)
+
+            f = Fernet(key)
+            password = f.decrypt(encrypted_password.encode()).decode()
+
+        except FileNotFoundError:
+            print(f"Error: Configuration file '{CONFIG_FILE}' not found.", file=sys.stderr)
+            sys.exit(1)
+        except json.JSONDecodeError:
+            print(f"Error: Could not decode '{CONFIG_FILE}'. Please ensure it is valid JSON.", file=sys.stderr)
+            sys.exit(1)
+        except InvalidToken:
+            print("Error: Failed to decrypt password. The encryption key may have changed.", file=sys.stderr)
+            sys.exit(1)
+
+    start_trace(args.trace)
+    try:
+        asyncio.run(run_profiled(
+            run_schedule(
+                email=email,
+                password=password,
+                rules=rules,
+                backend=args.backend,
+                tick=args.tick,
+                misfire_grace=args.misfire_grace,
+                late_threshold=args.late_threshold,
+                report_interval=args.report_interval,
+                sim_lights=args.sim_lights,
+                command_deadline=args.command_deadline,
+                hedge_after=args.hedge_after,
+                history_dir=args.history_dir,
+                verbose=args.verbose
+            ),
+            args.profile
+        ))
+    except KeyboardInterrupt:
+        print("\nScript interrupted by user.")
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,7 @@ from cryptography.fernet import Fernet, InvalidToken
 from meross_iot.controller.mixins.light import LightMixin
 from meross_iot.http_api import MerossHttpClient
 from meross_iot.manager import MerossManager
+from profiler import DEFAULT_OUTPUT, run_profiled
 # Setup basic logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 async def discover_and_control_lights(email: str, password: str, action: str, light_name: str = None, serial_numbers: list = None, verbose: bool = False):
@@ -83,6 +84,7 @@ def main():
     parser.add_argument("action", choices=["on", "off", "list"], help="The action to perform.")
     parser.add_argument("--light-name", help="The name of the light to control.")
     parser.add_argument("--serial-numbers", nargs='+', help="A list of device serial numbers to target.")
+    parser.add_argument("--profile", nargs='?', const=DEFAULT_OUTPUT, metavar="PREFIX", help="Profile the run and write PREFIX.collapsed, PREFIX.svg (flamegraph) and PREFIX-lag.json (event-loop lag); the prefix defaults to meross_profile.")
     parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose (DEBUG) logging.")
     args = parser.parse_args()
 
@@ -128,13 +130,13 @@ def main():
     if args.action in ["on", "off"] and not args.light_name and not (args.serial_numbers and len(args.serial_numbers) == 1):
         parser.error("When action is 'on' or 'off', you must specify either --light-name or a single --serial-numbers.")
         
-    asyncio.run(discover_and_control_lights(
+    asyncio.run(run_profiled(discover_and_control_lights(
         email=email,
         password=password,
         action=args.action,
         light_name=args.light_name,
         serial_numbers=args.serial_numbers,
         verbose=args.verbose
-    ))
+    ), args.profile))
 if __name__ == "__main__":
     main()
\ No newline at end of file
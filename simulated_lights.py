@@ -0,0 +1,129 @@
+import asyncio
+import random
+import uuid as uuid_module
+from collections import deque
+
+from command_trace import attach_trace
+
+# Local stand-in for Meross bulbs.
+#
+# SimulatedLight implements the part of the meross_iot light API the effect
+# code uses (state getters, capability checks, async_update, async_turn_on/off
+# and async_set_light_color), so a LightCommandBuilder, CommandExecutor or
+# SyncGroupDispatcher can drive it without an account or network. Every
+# command takes a random round-trip time and may be lost, and the light keeps
+# a short history of when commands were sent, applied and acknowledged.
+
+
+class SimulatedLight:
+    """An RGB bulb with a configurable round-trip latency, jitter and loss rate.
+
+    A command is applied halfway through its round-trip and acknowledged at the
+    end of it. A lost command never completes: it raises asyncio.TimeoutError
+    once its timeout runs out, or waits until it is cancelled when it has none.
+    """
+
+    def __init__(self, name: str, uuid: str = None, latency: float = 0.05, jitter: float = 0.01,
+                 loss: float = 0.0, supports_rgb: bool = True, supports_luminance: bool = True,
+                 supports_temperature: bool = False, seed: int = None, history: int = 1000):
+        self.name = name
+        self.uuid = uuid or uuid_module.uuid4().hex
+        self.type = "simulated"
+        self.online_status = None
+        self.abilities = {}
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self._supports = {"rgb": supports_rgb, "luminance": supports_luminance, "temperature": supports_temperature}
+        self._rng = random.Random(seed)
+        self._on = False
+        self._rgb = (255, 255, 255)
+        self._luminance = 100
+        self.commands = 0
+        self.lost = 0
+        # (sent_at, applied_at, acked_at, fields) in event loop time
+        self.history = deque(maxlen=history)
+
+    def __repr__(self):
+        return f"SimulatedLight({self.name!r})"
+
+    def get_supports_rgb(self, channel: int = 0) -> bool:
+        return self._supports["rgb"]
+
+    def get_supports_luminance(self, channel: int = 0) -> bool:
+        return self._supports["luminance"]
+
+    def get_supports_temperature(self, channel: int = 0) -> bool:
+        return self._supports["temperature"]
+
+    def is_on(self, channel: int = 0) -> bool:
+        return self._on
+
+    def get_light_is_on(self, channel: int = 0) -> bool:
+        return self._on
+
+    def get_rgb_color(self, channel: int = 0) -> tuple:
+        return self._rgb
+
+    def get_luminance(self, channel: int = 0) -> int:
+        return self._luminance
+
+    def round_trip(self) -> float:
+        return max(0.0, self._rng.gauss(self.latency, self.jitter))
+
+    async def _command(self, timeout: float = None, rtt: float = None, lost: bool = None, **fields):
+        # A replay passes the recorded round-trip and loss instead of drawing them
+        loop = asyncio.get_running_loop()
+        sent_at = loop.time()
+        self.commands += 1
+        if lost is None:
+            lost = bool(self.loss) and self._rng.random() < self.loss
+        if lost:
+            self.lost += 1
+            if timeout is None:
+                await asyncio.Future()
+            await asyncio.sleep(timeout)
+            raise asyncio.TimeoutError(f"{self.name} did not answer within {timeout}s")
+        if rtt is None:
+            rtt = self.round_trip()
+        await asyncio.sleep(rtt / 2)
+        applied_at = loop.time()
+        self._apply(**fields)
+        await asyncio.sleep(rtt / 2)
+        self.history.append((sent_at, applied_at, loop.time(), fields))
+
+    def _apply(self, onoff: bool = None, rgb: tuple = None, luminance: int = None):
+        if onoff is not None:
+            self._on = onoff
+        if rgb is not None and self._supports["rgb"]:
+            self._rgb = tuple(rgb)
+        if luminance is not None and self._supports["luminance"]:
+            self._luminance = luminance
+
+    def _update_channel_status(self, channel: int = 0, rgb: tuple = None, luminance: int = None, **kwargs):
+        self._apply(rgb=rgb, luminance=luminance)
+
+    async def async_update(self, *args, timeout: float = None, **kwargs):
+        await self._command(timeout=timeout)
+
+    async def async_turn_on(self, channel: int = 0, timeout: float = None, *args, **kwargs):
+        await self._command(timeout=timeout, onoff=True)
+
+    async def async_turn_off(self, channel: int = 0, timeout: float = None, *args, **kwargs):
+        await self._command(timeout=timeout, onoff=False)
+
+    async def async_set_light_color(self, channel: int = 0, onoff: bool = None, rgb: tuple = None,
+                                    luminance: int = None, temperature: int = None, timeout: float = None,
+                                    *args, **kwargs):
+        # Like the real bulbs, a light command switches the light on unless told otherwise
+        await self._command(timeout=timeout, onoff=True if onoff is None else onoff, rgb=rgb, luminance=luminance)
+
+
+def make_simulated_lights(count: int, latency: float = 0.05, jitter: float = 0.01, loss: float = 0.0,
+                          seed: int = None) -> list:
+    """Create count simulated lights named 'Simulated 1' and up. A seed makes their latencies repeatable."""
+    rng = random.Random(seed)
+    lights = [SimulatedLight(f"Simulated {i + 1}", uuid=f"simulated-{i + 1}", latency=latency, jitter=jitter,
+                             loss=loss, seed=rng.randrange(2 ** 32) if seed is not None else None)
+              for i in range(count)]
+    return attach_trace(lights)
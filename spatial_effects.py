@@ -0,0 +1,186 @@
+import argparse
+import asyncio
+import logging
+import json
+import sys
+import time
+from cryptography.fernet import Fernet, InvalidToken
+from startup import StartupGraph, add_light_steps, async_close_login
+from light_layout import EFFECTS, load_layout, layout_coordinates, brightness_to_luminance
+from light_output_filter import LightOutputFilter
+from light_commands import LightCommandBuilder
+from command_executor import CommandExecutor
+from light_scenes import snapshot_scene, release_lights
+from hot_path_log import HotPathLog
+from profiler import DEFAULT_OUTPUT, run_profiled
+from command_trace import start_trace
+
+# Setup basic logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+async def run_spatial_effect(email: str, password: str, light_names: list, effect: str, layout_file: str = None,
+                             speed: float = None, update_interval: float = 0.2, min_luminance: int = 1,
+                             luminance_threshold: int = 5, color_threshold: int = 16,
+                             command_deadline: float = 2.0, hedge_after: float = None, restore_scene: bool = False,
+                             verbose: bool = False):
+    if verbose:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    positions = None
+    if layout_file:
+        try:
+            positions = load_layout(layout_file)
+        except (FileNotFoundError, json.JSONDecodeError, ValueError) as e:
+            logging.error(f"Could not load layout file '{layout_file}': {e}")
+            return
+
+    # Login, MQTT connection, discovery and the light state fetch run as a dependency graph,
+    # so independent steps overlap
+    startup = StartupGraph()
+    add_light_steps(startup, email, password, light_names)
+    try:
+        results = await startup.run()
+        logging.info("MerossManager initialized and devices discovered.")
+        startup.log_report()
+    except Exception as e:
+        logging.error(f"Failed to initialize MerossManager: {e}")
+        await async_close_login(startup)
+        return
+    http_client = results["login"]
+    target_lights = results["light state"]
+
+    if not target_lights:
+        logging.error("No target lights found.")
+        await http_client.async_logout()
+        return
+
+    # Positions are gathered once, every frame is then a single numpy evaluation over all lights
+    coords = layout_coordinates(target_lights, positions)
+    effect_fn = EFFECTS[effect]
+    effect_kwargs = {} if speed is None else {"speed": speed}
+
+    logging.info(f"Running {effect} effect on {[light.name for light in target_lights]}. Press Ctrl+C to stop.")
+
+    prior_scene = snapshot_scene(target_lights) if restore_scene else None
+
+    # Neighbouring frames differ very little per light, the filter drops the changes nobody would notice
+    output_filter = LightOutputFilter(luminance_threshold=luminance_threshold, color_threshold=color_threshold)
+    for light in target_lights:
+        output_filter.seed(light)
+    executor = CommandExecutor(deadline=command_deadline, hedge_after=hedge_after)
+    commands = LightCommandBuilder(output_filter, executor=executor)
+    hot_log = HotPathLog(f"{effect} effect")
+    hot_log.track_commands(commands)
+
+    start = time.monotonic()
+    frames = 0
+    compute_time = 0.0
+    try:
+        while True:
+            frame_start = time.perf_counter()
+            rgb_values, brightness = effect_fn(coords, time.monotonic() - start, **effect_kwargs)
+            luminances = brightness_to_luminance(brightness, min_luminance)
+            compute_time += time.perf_counter() - frame_start
+            frames += 1
+            for light, rgb, luminance in zip(target_lights, rgb_values.tolist(), luminances.tolist()):
+                commands.set(light, onoff=True, rgb=rgb, luminance=luminance)
+            await commands.flush()
+            hot_log.update()
+            startup.mark("first light command")
+            await asyncio.sleep(update_interval)
+
+    except asyncio.CancelledError:
+        logging.info("Spatial effect stopped.")
+    finally:
+        hot_log.log_summary()
+        if frames:
+            logging.info(f"Computed {frames} frame(s) for {len(target_lights)} light(s), "
+                         f"{compute_time / frames * 1e6:.0f} us per frame on average.")
+        output_filter.log_summary()
+        commands.log_summary()
+        await release_lights(target_lights, prior_scene, executor)
+        executor.log_health()
+        await http_client.async_logout()
+
+def main():
+    parser = argparse.ArgumentParser(description="Run position based effects (waves, pulses, gradients) on Meross smart lights.")
+    parser.add_argument("--light-names", nargs='+', help="The name(s) of the light(s) to use (default: all lights). Also accepts aliases, group:<name>, tag:<name> and glob patterns.")
+    parser.add_argument("--effect", choices=sorted(EFFECTS), default="wave", help="The effect to run (default: wave).")
+    parser.add_argument("--layout", help="JSON file with the position of every light. Without it the lights are placed in a row.")
+    parser.add_argument("--speed", type=float, help="Speed of the effect in layout widths per second (default: per effect).")
+    parser.add_argument("--update-interval", type=float, default=0.2, help="Seconds between effect frames (default: 0.2).")
+    parser.add_argument("--min-luminance", type=int, default=1, help="Lowest luminance the effect uses (default: 1).")
+    parser.add_argument("--luminance-threshold", type=int, default=5, help="Smallest luminance change that is sent to a light (default: 5).")
+    parser.add_argument("--color-threshold", type=int, default=16, help="Smallest change of a color channel that is sent to a light (default: 16).")
+    parser.add_argument("--command-deadline", type=float, default=2.0, help="Seconds a light gets to acknowledge a command before it counts as failed (default: 2.0).")
+    parser.add_argument("--hedge-after", type=float, help="Send a second copy of a command that has not been acknowledged after this many seconds.")
+    parser.add_argument("--restore-scene", action="store_true", help="When stopping, put the lights back the way they were instead of turning them off.")
+    parser.add_argument("--profile", nargs='?', const=DEFAULT_OUTPUT, metavar="PREFIX", help="Profile the run and write PREFIX.collapsed, PREFIX.svg (flamegraph) and PREFIX-lag.json (event-loop lag); the prefix defaults to meross_profile.")
+    parser.add_argument("--trace", metavar="FILE", help="Record every device command, its acknowledgement and round-trip to FILE (gzipped JSON lines), to replay with replay_trace.py.")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose (DEBUG) logging.")
+    args = parser.parse_args()
+
+    KEY_FILE = "secret.key"
+    CONFIG_FILE = "meross_config.json"
+
+    def load_key():
+        """Load the encryption key from the key file."""
+        try:
+            with open(KEY_FILE, "rb") as key_file:
+                return key_file.read()
+        except FileNotFoundError:
+            return None
+
+    key = load_key()
+    if not key:
+        print(f"Error: Encryption key '{KEY_FILE}' not found. Please run the GUI app once to generate it.", file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        with open(CONFIG_FILE, 'r') as f:
+            config = json.load(f)
+        email = config.get('email')
+        encrypted_password = config.get('password')
+        if not email or not encrypted_password:
+            print(f"Error: Could not find 'email' or 'password' in {CONFIG_FILE}.", file=sys.stderr)
+            sys.exit(1)
+        
+        f = Fernet(key)
+        password = f.decrypt(encrypted_password.encode()).decode()
+
+    except FileNotFoundError:
+        print(f"Error: Configuration file '{CONFIG_FILE}' not found.", file=sys.stderr)
+        sys.exit(1)
+    except json.JSONDecodeError:
+        print(f"Error: Could not decode '{CONFIG_FILE}'. Please ensure it is valid JSON.", file=sys.stderr)
+        sys.exit(1)
+    except InvalidToken:
+        print("Error: Failed to decrypt password. The encryption key may have changed.", file=sys.stderr)
+        sys.exit(1)
+
+    start_trace(args.trace)
+    try:
+        asyncio.run(run_profiled(
+            run_spatial_effect(
+                email=email,
+                password=password,
+                light_names=args.light_names,
+                effect=args.effect,
+                layout_file=args.layout,
+                speed=args.speed,
+                update_interval=args.update_interval,
+                min_luminance=args.min_luminance,
+                luminance_threshold=args.luminance_threshold,
+                color_threshold=args.color_threshold,
+                command_deadline=args.command_deadline,
+                hedge_after=args.hedge_after,
+                restore_scene=args.restore_scene,
+                verbose=args.verbose
+            ),
+            args.profile
+        ))
+    except KeyboardInterrupt:
+        print("\nScript interrupted by user.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+import asyncio
+import logging
+
+from meross_iot.http_api import MerossHttpClient
+from meross_iot.manager import MerossManager
+
+from light_discovery import async_discover_lights
+from light_registry import load_registry_config
+
+# Startup as a dependency graph.
+#
+# Every startup step names the steps whose results it needs, and starts as soon
+# as those are done. Local work (opening audio devices, spawning the capture
+# process, loading layout and registry files) therefore runs while the network
+# chain of login, MQTT connection and discovery is still waiting on the cloud.
+# The graph records when every step ran, plus milestones such as the first
+# light command, and logs them as a per-phase report.
+
+
+class _Step:
+    __slots__ = ("func", "deps", "blocking")
+
+    def __init__(self, func, deps, blocking):
+        self.func = func
+        self.deps = deps
+        self.blocking = blocking
+
+
+class StartupGraph:
+    """Runs named startup steps concurrently, each one as soon as its dependencies are done.
+
+    step(name, func, *deps) registers a coroutine function called with the
+    results of deps, in order. With blocking=True, func is a regular function
+    and runs in a worker thread so it does not hold up the event loop.
+    """
+
+    def __init__(self):
+        self._steps = {}
+        self.results = {}
+        self.timings = {}
+        self.milestones = {}
+        self._t0 = None
+        self._loop = None
+        self.finished_at = None
+
+    def step(self, name: str, func, *deps, blocking: bool = False):
+        for dep in deps:
+            if dep not in self._steps:
+                raise ValueError(f"Startup step '{name}' depends on unknown step '{dep}'")
+        self._steps[name] = _Step(func, deps, blocking)
+
+    async def run(self) -> dict:
+        """Run every step. Returns {name: result}. On failure the remaining steps are cancelled and the error re-raised."""
+        self._loop = asyncio.get_running_loop()
+        self._t0 = self._loop.time()
+        tasks = {}
+
+        async def run_step(name):
+            step = self._steps[name]
+            args = [await tasks[dep] for dep in step.deps]
+            start = self._loop.time()
+            if step.blocking:
+                result = await self._loop.run_in_executor(None, step.func, *args)
+            else:
+                result = await step.func(*args)
+            self.timings[name] = (start - self._t0, self._loop.time() - self._t0)
+            self.results[name] = result
+            return result
+
+        for name in self._steps:
+            tasks[name] = asyncio.ensure_future(run_step(name))
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            raise
+        self.finished_at = self._loop.time() - self._t0
+        return self.results
+
+    def mark(self, milestone: str):
+        """Record and log a milestone such as the first light command. Later marks of the same milestone are ignored."""
+        if milestone in self.milestones or self._t0 is None:
+            return
+        self.milestones[milestone] = self._loop.time() - self._t0
+        logging.info(f"Startup {milestone} at {self.milestones[milestone] * 1000:.0f} ms.")
+
+    def report(self) -> dict:
+        serial = sum(end - start for start, end in self.timings.values())
+        return {
+            "steps_ms": {name: (round(start * 1000), round(end * 1000)) for name, (start, end) in self.timings.items()},
+            "ready_ms": round(self.finished_at * 1000) if self.finished_at is not None else None,
+            "serial_ms": round(serial * 1000),
+            "milestones_ms": {name: round(at * 1000) for name, at in self.milestones.items()},
+        }
+
+    def log_report(self):
+        report = self.report()
+        for name, (start, end) in sorted(report["steps_ms"].items(), key=lambda item: item[1]):
+            logging.info(f"Startup {name}: {start}-{end} ms ({end - start} ms)")
+        logging.info(f"Startup ready after {report['ready_ms']} ms, the steps one after the other "
+                     f"would take {report['serial_ms']} ms.")
+
+
+def add_light_steps(graph: StartupGraph, email: str, password: str, light_names: list = None, uuids: list = None):
+    """Register the network chain: login, MQTT connection and device list in parallel, discovery, light state.
+
+    Results: "login" is the MerossHttpClient, "manager" the MerossManager,
+    "discovery" the target lights, and "light state" the same lights once
+    their state has been fetched.
+    """
+    async def login():
+        return await MerossHttpClient.async_from_user_password(email=email, password=password,
+                                                               api_base_url="https://iot.meross.com")
+
+    async def init_manager(http_client):
+        manager = MerossManager(http_client=http_client)
+        await manager.async_init()
+        return manager
+
+    async def list_devices(http_client):
+        return await http_client.async_list_devices()
+
+    async def discover(http_client, manager, http_devices, registry_config):
+        return await async_discover_lights(manager, http_client, light_names, uuids,
+                                           registry_config=registry_config, http_devices=http_devices)
+
+    def load_registry():
+        # A broken registry file must not keep anyone from logging in, the selectors then only match names and uuids
+        try:
+            return load_registry_config()
+        except (OSError, ValueError) as e:
+            logging.error(f"Could not load the light registry file, continuing without aliases, groups and tags: {e}")
+            return {}
+
+    async def update_lights(lights):
+        await asyncio.gather(*(light.async_update() for light in lights))
+        return lights
+
+    graph.step("registry file", load_registry, blocking=True)
+    graph.step("login", login)
+    graph.step("manager", init_manager, "login")
+    graph.step("device list", list_devices, "login")
+    graph.step("discovery", discover, "login", "manager", "device list", "registry file")
+    graph.step("light state", update_lights, "discovery")
+
+
+async def async_close_login(graph: StartupGraph):
+    """Log out again when startup failed after the login went through."""
+    http_client = graph.results.get("login")
+    if http_client is not None:
+        await http_client.async_logout()
@@ -5,10 +5,10 @@ import speech_recognition as sr
 import sys
 import json
 
-from meross_iot.controller.mixins.light import LightMixin
-from meross_iot.http_api import MerossHttpClient
-from meross_iot.manager import MerossManager
+from startup import StartupGraph, add_light_steps, async_close_login
 from cryptography.fernet import Fernet, InvalidToken
+from profiler import DEFAULT_OUTPUT, run_profiled
+from command_trace import start_trace
 
 # Setup basic logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -28,61 +28,43 @@ async def voice_control_lights(email: str, password: str, light_names: list, ver
     if verbose:
         logging.getLogger().setLevel(logging.DEBUG)
 
-    # Setup Meross HTTP API client and manager
-    http_client = await MerossHttpClient.async_from_user_password(email=email, password=password, api_base_url="https://iot.meross.com")
-    manager = MerossManager(http_client=http_client)
-
-    # Discover devices
+    def calibrate_microphone():
+        recognizer = sr.Recognizer()
+        microphone = sr.Microphone()
+        with microphone as source:
+            logging.info("Adjusting for ambient noise... Please wait.")
+            recognizer.adjust_for_ambient_noise(source)
+        return recognizer, microphone
+
+    # Login, MQTT connection, discovery and the light state fetch run as a dependency graph,
+    # and the microphone is opened and calibrated alongside
+    startup = StartupGraph()
+    add_light_steps(startup, email, password, light_names)
+    startup.step("microphone", calibrate_microphone, blocking=True)
     try:
-        await manager.async_init()
-        await manager.async_device_discovery()
+        results = await startup.run()
         logging.info("MerossManager initialized and devices discovered.")
+        startup.log_report()
     except Exception as e:
         logging.error(f"Failed to initialize MerossManager: {e}")
-        await http_client.async_logout()
+        await async_close_login(startup)
         return
-
-    all_devices = manager.find_devices()
-    controllable_lights = [dev for dev in all_devices if isinstance(dev, LightMixin)]
-
-    target_lights = []
-    if light_names:
-        for light_name in light_names:
-            light = next((l for l in controllable_lights if l.name.lower() == light_name.lower()), None)
-            if light:
-                target_lights.append(light)
-            else:
-                logging.warning(f"Light '{light_name}' not found.")
-    else:
-        target_lights.extend(controllable_lights)
+    http_client = results["login"]
+    target_lights = results["light state"]
 
     if not target_lights:
         logging.error("No target lights found. Exiting.")
         await http_client.async_logout()
         return
 
-    # It's good practice to update and turn on lights at the start if that's the desired initial state
-    try:
-        tasks = [light.async_update() for light in target_lights]
-        await asyncio.gather(*tasks)
-        # Optionally turn them on here, or leave off until voice command
-        # tasks = [light.async_turn_on() for light in target_lights]
-        # await asyncio.gather(*tasks)
-    except Exception as e:
-        logging.error(f"Failed to prepare lights: {e}")
-        await http_client.async_logout()
-        return
-
-    recognizer = sr.Recognizer()
-    microphone = sr.Microphone()
+    # The recognizer keeps adapting its energy threshold while listening, so calibrating once is enough
+    recognizer, microphone = results["microphone"]
 
     logging.info(f"Voice control active for: {[light.name for light in target_lights]}. Say 'lights on' or 'lights off'. Press Ctrl+C to stop.")
 
     try:
         while True:
             with microphone as source:
-                logging.info("Adjusting for ambient noise... Please wait.")
-                recognizer.adjust_for_ambient_noise(source) 
                 logging.info("Listening for commands...")
                 audio = recognizer.listen(source, phrase_time_limit=5) # Listen for a phrase, up to 5 seconds
 
@@ -118,7 +100,9 @@ async def voice_control_lights(email: str, password: str, light_names: list, ver
 
 def main():
     parser = argparse.ArgumentParser(description="Control Meross smart lights using simplified voice commands.")
-    parser.add_argument("--light-names", nargs='+', required=True, help="The name(s) of the light(s) to control.")
+    parser.add_argument("--light-names", nargs='+', required=True, help="The name(s) of the light(s) to control. Also accepts aliases, group:<name>, tag:<name> and glob patterns.")
+    parser.add_argument("--profile", nargs='?', const=DEFAULT_OUTPUT, metavar="PREFIX", help="Profile the run and write PREFIX.collapsed, PREFIX.svg (flamegraph) and PREFIX-lag.json (event-loop lag); the prefix defaults to meross_profile.")
+    parser.add_argument("--trace", metavar="FILE", help="Record every device command, its acknowledgement and round-trip to FILE (gzipped JSON lines), to replay with replay_trace.py.")
     parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose (DEBUG) logging.")
     args = parser.parse_args()
 
@@ -149,22 +133,14 @@ def main():
         print("Error: Failed to decrypt password. The encryption key may have changed.", file=sys.stderr)
         sys.exit(1)
 
+    start_trace(args.trace)
     try:
-        # Check for sounddevice and numpy installations first
-        try:
-            import sounddevice as sd
-            import numpy as np
-        except ImportError:
-            print("Error: 'sounddevice' and/or 'numpy' not found.", file=sys.stderr)
-            print("Please install them: pip install sounddevice numpy", file=sys.stderr)
-            sys.exit(1)
-
-        asyncio.run(voice_control_lights(
+        asyncio.run(run_profiled(voice_control_lights(
             email=email,
             password=password,
             light_names=args.light_names,
             verbose=args.verbose
-        ))
+        ), args.profile))
     except KeyboardInterrupt:
         print("\nScript interrupted by user.")
     except Exception as e:
@@ -0,0 +1,166 @@
+import asyncio
+import json
+import logging
+import time
+
+import numpy as np
+
+# Streaming frame API for other local programs.
+#
+# Clients connect over WebSocket and stream binary frames; every frame is a
+# sequence of 6 byte records, one per light:
+#
+#     uint16 light index (little endian), uint8 red, uint8 green, uint8 blue, uint8 luminance
+#
+# Luminance 0 turns the light off, 1-100 sets it, and 255 keeps the current
+# luminance (color only). Text messages are JSON: the server greets every
+# client with {"type": "lights", ...} listing the light indexes, answers
+# {"type": "stats"} with the session statistics and pushes those statistics
+# on its own every stats_interval seconds so a client can slow down.
+#
+# All clients feed the same CoalescingOutput, so the light traffic does not
+# grow with the number of clients or their frame rates.
+
+RECORD = np.dtype([("index", "<u2"), ("r", "u1"), ("g", "u1"), ("b", "u1"), ("luminance", "u1")])
+LUMINANCE_UNCHANGED = 255
+
+
+def encode_frame(records) -> bytes:
+    """Pack [(index, (r, g, b), luminance)] into a binary frame (for clients written in Python)."""
+    frame = np.empty(len(records), dtype=RECORD)
+    for i, (index, rgb, luminance) in enumerate(records):
+        frame[i] = (index, rgb[0], rgb[1], rgb[2], luminance)
+    return frame.tobytes()
+
+
+def decode_frame(message: bytes) -> np.ndarray:
+    if len(message) % RECORD.itemsize:
+        raise ValueError(f"Frame length {len(message)} is not a multiple of {RECORD.itemsize}")
+    return np.frombuffer(message, dtype=RECORD)
+
+
+class ClientSession:
+    """Counters and rate limiting of one connected client."""
+
+    def __init__(self, name: str, max_frame_rate: float = None):
+        self.name = name
+        self.min_frame_gap = 1.0 / max_frame_rate if max_frame_rate else 0.0
+        self.connected_at = time.monotonic()
+        self._last_accepted = 0.0
+        self.frames = 0
+        self.records = 0
+        self.bytes = 0
+        self.dropped_rate = 0
+        self.dropped_invalid = 0
+        self.coalesced = 0
+
+    def accept_frame(self, size: int) -> bool:
+        """Count an incoming frame. Returns False when it arrived faster than the session allows."""
+        self.frames += 1
+        self.bytes += size
+        now = time.monotonic()
+        if now - self._last_accepted < self.min_frame_gap:
+            self.dropped_rate += 1
+            return False
+        self._last_accepted = now
+        return True
+
+    def stats(self) -> dict:
+        elapsed = max(time.monotonic() - self.connected_at, 1e-6)
+        return {
+            "type": "stats",
+            "client": self.name,
+            "frames": self.frames,
+            "records": self.records,
+            "frames_per_second": round(self.frames / elapsed, 1),
+            "bytes_per_second": round(self.bytes / elapsed),
+            "dropped_rate_limited": self.dropped_rate,
+            "dropped_invalid": self.dropped_invalid,
+            "coalesced": self.coalesced,
+        }
+
+
+class FrameServer:
+    """Accepts WebSocket clients and stages their frames on a shared CoalescingOutput."""
+
+    def __init__(self, lights: list, output, max_frame_rate: float = None, stats_interval: float = 5.0):
+        self.lights = lights
+        self.output = output
+        self.max_frame_rate = max_frame_rate
+        self.stats_interval = stats_interval
+        self.sessions = {}
+        self._next_client = 1
+
+    def lights_message(self) -> str:
+        return json.dumps({"type": "lights", "record_size": RECORD.itemsize,
+                           "lights": [{"index": i, "name": light.name, "uuid": light.uuid}
+                                      for i, light in enumerate(self.lights)]})
+
+    def apply_frame(self, session: ClientSession, message: bytes):
+        try:
+            records = decode_frame(message)
+        except ValueError as e:
+            session.dropped_invalid += 1
+            logging.debug(f"{session.name}: {e}")
+            return
+        session.records += len(records)
+        valid = records["index"] < len(self.lights)
+        if not valid.all():
+            session.dropped_invalid += int((~valid).sum())
+            records = records[valid]
+        for index, r, g, b, luminance in records.tolist():
+            light = self.lights[index]
+            if luminance == 0:
+                replaced = self.output.submit(light, onoff=False)
+            elif luminance == LUMINANCE_UNCHANGED:
+                replaced = self.output.submit(light, onoff=True, rgb=(r, g, b))
+            else:
+                replaced = self.output.submit(light, onoff=True, rgb=(r, g, b), luminance=min(luminance, 100))
+            session.coalesced += replaced
+
+    async def handle_client(self, websocket):
+        session = ClientSession(f"client-{self._next_client}", self.max_frame_rate)
+        self._next_client += 1
+        self.sessions[session.name] = session
+        logging.info(f"{session.name} connected from {websocket.remote_address}.")
+        await websocket.send(self.lights_message())
+        pusher = asyncio.ensure_future(self._push_stats(websocket, session))
+        try:
+            async for message in websocket:
+                if isinstance(message, bytes):
+                    if session.accept_frame(len(message)):
+                        self.apply_frame(session, message)
+                    continue
+                try:
+                    request = json.loads(message)
+                except json.JSONDecodeError:
+                    session.dropped_invalid += 1
+                    continue
+                if request.get("type") == "stats":
+                    await websocket.send(json.dumps(session.stats()))
+                elif request.get("type") == "lights":
+                    await websocket.send(self.lights_message())
+        except Exception as e:
+            logging.debug(f"{session.name} connection ended: {e!r}")
+        finally:
+            # Await the pusher too, so an error it hit (e.g. sending on a closed connection) is retrieved
+            pusher.cancel()
+            for result in await asyncio.gather(pusher, return_exceptions=True):
+                if isinstance(result, Exception):
+                    logging.debug(f"{session.name} stats push ended: {result!r}")
+            del self.sessions[session.name]
+            logging.info(f"{session.name} disconnected: {session.stats()}")
+
+    async def _push_stats(self, websocket, session: ClientSession):
+        if not self.stats_interval:
+            return
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            await websocket.send(json.dumps(session.stats()))
+
+    def log_stats(self):
+        for session in self.sessions.values():
+            stats = session.stats()
+            logging.info(f"{session.name}: {stats['frames_per_second']} frame(s)/s, {stats['bytes_per_second']} B/s, "
+                         f"{stats['dropped_rate_limited']} rate limited, {stats['dropped_invalid']} invalid, "
+                         f"{stats['coalesced']} coalesced.")
@@ -0,0 +1,180 @@
+import argparse
+import asyncio
+import logging
+import json
+import sys
+from cryptography.fernet import Fernet, InvalidToken
+from startup import StartupGraph, add_light_steps, async_close_login
+from ws_frame_api import FrameServer
+from output_stage import CoalescingOutput
+from light_output_filter import LightOutputFilter
+from light_commands import LightCommandBuilder
+from command_executor import CommandExecutor
+from light_scenes import snapshot_scene, release_lights
+from hot_path_log import HotPathLog
+from profiler import DEFAULT_OUTPUT, run_profiled
+from command_trace import start_trace
+
+# Setup basic logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+async def run_frame_server(email: str, password: str, light_names: list, host: str = "127.0.0.1", port: int = 8765,
+                           max_frame_rate: float = None, stats_interval: float = 5.0, update_interval: float = 0.05,
+                           luminance_threshold: int = 2, color_threshold: int = 8,
+                           command_deadline: float = 2.0, hedge_after: float = None, restore_scene: bool = False,
+                           verbose: bool = False):
+    import websockets
+
+    if verbose:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    # Login, MQTT connection, discovery and the light state fetch run as a dependency graph,
+    # so independent steps overlap
+    startup = StartupGraph()
+    add_light_steps(startup, email, password, light_names)
+    try:
+        results = await startup.run()
+        logging.info("MerossManager initialized and devices discovered.")
+        startup.log_report()
+    except Exception as e:
+        logging.error(f"Failed to initialize MerossManager: {e}")
+        await async_close_login(startup)
+        return
+    http_client = results["login"]
+    target_lights = results["light state"]
+
+    if not target_lights:
+        logging.error("No target lights found.")
+        await http_client.async_logout()
+        return
+
+    prior_scene = snapshot_scene(target_lights) if restore_scene else None
+
+    output_filter = LightOutputFilter(luminance_threshold=luminance_threshold, color_threshold=color_threshold)
+    for light in target_lights:
+        output_filter.seed(light)
+    executor = CommandExecutor(deadline=command_deadline, hedge_after=hedge_after)
+    commands = LightCommandBuilder(output_filter, executor=executor)
+    # Every client feeds the same output stage, so the bulbs never see more than one state per tick
+    hot_log = HotPathLog("ws frames")
+    hot_log.track_commands(commands)
+    output = CoalescingOutput(commands, update_interval, hot_log)
+    frame_server = FrameServer(target_lights, output, max_frame_rate=max_frame_rate, stats_interval=stats_interval)
+
+    async def log_stats():
+        while True:
+            await asyncio.sleep(stats_interval or 5.0)
+            frame_server.log_stats()
+
+    try:
+        try:
+            server = await websockets.serve(frame_server.handle_client, host, port)
+        except OSError as e:
+            # E.g. the port is already in use; the lights are still released and the session closed below
+            logging.error(f"Could not open the frame server port {host}:{port}: {e}")
+            return
+        async with server:
+            logging.info(f"Frame server listening on ws://{host}:{port} for {[light.name for light in target_lights]}. "
+                         f"Press Ctrl+C to stop.")
+            await asyncio.gather(output.run(), log_stats())
+
+    except asyncio.CancelledError:
+        logging.info("Frame server stopped.")
+    finally:
+        hot_log.log_summary()
+        output.log_summary()
+        output_filter.log_summary()
+        commands.log_summary()
+        await release_lights(target_lights, prior_scene, executor)
+        executor.log_health()
+        await http_client.async_logout()
+
+def main():
+    parser = argparse.ArgumentParser(description="Let local programs stream lighting frames to Meross smart lights over WebSocket.")
+    parser.add_argument("--light-names", nargs='+', help="The name(s) of the light(s) to expose, in index order (default: all lights). Also accepts aliases, group:<name>, tag:<name> and glob patterns.")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (default: 127.0.0.1).")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on (default: 8765).")
+    parser.add_argument("--max-frame-rate", type=float, help="Frames per second accepted from each client, faster frames are dropped (default: unlimited).")
+    parser.add_argument("--stats-interval", type=float, default=5.0, help="Seconds between statistics pushed to every client and logged (default: 5, 0 disables the push).")
+    parser.add_argument("--update-interval", type=float, default=0.05, help="Minimum seconds between two rounds of commands to the lights (default: 0.05).")
+    parser.add_argument("--luminance-threshold", type=int, default=2, help="Smallest luminance change that is sent to a light (default: 2).")
+    parser.add_argument("--color-threshold", type=int, default=8, help="Smallest change of a color channel that is sent to a light (default: 8).")
+    parser.add_argument("--command-deadline", type=float, default=2.0, help="Seconds a light gets to acknowledge a command before it counts as failed (default: 2.0).")
+    parser.add_argument("--hedge-after", type=float, help="Send a second copy of a command that has not been acknowledged after this many seconds.")
+    parser.add_argument("--restore-scene", action="store_true", help="When stopping, put the lights back the way they were instead of turning them off.")
+    parser.add_argument("--profile", nargs='?', const=DEFAULT_OUTPUT, metavar="PREFIX", help="Profile the run and write PREFIX.collapsed, PREFIX.svg (flamegraph) and PREFIX-lag.json (event-loop lag); the prefix defaults to meross_profile.")
+    parser.add_argument("--trace", metavar="FILE", help="Record every device command, its acknowledgement and round-trip to FILE (gzipped JSON lines), to replay with replay_trace.py.")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose (DEBUG) logging.")
+    args = parser.parse_args()
+
+    KEY_FILE = "secret.key"
+    CONFIG_FILE = "meross_config.json"
+
+    def load_key():
+        """Load the encryption key from the key file."""
+        try:
+            with open(KEY_FILE, "rb") as key_file:
+                return key_file.read()
+        except FileNotFoundError:
+            return None
+
+    key = load_key()
+    if not key:
+        print(f"Error: Encryption key '{KEY_FILE}' not found. Please run the GUI app once to generate it.", file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        with open(CONFIG_FILE, 'r') as f:
+            config = json.load(f)
+        email = config.get('email')
+        encrypted_password = config.get('password')
+        if not email or not encrypted_password:
+            print(f"Error: Could not find 'email' or 'password' in {CONFIG_FILE}.", file=sys.stderr)
+            sys.exit(1)
+        
+        f = Fernet(key)
+        password = f.decrypt(encrypted_password.encode()).decode()
+
+    except FileNotFoundError:
+        print(f"Error: Configuration file '{CONFIG_FILE}' not found.", file=sys.stderr)
+        sys.exit(1)
+    except json.JSONDecodeError:
+        print(f"Error: Could not decode '{CONFIG_FILE}'. Please ensure it is valid JSON.", file=sys.stderr)
+        sys.exit(1)
+    except InvalidToken:
+        print("Error: Failed to decrypt password. The encryption key may have changed.", file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        import websockets
+    except ImportError:
+        print("Error: 'websockets' not found.", file=sys.stderr)
+        print("Please install it: pip install websockets", file=sys.stderr)
+        sys.exit(1)
+
+    start_trace(args.trace)
+    try:
+        asyncio.run(run_profiled(
+            run_frame_server(
+                email=email,
+                password=password,
+                light_names=args.light_names,
+                host=args.host,
+                port=args.port,
+                max_frame_rate=args.max_frame_rate,
+                stats_interval=args.stats_interval,
+                update_interval=args.update_interval,
+                luminance_threshold=args.luminance_threshold,
+                color_threshold=args.color_threshold,
+                command_deadline=args.command_deadline,
+                hedge_after=args.hedge_after,
+                restore_scene=args.restore_scene,
+                verbose=args.verbose
+            ),
+            args.profile
+        ))
+    except KeyboardInterrupt:
+        print("\nScript interrupted by user.")
+
+if __name__ == "__main__":
+    main()